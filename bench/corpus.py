@@ -0,0 +1,119 @@
+"""
+Synthetic remote/ trees and document corpora for the benchmark suite.
+
+Generation is seeded, so the same parameters always produce the same tree
+(file contents, names and sizes); only the modification times differ between runs.
+"""
+import os
+import random
+
+import fitz
+import openpyxl
+import pptx
+from pptx.util import Inches, Pt
+
+
+WORDS = ("alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel", "india", "juliet",
+         "kilo", "lima", "mike", "november", "oscar", "papa", "quebec", "romeo", "sierra", "tango",
+         "report", "invoice", "budget", "plan", "draft", "final", "summary", "contract", "minutes", "notes")
+
+
+def _name(rng, words=2):
+    return "_".join(rng.choice(WORDS) for _ in range(words))
+
+
+def _sentence(rng, words=12):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def write_pdf(path, pages, rng):
+    doc = fitz.open()
+    for page_number in range(pages):
+        page = doc.new_page(width=595, height=842)  # A4
+        page.insert_text((56, 72), f"Page {page_number + 1} - {_name(rng, 3)}", fontsize=18)
+        y = 110
+        while y < 780:
+            page.insert_text((56, y), _sentence(rng), fontsize=10)
+            y += 14
+        page.draw_rect(fitz.Rect(380, 120, 540, 260), color=(0.2, 0.3, 0.8), fill=(0.85, 0.9, 1.0))
+    doc.save(path)
+    doc.close()
+
+
+def write_xlsx(path, sheets, rows, columns, rng):
+    workbook = openpyxl.Workbook()
+    workbook.remove(workbook.active)
+    for sheet_index in range(sheets):
+        sheet = workbook.create_sheet(f"Sheet{sheet_index + 1}")
+        sheet.append([f"{rng.choice(WORDS)}_{column}" for column in range(columns)])
+        for _ in range(rows):
+            sheet.append([rng.randint(0, 100000) if column % 2 else rng.choice(WORDS) for column in range(columns)])
+    workbook.save(path)
+
+
+def write_pptx(path, slides, rng):
+    presentation = pptx.Presentation()
+    layout = presentation.slide_layouts[1]  # title and content
+    for slide_index in range(slides):
+        slide = presentation.slides.add_slide(layout)
+        slide.shapes.title.text = f"Slide {slide_index + 1}: {_name(rng, 3)}"
+        body = slide.placeholders[1].text_frame
+        body.text = _sentence(rng)
+        for _ in range(4):
+            body.add_paragraph().text = _sentence(rng, 8)
+        box = slide.shapes.add_textbox(Inches(6), Inches(6), Inches(3), Inches(1))
+        box.text_frame.text = _name(rng)
+        box.text_frame.paragraphs[0].runs[0].font.size = Pt(12)
+    presentation.save(path)
+
+
+def generate_corpus(root, depth=3, fanout=4, files_per_dir=20, pdfs=10, pdf_pages=20, xlsx=5, xlsx_rows=500,
+                    pptx_files=5, pptx_slides=10, seed=0):
+    """
+    Build a synthetic tree under root (created if needed).
+
+    Returns:
+        {"catalog": {relative path: "file" | "dir"}, "dirs": [...], "files": [...],
+         "pdf": [...], "xlsx": [...], "pptx": [...]} with relative posix paths
+    """
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    corpus = {"catalog": {}, "dirs": ["."], "files": [], "pdf": [], "xlsx": [], "pptx": []}
+
+    def add(relative_path, entry_type):
+        corpus["catalog"][relative_path] = entry_type
+        corpus["dirs" if entry_type == "dir" else "files"].append(relative_path)
+
+    # Directory tree with small text files
+    level = ["."]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for index in range(fanout):
+                relative_dir = f"{_name(rng)}_{index}" if parent == "." else f"{parent}/{_name(rng)}_{index}"
+                os.makedirs(os.path.join(root, relative_dir), exist_ok=True)
+                add(relative_dir, "dir")
+                next_level.append(relative_dir)
+        level = next_level
+    for relative_dir in list(corpus["dirs"]):
+        for index in range(files_per_dir):
+            relative_file = f"{_name(rng)}_{index}.txt" if relative_dir == "." else f"{relative_dir}/{_name(rng)}_{index}.txt"
+            with open(os.path.join(root, relative_file), "w", encoding="utf-8") as f:
+                f.write("\n".join(_sentence(rng) for _ in range(rng.randint(1, 40))))
+            add(relative_file, "file")
+
+    # Documents, spread over the tree
+    documents = (("pdf", pdfs, lambda path: write_pdf(path, pdf_pages, rng)),
+                 ("xlsx", xlsx, lambda path: write_xlsx(path, 3, xlsx_rows, 12, rng)),
+                 ("pptx", pptx_files, lambda path: write_pptx(path, pptx_slides, rng)))
+    for extension, count, write in documents:
+        for index in range(count):
+            relative_dir = rng.choice(corpus["dirs"])
+            relative_file = f"{_name(rng)}_{index}.{extension}"
+            if relative_dir != ".":
+                relative_file = f"{relative_dir}/{relative_file}"
+            write(os.path.join(root, relative_file))
+            add(relative_file, "file")
+            corpus[extension].append(relative_file)
+
+    return corpus
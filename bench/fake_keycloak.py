@@ -0,0 +1,463 @@
+"""
+In-memory Keycloak stand-in for the benchmark suite.
+
+Implements the OpenID (token, certs, introspect, UMA) and admin endpoints listed in
+routers/utils/keycloak_vars.py closely enough for the app to run unmodified against it.
+Every request is delayed by a configurable latency, so Keycloak round trips cost
+roughly what they cost against a real server. The server runs in a separate process
+so it does not compete with the app under test for the GIL.
+"""
+import json
+import time
+import uuid
+import random
+import socket
+import asyncio
+import datetime
+import threading
+import multiprocessing
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+from jwcrypto import jwk, jwt
+
+
+REALM = "bench"
+BACKEND_CLIENT_NAME = "bench-backend"
+BACKEND_CLIENT_SECRET = "bench-secret"
+FRONTEND_CLIENT_NAME = "benyon_fe"   # the app reads roles from resource_access.benyon_fe
+TOKEN_LIFETIME = 3600
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _page(items, params):
+    first = int(params.get("first", 0))
+    maximum = int(params.get("max", 100))
+    return items[first:first + maximum]
+
+
+def _named(items, params):
+    # Keycloak's policy/permission name filter is a case-insensitive substring match
+    name = (params.get("name") or "").lower()
+    return [item for item in items if name in item.get("name", "").lower()] if name else items
+
+
+def _serve(fake):
+    fake.app = fake._build_app()
+    uvicorn.run(fake.app, host="127.0.0.1", port=fake.port, log_level="warning", access_log=False, lifespan="off")
+
+
+class FakeKeycloak:
+    """
+    Fake Keycloak server, started in a child process with start().
+    State (users, resources, events, ...) is generated up front; tokens for the
+    benchmark clients are minted with mint_token() before the server is started.
+
+    Args:
+        catalog: resource name -> "file" | "dir" (e.g. the generated remote/ tree)
+        users: number of users to create (the first one is the admin)
+        login_events: LOGIN events spread over the last 24 hours
+        latency_ms: delay added to every request
+        jitter_ms: uniform random extra delay
+        grants_per_user: resources each non-admin user is permitted to access
+    """
+
+    def __init__(self, catalog: dict, users: int = 200, login_events: int = 2000, latency_ms: float = 5.0,
+                 jitter_ms: float = 0.0, grants_per_user: int = 20, seed: int = 0):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.rng = random.Random(seed)
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.backend_client_id = str(uuid.UUID(int=self.rng.getrandbits(128)))
+        self.frontend_client_id = str(uuid.UUID(int=self.rng.getrandbits(128)))
+        self.key = jwk.JWK.generate(kty="RSA", size=2048, kid="bench")
+        self._served = multiprocessing.Value("l", 0)
+        self._lock = threading.Lock()
+        self._process = None
+
+        self.roles = {name: {"id": str(uuid.uuid4()), "name": name, "clientRole": True}
+                      for name in ("admin", "user")}
+        self.users = {}             # id -> representation
+        self.user_roles = {}        # id -> [role]
+        self.sessions = {}          # id -> [session]
+        for index in range(users):
+            user_id = str(uuid.UUID(int=self.rng.getrandbits(128)))
+            username = "admin@bench.local" if index == 0 else f"user{index}@bench.local"
+            self.users[user_id] = {
+                "id": user_id, "username": username, "email": username, "enabled": True,
+                "firstName": "Bench", "lastName": f"User {index}", "attributes": {}
+            }
+            self.user_roles[user_id] = [self.roles["admin" if index == 0 else "user"]]
+            self.sessions[user_id] = [{"id": str(uuid.uuid4())}] if self.rng.random() < 0.3 else []
+
+        self.resources = {}         # id -> representation
+        for name, resource_type in list(catalog.items()) + [(".", "dir"), ("admin", "api")]:
+            self._add_resource(name, resource_type)
+
+        self.policies = {}          # id -> representation
+        self.permissions = {}       # id -> representation (+ "resources": [resource ids])
+        names = sorted(catalog)
+        resource_ids = {resource["name"]: resource_id for resource_id, resource in self.resources.items()}
+        for user_id, user in self.users.items():
+            if user["username"].startswith("admin"):
+                continue
+            granted = self.rng.sample(names, min(grants_per_user, len(names)))
+            self._add_permission(user["username"], [resource_ids[name] for name in granted])
+
+        now_ms = int(time.time() * 1000)
+        user_ids = list(self.users)
+        self.events = sorted(
+            ({"id": str(uuid.uuid4()), "time": now_ms - self.rng.randrange(86_400_000), "type": "LOGIN",
+              "userId": self.rng.choice(user_ids), "realmId": REALM, "clientId": FRONTEND_CLIENT_NAME}
+             for _ in range(login_events)),
+            key=lambda event: -event["time"]
+        )
+        self.app = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(key=self.key.export(), _lock=None, _process=None, app=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.key = jwk.JWK.from_json(state["key"])
+        self._lock = threading.Lock()
+
+    @property
+    def requests_served(self) -> int:
+        return self._served.value
+
+    # -- state helpers -------------------------------------------------------------------------
+
+    def _add_resource(self, name, resource_type):
+        resource_id = str(uuid.uuid4())
+        self.resources[resource_id] = {"_id": resource_id, "name": name, "displayName": name,
+                                       "type": resource_type, "uris": [], "scopes": [], "attributes": {},
+                                       "ownerManagedAccess": False}
+        return self.resources[resource_id]
+
+    def _resource_by_name(self, name):
+        for resource in self.resources.values():
+            if resource["name"] == name:
+                return resource
+        return None
+
+    def _add_permission(self, username, resource_ids):
+        policy_id, permission_id = str(uuid.uuid4()), str(uuid.uuid4())
+        self.policies[policy_id] = {"id": policy_id, "name": f"policy_user_{username}", "type": "user",
+                                    "users": [username], "logic": "POSITIVE"}
+        self.permissions[permission_id] = {"id": permission_id, "name": f"permission_user_{username}",
+                                           "type": "resource", "decisionStrategy": "UNANIMOUS",
+                                           "logic": "POSITIVE", "resources": list(resource_ids),
+                                           "policies": [policy_id]}
+
+    def _user_by_name(self, username):
+        for user in self.users.values():
+            if user["username"] == username:
+                return user
+        return None
+
+    def _granted_resources(self, username):
+        user = self._user_by_name(username)
+        if user and any(role["name"] == "admin" for role in self.user_roles.get(user["id"], [])):
+            return list(self.resources.values())
+        for permission in self.permissions.values():
+            if permission["name"] == f"permission_user_{username}":
+                return [self.resources[rid] for rid in permission["resources"] if rid in self.resources]
+        return []
+
+    # -- tokens --------------------------------------------------------------------------------
+
+    def _sign(self, claims):
+        token = jwt.JWT(header={"alg": "RS256", "typ": "JWT", "kid": "bench"}, claims=claims)
+        token.make_signed_token(self.key)
+        return token.serialize()
+
+    def mint_token(self, username: str) -> str:
+        """User access token as the frontend would send it; also records a LOGIN event"""
+        user = self._user_by_name(username)
+        now = int(time.time())
+        roles = [role["name"] for role in self.user_roles[user["id"]]]
+        with self._lock:
+            self.events.insert(0, {"id": str(uuid.uuid4()), "time": now * 1000, "type": "LOGIN",
+                                   "userId": user["id"], "realmId": REALM, "clientId": FRONTEND_CLIENT_NAME})
+        return self._sign({
+            "iss": f"{self.url}/realms/{REALM}", "sub": user["id"], "typ": "Bearer", "azp": FRONTEND_CLIENT_NAME,
+            "iat": now, "exp": now + TOKEN_LIFETIME, "name": f"{user['firstName']} {user['lastName']}",
+            "email": user["email"], "preferred_username": user["username"],
+            "resource_access": {FRONTEND_CLIENT_NAME: {"roles": roles}}
+        })
+
+    def _claims(self, token):
+        try:
+            return json.loads(jwt.JWT(jwt=token, key=self.key).claims)
+        except Exception:
+            return None
+
+    # -- server --------------------------------------------------------------------------------
+
+    def env(self) -> dict:
+        """Environment overriding secrets.env so the app talks to this server"""
+        return {
+            "KEYCLOAK_URL": self.url + "/",
+            "KEYCLOAK_REALM_NAME": REALM,
+            "KEYCLOAK_BACKEND_CLIENT_ID": BACKEND_CLIENT_NAME,
+            "KEYCLOAK_BACKEND_CLIENT_SECRET": BACKEND_CLIENT_SECRET,
+            "base_url": self.url,
+            "realm_name": REALM,
+            "backend_client_name": BACKEND_CLIENT_NAME,
+            "backend_client_id": self.backend_client_id,
+            "frontend_client_id": self.frontend_client_id,
+            "backend_client_secret": BACKEND_CLIENT_SECRET,
+        }
+
+    def start(self):
+        self._process = multiprocessing.Process(target=_serve, args=(self,), name="fake-keycloak", daemon=True)
+        self._process.start()
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.5).close()
+                return self
+            except OSError:
+                if time.monotonic() > deadline or not self._process.is_alive():
+                    raise RuntimeError("fake Keycloak did not start")
+                time.sleep(0.05)
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join(timeout=10)
+            self._process = None
+
+    def _build_app(self):
+        app = FastAPI(openapi_url=None)
+        realm = f"/realms/{REALM}"
+        admin = f"/admin/realms/{REALM}"
+        authz = f"{admin}/clients/{{client_id}}/authz/resource-server"
+
+        @app.middleware("http")
+        async def latency(request: Request, call_next):
+            with self._served.get_lock():
+                self._served.value += 1
+            delay = self.latency + (self.rng.random() * self.jitter if self.jitter else 0)
+            if delay:
+                await asyncio.sleep(delay)
+            return await call_next(request)
+
+        # OpenID endpoints -------------------------------------------------------------------
+
+        @app.get(f"{realm}/protocol/openid-connect/certs")
+        async def certs():
+            return {"keys": [self.key.export_public(as_dict=True)]}
+
+        @app.post(f"{realm}/protocol/openid-connect/token")
+        async def token(request: Request):
+            form = await request.form()
+            grant_type = form.get("grant_type")
+            if grant_type == "client_credentials":
+                if form.get("client_secret") != BACKEND_CLIENT_SECRET:
+                    return JSONResponse({"error": "unauthorized_client"}, status_code=401)
+                now = int(time.time())
+                return {"access_token": self._sign({"iss": f"{self.url}{realm}", "sub": "service-account",
+                                                    "iat": now, "exp": now + 300, "typ": "Bearer"}),
+                        "expires_in": 300, "token_type": "Bearer"}
+            if grant_type == "urn:ietf:params:oauth:grant-type:uma-ticket":
+                claims = self._claims(request.headers.get("Authorization", "").split(" ")[-1])
+                if not claims:
+                    return JSONResponse({"error": "invalid_grant"}, status_code=401)
+                return [{"rsid": resource["_id"], "rsname": resource["name"]}
+                        for resource in self._granted_resources(claims.get("preferred_username"))]
+            return JSONResponse({"error": "unsupported_grant_type"}, status_code=400)
+
+        @app.post(f"{realm}/protocol/openid-connect/token/introspect")
+        async def introspect(request: Request):
+            claims = self._claims((await request.form()).get("token", ""))
+            if not claims or claims.get("exp", 0) < time.time():
+                return {"active": False}
+            return {"active": True, **claims}
+
+        @app.get(f"{realm}/authz/protection/resource_set")
+        async def resource_set(request: Request):
+            name = request.query_params.get("name")
+            return [resource for resource in self.resources.values() if resource["name"] == name]
+
+        # Users ------------------------------------------------------------------------------
+
+        @app.get(f"{admin}/users")
+        async def list_users(request: Request):
+            params = request.query_params
+            users = list(self.users.values())
+            if params.get("username"):
+                if params.get("exact", "").lower() == "true":
+                    users = [user for user in users if user["username"] == params["username"]]
+                else:
+                    users = [user for user in users if params["username"] in user["username"]]
+            if params.get("search"):
+                users = [user for user in users if params["search"] in user["username"]]
+            return _page(users, params)
+
+        @app.post(f"{admin}/users")
+        async def create_user(request: Request):
+            payload = await request.json()
+            if self._user_by_name(payload.get("username")):
+                return JSONResponse({"errorMessage": "User exists with same username"}, status_code=409)
+            user_id = str(uuid.uuid4())
+            self.users[user_id] = {"id": user_id, "enabled": True, "attributes": {}, **payload}
+            self.user_roles[user_id] = []
+            self.sessions[user_id] = []
+            return Response(status_code=201, headers={"Location": f"{self.url}{admin}/users/{user_id}"})
+
+        @app.get(f"{admin}/users/{{user_id}}")
+        async def get_user(user_id: str):
+            if user_id not in self.users:
+                return JSONResponse({"error": "User not found"}, status_code=404)
+            return self.users[user_id]
+
+        @app.put(f"{admin}/users/{{user_id}}")
+        async def update_user(user_id: str, request: Request):
+            if user_id not in self.users:
+                return JSONResponse({"error": "User not found"}, status_code=404)
+            self.users[user_id].update(await request.json())
+            return Response(status_code=204)
+
+        @app.delete(f"{admin}/users/{{user_id}}")
+        async def delete_user(user_id: str):
+            if self.users.pop(user_id, None) is None:
+                return JSONResponse({"error": "User not found"}, status_code=404)
+            return Response(status_code=204)
+
+        @app.get(f"{admin}/users/{{user_id}}/sessions")
+        async def user_sessions(user_id: str):
+            return self.sessions.get(user_id, [])
+
+        @app.put(f"{admin}/users/{{user_id}}/reset-password")
+        @app.put(f"{admin}/users/{{user_id}}/execute-actions-email")
+        @app.post(f"{admin}/users/{{user_id}}/logout")
+        async def user_action(user_id: str):
+            return Response(status_code=204)
+
+        @app.get(f"{admin}/users/{{user_id}}/role-mappings/clients/{{client_id}}")
+        async def user_roles(user_id: str, client_id: str):
+            return self.user_roles.get(user_id, [])
+
+        @app.post(f"{admin}/users/{{user_id}}/role-mappings/clients/{{client_id}}")
+        async def add_user_roles(user_id: str, client_id: str, request: Request):
+            roles = self.user_roles.setdefault(user_id, [])
+            roles.extend(role for role in await request.json() if role not in roles)
+            return Response(status_code=204)
+
+        @app.delete(f"{admin}/users/{{user_id}}/role-mappings/clients/{{client_id}}")
+        async def remove_user_roles(user_id: str, client_id: str, request: Request):
+            removed = {role.get("name") for role in await request.json()}
+            self.user_roles[user_id] = [role for role in self.user_roles.get(user_id, []) if role["name"] not in removed]
+            return Response(status_code=204)
+
+        @app.get(f"{admin}/clients/{{client_id}}/roles/{{role}}")
+        async def client_role(client_id: str, role: str):
+            if role not in self.roles:
+                return JSONResponse({"error": "Could not find role"}, status_code=404)
+            return self.roles[role]
+
+        # Authorization: resources, policies, permissions ------------------------------------
+
+        @app.get(f"{authz}/resource")
+        async def list_resources(request: Request):
+            resources = list(self.resources.values())
+            if request.query_params.get("name"):
+                resources = [resource for resource in resources if request.query_params["name"] in resource["name"]]
+            return _page(resources, request.query_params)
+
+        @app.post(f"{authz}/resource")
+        async def create_resource(request: Request):
+            payload = await request.json()
+            if self._resource_by_name(payload.get("name")):
+                return JSONResponse({"error": "conflict"}, status_code=409)
+            return JSONResponse(self._add_resource(payload["name"], payload.get("type")), status_code=201)
+
+        @app.delete(f"{authz}/resource/{{resource_id}}")
+        async def delete_resource(resource_id: str):
+            if self.resources.pop(resource_id, None) is None:
+                return JSONResponse({"error": "not found"}, status_code=404)
+            return Response(status_code=204)
+
+        @app.post(f"{authz}/policy/user")
+        async def create_policy(request: Request):
+            payload = await request.json()
+            policy_id = str(uuid.uuid4())
+            self.policies[policy_id] = {"id": policy_id, "type": "user", **payload}
+            return JSONResponse(self.policies[policy_id], status_code=201)
+
+        @app.get(f"{authz}/policy/")
+        async def list_policies(request: Request):
+            policies = _named(list(self.policies.values()) + self._permission_list(), request.query_params)
+            return _page(policies, request.query_params)
+
+        @app.delete(f"{authz}/policy/{{policy_id}}")
+        async def delete_policy(policy_id: str):
+            if self.policies.pop(policy_id, None) is None:
+                return JSONResponse({"error": "not found"}, status_code=404)
+            return Response(status_code=204)
+
+        @app.get(f"{authz}/policy/{{permission_id}}/resources")
+        async def permission_resources(permission_id: str):
+            permission = self.permissions.get(permission_id)
+            if permission is None:
+                return JSONResponse({"error": "not found"}, status_code=404)
+            return [{"_id": rid, "name": self.resources[rid]["name"]}
+                    for rid in permission["resources"] if rid in self.resources]
+
+        @app.get(f"{authz}/permission/")
+        async def list_permissions(request: Request):
+            return _page(_named(self._permission_list(), request.query_params), request.query_params)
+
+        @app.post(f"{authz}/permission/resource")
+        async def create_permission(request: Request):
+            payload = await request.json()
+            permission_id = str(uuid.uuid4())
+            self.permissions[permission_id] = {"id": permission_id, "type": "resource", **payload}
+            return JSONResponse(self.permissions[permission_id], status_code=201)
+
+        @app.put(f"{authz}/permission/resource/{{permission_id}}")
+        async def update_permission(permission_id: str, request: Request):
+            if permission_id not in self.permissions:
+                return JSONResponse({"error": "not found"}, status_code=404)
+            self.permissions[permission_id].update(await request.json())
+            return Response(status_code=201)
+
+        @app.delete(f"{authz}/permission/{{permission_id}}")
+        async def delete_permission(permission_id: str):
+            if self.permissions.pop(permission_id, None) is None:
+                return JSONResponse({"error": "not found"}, status_code=404)
+            return Response(status_code=204)
+
+        # Events -----------------------------------------------------------------------------
+
+        @app.get(f"{admin}/events")
+        async def events(request: Request):
+            params = request.query_params
+            with self._lock:
+                selected = list(self.events)
+            if params.get("type"):
+                selected = [event for event in selected if event["type"] == params["type"]]
+            if params.get("user"):
+                selected = [event for event in selected if event["userId"] == params["user"]]
+            if params.get("dateFrom"):
+                day = datetime.datetime.strptime(params["dateFrom"], "%Y-%m-%d")
+                selected = [event for event in selected if event["time"] >= day.timestamp() * 1000]
+            return _page(selected, params)
+
+        return app
+
+    def _permission_list(self):
+        # resource ids are only exposed through policy/{id}/resources, like in Keycloak
+        return [{key: value for key, value in permission.items() if key != "resources"}
+                for permission in self.permissions.values()]
@@ -0,0 +1,283 @@
+"""
+Benchmark suite: runs the FastAPI app in-process against a fake Keycloak and a
+synthetic remote/ tree, and reports latency percentiles and throughput per endpoint.
+
+    python -m bench.run_bench --output bench_results.json
+    python -m bench.run_bench --requests 500 --concurrency 16 --keycloak-latency-ms 20
+    python -m bench.run_bench --scenarios pdf_page,dir_contents --compare old_results.json
+
+The app is imported from this checkout and driven through httpx's ASGI transport, so a
+run measures the code at the current commit; results record the commit for comparison.
+Nothing is written to the repository: the corpus, data/ and cache/ live in a temporary
+working directory (or --workdir).
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import datetime
+
+import httpx
+
+from bench.corpus import WORDS, generate_corpus
+from bench.fake_keycloak import FakeKeycloak
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Scenario:
+    """One endpoint under load; build(rng) returns (method, url, request kwargs, token)"""
+
+    def __init__(self, name, build):
+        self.name = name
+        self.build = build
+
+
+def build_scenarios(corpus, tokens, usernames):
+    admin, user = tokens["admin"], tokens["user"]
+    dirs, files = corpus["dirs"], [path for path in corpus["files"] if path.endswith(".txt")]
+    pdfs, sheets, slides = corpus["pdf"], corpus["xlsx"], corpus["pptx"]
+    pdf_pages = corpus["pdf_pages"]
+
+    def form(url, token, **data):
+        return "POST", url, {"data": data}, token
+
+    scenarios = [
+        # listing, search and permission filtering run as a regular user
+        Scenario("dir_contents", lambda rng: form("/files/dir_contents", user, path=rng.choice(dirs))),
+        Scenario("dir_contents_paged", lambda rng: form("/files/dir_contents", user, path=rng.choice(dirs), limit="100")),
+        Scenario("search_files", lambda rng: form("/files/search_files", user, search_str=rng.choice(WORDS))),
+        Scenario("newly_added", lambda rng: ("GET", "/files/newly_added?days=3", {}, user)),
+        # document endpoints run as admin so every path is permitted
+        Scenario("download_file", lambda rng: form("/files/download_file", admin, path=rng.choice(files))),
+        Scenario("pdf_info", lambda rng: form("/files/pdf_info", admin, path=rng.choice(pdfs))),
+        Scenario("pdf_page", lambda rng: form("/files/pdf_page", admin, path=rng.choice(pdfs),
+                                              page=str(rng.randint(1, pdf_pages)), quality="medium")),
+        Scenario("pdf_text_layer", lambda rng: form("/files/pdf_text_layer", admin, path=rng.choice(pdfs),
+                                                    page=str(rng.randint(1, pdf_pages)))),
+        Scenario("pdf_search", lambda rng: form("/files/pdf_search", admin, path=rng.choice(pdfs),
+                                                search_text=rng.choice(WORDS))),
+        Scenario("xlsx_sheet", lambda rng: form("/files/xlsx_sheet", admin, path=rng.choice(sheets),
+                                                sheet_name=f"Sheet{rng.randint(1, 3)}")),
+        Scenario("pptx_slide", lambda rng: form("/files/pptx_slide", admin, path=rng.choice(slides),
+                                                slide=str(rng.randint(1, corpus["pptx_slides"])))),
+        # Keycloak-backed admin endpoints
+        Scenario("users_status", lambda rng: ("GET", "/keycloak/users_status", {}, admin)),
+        Scenario("login_events", lambda rng: ("POST", "/keycloak/login_events", {"json": {}}, admin)),
+        Scenario("get_user_permissions", lambda rng: ("POST", "/keycloak/get_user_permissions",
+                                                      {"json": {"username": rng.choice(usernames)}}, admin)),
+    ]
+    return scenarios
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, min(len(sorted_values), round(fraction * len(sorted_values) + 0.5)))
+    return sorted_values[rank - 1]
+
+
+async def run_scenario(client, scenario, requests, concurrency, warmup, seed):
+    rng = random.Random(seed)
+    prepared = [scenario.build(rng) for _ in range(warmup + requests)]
+    latencies, statuses, response_bytes = [], {}, 0
+
+    async def send(method, url, kwargs, token):
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        return await client.request(method, url, headers=headers, **kwargs)
+
+    for request in prepared[:warmup]:
+        await send(*request)
+
+    queue = asyncio.Queue()
+    for request in prepared[warmup:]:
+        queue.put_nowait(request)
+
+    async def worker():
+        nonlocal response_bytes
+        while not queue.empty():
+            request = queue.get_nowait()
+            started = time.perf_counter()
+            try:
+                response = await send(*request)
+                status = str(response.status_code)
+                response_bytes += len(response.content)
+            except Exception as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall_time = time.perf_counter() - started
+
+    latencies.sort()
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    errors = sum(count for status, count in statuses.items() if not status.startswith(("2", "3")))
+    return {
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "p50_ms": ms(percentile(latencies, 0.50)),
+        "p95_ms": ms(percentile(latencies, 0.95)),
+        "p99_ms": ms(percentile(latencies, 0.99)),
+        "mean_ms": ms(sum(latencies) / len(latencies)) if latencies else None,
+        "max_ms": ms(latencies[-1]) if latencies else None,
+        "throughput_rps": round(len(latencies) / wall_time, 2) if wall_time else None,
+        "mean_response_bytes": round(response_bytes / len(latencies)) if latencies else 0,
+        "errors": errors,
+        "status_counts": statuses
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def import_app():
+    """
+    Import main.app with the fake Keycloak's settings. decouple lets environment
+    variables override secrets.env, but the file has to exist, so while main is
+    imported a missing secrets.env is read from an empty temporary file instead.
+    """
+    import decouple
+
+    fd, empty_env = tempfile.mkstemp(prefix="bench-", suffix=".env")
+    os.close(fd)
+    repository_env = decouple.RepositoryEnv
+
+    class BenchRepositoryEnv(repository_env):
+        def __init__(self, source, *args, **kwargs):
+            super().__init__(source if os.path.exists(source) else empty_env, *args, **kwargs)
+
+    decouple.RepositoryEnv = BenchRepositoryEnv  # the app's modules bind it on import
+    try:
+        sys.path.insert(0, REPO_ROOT)
+        import main
+    finally:
+        decouple.RepositoryEnv = repository_env
+        os.remove(empty_env)
+    return main.app
+
+
+def compare(results, baseline_file):
+    with open(baseline_file, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\ncompared with {baseline_file} (commit {baseline['meta'].get('commit')})")
+    for name, current in results["scenarios"].items():
+        previous = baseline["scenarios"].get(name)
+        if not previous:
+            continue
+        deltas = []
+        for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps"):
+            if previous.get(key) and current.get(key) is not None:
+                deltas.append(f"{key} {(current[key] - previous[key]) / previous[key] * 100:+.1f}%")
+        print(f"  {name:24} " + "  ".join(deltas))
+
+
+async def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench-")
+    for directory in ("data", "cache", "preview"):
+        os.makedirs(os.path.join(workdir, directory), exist_ok=True)
+
+    print(f"generating corpus in {workdir}")
+    corpus = generate_corpus(os.path.join(workdir, "remote"), depth=args.depth, fanout=args.fanout,
+                             files_per_dir=args.files_per_dir, pdfs=args.pdfs, pdf_pages=args.pdf_pages,
+                             xlsx=args.xlsx, pptx_files=args.pptx, pptx_slides=args.pptx_slides, seed=args.seed)
+    corpus["pdf_pages"], corpus["pptx_slides"] = args.pdf_pages, args.pptx_slides
+
+    keycloak = FakeKeycloak(corpus["catalog"], users=args.users, login_events=args.login_events,
+                            latency_ms=args.keycloak_latency_ms, jitter_ms=args.keycloak_jitter_ms, seed=args.seed)
+    usernames = [user["username"] for user in keycloak.users.values()]
+    tokens = {"admin": keycloak.mint_token(usernames[0]), "user": keycloak.mint_token(usernames[1])}
+    keycloak.start()
+    os.environ.update(keycloak.env())
+    try:
+        app = import_app()
+        # main.py switches to the repository directory on import; the app resolves remote/, data/ and cache/ per call
+        os.chdir(workdir)
+
+        scenarios = build_scenarios(corpus, tokens, usernames)
+        if args.scenarios:
+            selected = set(args.scenarios.split(","))
+            scenarios = [scenario for scenario in scenarios if scenario.name in selected]
+
+        results = {
+            "meta": {
+                "commit": git_commit(),
+                "timestamp": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+                "corpus": {key: len(corpus[key]) for key in ("dirs", "files", "pdf", "xlsx", "pptx")}
+            },
+            "scenarios": {}
+        }
+
+        transport = httpx.ASGITransport(app=app, client=("127.0.0.1", 50000))
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120.0) as client:
+                for index, scenario in enumerate(scenarios):
+                    keycloak_before = keycloak.requests_served
+                    result = await run_scenario(client, scenario, args.requests, args.concurrency,
+                                                args.warmup, args.seed + index)
+                    result["keycloak_requests_per_request"] = round(
+                        (keycloak.requests_served - keycloak_before) / max(1, args.requests + args.warmup), 2)
+                    results["scenarios"][scenario.name] = result
+                    print(f"  {scenario.name:24} p50 {result['p50_ms']:>9} ms  p95 {result['p95_ms']:>9} ms  "
+                          f"p99 {result['p99_ms']:>9} ms  {result['throughput_rps']:>8} req/s  "
+                          f"errors {result['errors']}")
+    finally:
+        keycloak.stop()
+        os.chdir(REPO_ROOT)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default=os.path.abspath("bench_results.json"))
+    parser.add_argument("--compare", help="earlier results file to print deltas against")
+    parser.add_argument("--scenarios", help="comma separated scenario names (default: all)")
+    parser.add_argument("--workdir", help="directory for the generated corpus (default: a new temp dir)")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keycloak-latency-ms", type=float, default=5.0)
+    parser.add_argument("--keycloak-jitter-ms", type=float, default=0.0)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--login-events", type=int, default=2000)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--files-per-dir", type=int, default=20)
+    parser.add_argument("--pdfs", type=int, default=10)
+    parser.add_argument("--pdf-pages", type=int, default=20)
+    parser.add_argument("--xlsx", type=int, default=5)
+    parser.add_argument("--pptx", type=int, default=5)
+    parser.add_argument("--pptx-slides", type=int, default=10)
+    args = parser.parse_args()
+    args.output = os.path.abspath(args.output)
+    if args.compare:
+        args.compare = os.path.abspath(args.compare)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+from functools import wraps
+from fastapi import Request
+
+from routers.utils.misc_admission_utils import admission_controller, request_priority
+
+
+def admission(cost_class: str):
+    """
+    Run the endpoint under the admission control of its cost class (see ADMISSION_CLASSES).
+    Goes below @jwt_token, so only authenticated requests take a queue position, and a
+    429 raised here is not swallowed by the endpoint's own error handling.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        async def decorated(request: Request, *args, **kwargs):
+            priority = request_priority(request.headers)
+            return await admission_controller.run(cost_class, priority, lambda: fn(request, *args, **kwargs))
+
+        return decorated
+    return decorator
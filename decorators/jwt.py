@@ -11,6 +11,14 @@ from jwcrypto.jwt import JWTExpired
 from jwcrypto.jws import InvalidJWSObject, InvalidJWSSignature
 from datetime import datetime
 
+from routers.utils.misc_metrics_utils import auth_verification_duration_seconds
+from routers.utils.misc_tracing_utils import span
+from routers.utils.misc_logging_utils import get_logger
+
+
+logger = get_logger(__name__)
+
+
 secrets = Config(RepositoryEnv("secrets.env"))
 
 KEYCLOAK_URL = secrets("KEYCLOAK_URL")
@@ -26,14 +34,17 @@ async def keycloak_verif(token:str):
                                     client_secret_key=KEYCLOAK_BACKEND_CLIENT_SECRET
                                     )
 
-    dec_tok = await keycloak_openid.a_decode_token(token, validate=True)
-    intr_tok = await keycloak_openid.a_introspect(token)
+    with span("auth.decode"):
+        dec_tok = await keycloak_openid.a_decode_token(token, validate=True)
+    with span("auth.introspect"):
+        intr_tok = await keycloak_openid.a_introspect(token)
     if intr_tok.get("active"): 
         if time.time()>intr_tok.get('exp'): raise Exception("auth token expired")
     else:
         raise Exception("inactive auth token")
     
-    auth_status = keycloak_openid.uma_permissions(token)
+    with span("auth.uma"):
+        auth_status = keycloak_openid.uma_permissions(token)
     permissions = [permissions_dict[i] for permissions_dict in auth_status for i in permissions_dict if i=="rsname"]
     
     return intr_tok, permissions
@@ -55,7 +66,14 @@ def jwt_token(required_role: str):
                 raise HTTPException(status_code = 401, detail = "An error occurred: missing authorization token")
         
             try:
-                intr_tok, permissions = await keycloak_verif(token_from_request)                
+                verif_started = time.perf_counter()
+                try:
+                    with span("auth.verify"):
+                        intr_tok, permissions = await keycloak_verif(token_from_request)
+                except Exception:
+                    auth_verification_duration_seconds.observe(time.perf_counter() - verif_started, outcome="rejected")
+                    raise
+                auth_verification_duration_seconds.observe(time.perf_counter() - verif_started, outcome="verified")
                 # if required_permission:
                 #     if (required_permission not in permissions) and ("api_all_endpoints" not in permissions):
                 #         print("required permission:", required_permission)
@@ -74,8 +92,8 @@ def jwt_token(required_role: str):
                 request.state.email = user_email
 
             except Exception as e:
-                tb_str = traceback.format_exc()
-                print(f"\n{datetime.now()} jwt_token. error: {tb_str}\n")
+                # expected failures (expired / invalid tokens) are common: no traceback, and rate limited
+                logger.warning("jwt_token rejected request: %s: %s", type(e).__name__, e)
                 if isinstance(e, (InvalidJWSObject, InvalidJWSSignature)):
                     raise HTTPException(status_code = 401, detail = "error: invalid auth token")
                 elif isinstance(e, (JWTExpired)):
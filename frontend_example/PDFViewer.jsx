@@ -85,6 +85,7 @@ const PDFViewer = ({ filePath, apiBaseUrl = 'http://127.0.0.1:5000' }) => {
       formData.append('page', pageNum.toString());
       formData.append('quality', pdfState.quality);
       formData.append('scale', pdfState.zoomLevel.toString());
+      formData.append('format', 'auto');
 
       const response = await fetch(`${apiBaseUrl}/files/pdf_page`, {
         method: 'POST',
@@ -121,6 +122,7 @@ const PDFViewer = ({ filePath, apiBaseUrl = 'http://127.0.0.1:5000' }) => {
       formData.append('end_page', endPage.toString());
       formData.append('quality', pdfState.quality);
       formData.append('scale', pdfState.zoomLevel.toString());
+      formData.append('format', 'auto');
 
       const response = await fetch(`${apiBaseUrl}/files/pdf_pages_range`, {
         method: 'POST',
@@ -369,7 +371,7 @@ const PDFViewer = ({ filePath, apiBaseUrl = 'http://127.0.0.1:5000' }) => {
               {pageData ? (
                 <div className="pdf-page">
                   <img
-                    src={`data:image/png;base64,${pageData.image_data}`}
+                    src={`data:${pageData.mime_type || 'image/png'};base64,${pageData.image_data}`}
                     alt={`Page ${pageNum}`}
                     style={{
                       width: `${pageData.width * pdfState.zoomLevel}px`,
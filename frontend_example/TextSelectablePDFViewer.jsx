@@ -115,6 +115,7 @@ const TextSelectablePDFViewer = ({
     formData.append('page', pageNum.toString());
     formData.append('quality', pdfState.quality);
     formData.append('scale', pdfState.zoomLevel.toString());
+    formData.append('format', 'auto');
 
     const response = await fetch(`${apiBaseUrl}/files/pdf_page`, {
       method: 'POST',
@@ -134,7 +135,7 @@ const TextSelectablePDFViewer = ({
       container.innerHTML = `
         <div class="pdf-page-container">
           <img 
-            src="data:image/png;base64,${pageData.image_data}" 
+            src="data:${pageData.mime_type || 'image/png'};base64,${pageData.image_data}" 
             alt="Page ${pageNum}"
             class="pdf-page-background"
           />
@@ -151,6 +152,7 @@ const TextSelectablePDFViewer = ({
     formData.append('page', pageNum.toString());
     formData.append('quality', pdfState.quality);
     formData.append('scale', pdfState.zoomLevel.toString());
+    formData.append('format', 'auto');
 
     const response = await fetch(`${apiBaseUrl}/files/pdf_page_with_text`, {
       method: 'POST',
@@ -172,7 +174,7 @@ const TextSelectablePDFViewer = ({
 
       // Background image
       const img = document.createElement('img');
-      img.src = `data:image/png;base64,${pageData.image_data}`;
+      img.src = `data:${pageData.mime_type || 'image/png'};base64,${pageData.image_data}`;
       img.alt = `Page ${pageNum}`;
       img.className = 'pdf-page-background';
 
@@ -217,8 +219,12 @@ const TextSelectablePDFViewer = ({
     }
 
     try {
-      const pdfUrl = `${apiBaseUrl}/files/pdf_raw?path=${encodeURIComponent(filePath)}`;
-      const pdf = await pdfJsLib.getDocument(pdfUrl).promise;
+      // web_version selects the linearized copy, when the server has one
+      const webVersion = pdfState.info && pdfState.info.web_version;
+      const pdfUrl = `${apiBaseUrl}/files/pdf_raw?path=${encodeURIComponent(filePath)}` +
+        (webVersion ? `&version=${encodeURIComponent(webVersion)}` : '');
+      // disableAutoFetch: only fetch the byte ranges needed for the visible page
+      const pdf = await pdfJsLib.getDocument({ url: pdfUrl, disableAutoFetch: true }).promise;
       const page = await pdf.getPage(pageNum);
       
       const scale = pdfState.zoomLevel * 1.5;
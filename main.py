@@ -8,13 +8,32 @@ os.chdir(os.path.dirname(os.path.abspath(__file__)))
 # import sys
 # import ctypes
 # from ctypes import wintypes
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from routers.files import files_router
 from routers.keycloak import keycloak_router
+from routers.utils.misc_activity_utils import activity_pipeline
+from routers.utils.misc_reconcile_utils import resource_reconciler
+from routers.utils.misc_metrics_utils import MetricsMiddleware, render_metrics, metrics_authorized
+from routers.utils.misc_tracing_utils import TracingMiddleware
+from routers.utils.misc_render_utils import stop_rendering
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # background workers
+    await activity_pipeline.start()
+    await resource_reconciler.start()
+    yield
+    await resource_reconciler.stop()
+    await activity_pipeline.stop()
+    await stop_rendering()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -23,6 +42,9 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# outermost, so the timings include CORS handling
+app.add_middleware(TracingMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(files_router, prefix="/files", tags=["files"])
 app.include_router(keycloak_router, prefix="/keycloak", tags=["keycloak"])
@@ -32,6 +54,14 @@ def get_items():
     return "root_endpoint"
 
 
+@app.get("/metrics", include_in_schema=False)
+def get_metrics(request: Request):
+    # Prometheus scrape endpoint, only served with the METRICS_TOKEN bearer token
+    if not metrics_authorized(request.headers):
+        raise HTTPException(status_code=404, detail="Not Found")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("main:app", host="127.0.0.1", port=5000, reload=True)
@@ -1,7 +1,7 @@
 from fastapi import FastAPI, HTTPException, Form, UploadFile, File, Request, APIRouter
 from typing import List
 import os
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
 import base64
 from io import BytesIO
 import traceback
@@ -13,6 +13,9 @@ from datetime import datetime
 import csv
 
 from decorators.jwt import jwt_token
+from decorators.admission import admission
+from routers.utils.misc_admission_utils import request_priority, PRIORITY_VISIBLE
+from routers.utils.misc_render_utils import request_encoding
 from routers.utils.api_files_utils import *
 from routers.utils.misc_keycloak_utils import *
 
@@ -24,7 +27,11 @@ from routers.utils.api_files_utils import (
     search_pdf_text,
     get_pdf_page_with_text,
     get_pdf_text_layer,
-    get_raw_pdf
+    get_raw_pdf,
+    schedule_page_prefetch,
+    stream_pdf_pages,
+    get_pdf_tile_info,
+    get_pdf_tile
 )
 
 # Import the new DOCX, XLSX, PPTX functions explicitly
@@ -40,18 +47,32 @@ from routers.utils.api_files_utils import (
 # Import the new functions for newly added files
 from routers.utils.api_files_utils import get_newly_added_files, get_newly_added_files_since_timestamp
 
+# Import the access history functions explicitly
+from routers.utils.api_files_utils import get_recent_files, get_file_stats, get_trending_files
+from routers.utils.misc_logging_utils import get_logger
+
+
+logger = get_logger(__name__)
+
+
 files_router = APIRouter()
 
 
 @files_router.post("/search_files")
+@jwt_token("")
+@admission("scan")
 async def api_search_files(request: Request):
     try:
         data = await request.form()
         search_str = data.get("search_str")
-        results = await search_files(search_str)
+        if not search_str:
+            raise HTTPException(status_code=400, detail="search_str field is required")
+        results = await search_files(search_str, request.state.permissions, request.state.roles)
 
         return {"detail": results}
     
+    except HTTPException as he:
+        raise he
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
@@ -65,7 +86,7 @@ async def api_download_file(request: Request):
         username = request.state.email
         user_id = request.state.user_id
         
-        file_response = await download_file(path, user_id, username)
+        file_response = await download_file(path, user_id, username, request.headers)
         
         return file_response
     except Exception as e:
@@ -111,25 +132,51 @@ async def api_upload_files(request: Request):
 
 @files_router.post("/dir_contents")
 @jwt_token("")
+@admission("metadata")
 async def api_dir_contents(request: Request):
+    """
+    List a directory. num_files / num_subdirs of subdirectories cost a scandir each (cached
+    per directory mtime); send counts=false to skip them (they are then null). A page only
+    computes them for the returned entries.
+    """
+    path = None
     try:
         # print(request.state.permissions)
         data = await request.form()
         path = data.get("path")
-        results = await dir_contents(path, request.state.permissions, request.state.roles)
+        counts = (data.get("counts") or "true").strip().lower() not in ("0", "false", "no")
+        
+        # Server-side pagination is opt-in: send limit and/or cursor to get a single page
+        page_options = None
+        if data.get("limit") or data.get("cursor"):
+            try:
+                limit = int(data.get("limit") or 100)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="limit must be an integer")
+            page_options = {
+                "limit": limit,
+                "cursor": data.get("cursor") or None,
+                "sort": data.get("sort", "name"),
+                "order": data.get("order", "asc"),
+                "entry_type": data.get("type", "all"),
+                "prefix": data.get("prefix") or None,
+                "counts": counts
+            }
+        results = await dir_contents(path, request.state.permissions, request.state.roles, page_options,
+                                     counts=counts)
 
         return {"detail": results}
     
     except HTTPException as he:
         raise he
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error retrieving dir contents of {path}: {tb_str}")
+        logger.error("Error retrieving dir contents of %s", path, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @files_router.post("/file_preview")
 @jwt_token("")
+@admission("render")
 async def api_file_preview(request: Request):
     try:
         data = await request.form()
@@ -137,8 +184,7 @@ async def api_file_preview(request: Request):
         preview_img = await file_preview(path)
         return JSONResponse(content={"detail": preview_img})
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error processing file {path}: {tb_str}")
+        logger.error("Error processing file %s", path, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -190,16 +236,16 @@ async def api_upload_multiple_folders(request: Request):
         return JSONResponse(content={"detail": result})
     
     except HTTPException as he:
-        print(f"Error in upload_multiple endpoint: {he}")
+        logger.warning("upload_multiple rejected: %s", he.detail)
         raise he
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error in upload_multiple endpoint: {tb_str}")
+        logger.error("Error in upload_multiple endpoint", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @files_router.post("/pdf_info")
 @jwt_token("")
+@admission("metadata")
 async def api_pdf_info(request: Request):
     """Get PDF metadata like page count, dimensions, etc."""
     try:
@@ -208,13 +254,13 @@ async def api_pdf_info(request: Request):
         pdf_info = await get_pdf_info(path)
         return JSONResponse(content={"detail": pdf_info})
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error getting PDF info for {path}: {tb_str}")
+        logger.error("Error getting PDF info for %s", path, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @files_router.post("/pdf_page")
 @jwt_token("")
+@admission("render")
 async def api_pdf_page(request: Request):
     """Get a specific page from PDF as base64 image"""
     try:
@@ -223,17 +269,23 @@ async def api_pdf_page(request: Request):
         page_num = int(data.get("page", 1))
         quality = data.get("quality", "medium")  # low, medium, high
         scale = float(data.get("scale", 1.0))
+        encoding = request_encoding(data, request.headers)  # format=png|webp|jpeg|avif|auto, image_quality
         
-        page_data = await get_pdf_page(path, page_num, quality, scale)
+        page_data = await get_pdf_page(path, page_num, quality, scale, encoding)
+        # pre-render the neighbouring pages while this one is on screen
+        if request_priority(request.headers) == PRIORITY_VISIBLE:
+            schedule_page_prefetch(request.state.user_id, path, page_num, quality, scale, encoding)
         return JSONResponse(content={"detail": page_data})
+    except HTTPException as he:
+        raise he
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error getting PDF page {page_num} for {path}: {tb_str}")
+        logger.error("Error getting PDF page %s for %s", page_num, path, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @files_router.post("/pdf_pages_range")
 @jwt_token("")
+@admission("render")
 async def api_pdf_pages_range(request: Request):
     """Get multiple PDF pages in a range"""
     try:
@@ -243,17 +295,91 @@ async def api_pdf_pages_range(request: Request):
         end_page = int(data.get("end_page", start_page))
         quality = data.get("quality", "medium")
         scale = float(data.get("scale", 1.0))
+        encoding = request_encoding(data, request.headers)
         
-        pages_data = await get_pdf_pages_range(path, start_page, end_page, quality, scale)
+        pages_data = await get_pdf_pages_range(path, start_page, end_page, quality, scale, encoding)
         return JSONResponse(content={"detail": pages_data})
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error("Error getting PDF pages %s-%s for %s", start_page, end_page, path, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@files_router.post("/pdf_pages_stream")
+@jwt_token("")
+@admission("metadata")  # pages are admitted one by one to "render" while the response streams
+async def api_pdf_pages_stream(request: Request):
+    """Stream a range of PDF pages as NDJSON, one line per page as soon as it is rendered"""
+    try:
+        data = await request.form()
+        path = data.get("path")
+        start_page = int(data.get("start_page", 1))
+        end_page = int(data.get("end_page", start_page))
+        quality = data.get("quality", "medium")
+        scale = float(data.get("scale", 1.0))
+        encoding = request_encoding(data, request.headers)
+        
+        lines = await stream_pdf_pages(path, start_page, end_page, quality, scale, encoding,
+                                       request_priority(request.headers))
+        return StreamingResponse(lines, media_type="application/x-ndjson",
+                                 headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"})
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error("Error streaming PDF pages %s-%s for %s", start_page, end_page, path, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@files_router.post("/pdf_tile_info")
+@jwt_token("")
+@admission("metadata")
+async def api_pdf_tile_info(request: Request):
+    """Get the zoom levels and tile grid of a PDF page for tiled (deep-zoom) viewing"""
+    try:
+        data = await request.form()
+        path = data.get("path")
+        page_num = int(data.get("page", 1))
+        tile_size = int(data.get("tile_size", 256))
+        
+        tile_info = await get_pdf_tile_info(path, page_num, tile_size)
+        return JSONResponse(content={"detail": tile_info})
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error("Error getting PDF tile info %s for %s", page_num, path, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@files_router.get("/pdf_tile")
+@jwt_token("")
+@admission("render")
+async def api_pdf_tile(request: Request):
+    """Get one tile of a PDF page as an image: ?path=&page=&z=&x=&y=[&tile_size=256][&format=][&image_quality=]"""
+    try:
+        params = request.query_params
+        path = params.get("path")
+        if not path:
+            raise HTTPException(status_code=400, detail="Path parameter is required")
+        page_num = int(params.get("page", 1))
+        zoom, x, y = int(params.get("z", 0)), int(params.get("x", 0)), int(params.get("y", 0))
+        tile_size = int(params.get("tile_size", 256))
+        # image requests from the browser advertise webp/avif in Accept, so tiles negotiate by default
+        encoding = request_encoding(params, request.headers)
+        
+        tile, media_type = await get_pdf_tile(path, page_num, zoom, x, y, tile_size, encoding)
+        return Response(content=tile, media_type=media_type,
+                        headers={"Cache-Control": "private, max-age=3600", "Vary": "Accept"})
+    except HTTPException as he:
+        raise he
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error getting PDF pages {start_page}-{end_page} for {path}: {tb_str}")
+        logger.error("Error getting PDF tile for %s", path, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @files_router.post("/pdf_search")
 @jwt_token("")
+@admission("scan")
 async def api_pdf_search(request: Request):
     """Search for text within PDF and return page numbers and positions"""
     try:
@@ -264,13 +390,13 @@ async def api_pdf_search(request: Request):
         search_results = await search_pdf_text(path, search_text)
         return JSONResponse(content={"detail": search_results})
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error searching PDF {path}: {tb_str}")
+        logger.error("Error searching PDF %s", path, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @files_router.post("/pdf_page_with_text")
 @jwt_token("")
+@admission("render")
 async def api_pdf_page_with_text(request: Request):
     """Get a PDF page with both image and text layer for text selection"""
     try:
@@ -279,17 +405,23 @@ async def api_pdf_page_with_text(request: Request):
         page_num = int(data.get("page", 1))
         quality = data.get("quality", "medium")
         scale = float(data.get("scale", 1.0))
+        encoding = request_encoding(data, request.headers)
+        text_format = data.get("text_format", "full")  # full | compact
         
-        page_data = await get_pdf_page_with_text(path, page_num, quality, scale)
+        page_data = await get_pdf_page_with_text(path, page_num, quality, scale, encoding, text_format)
+        if request_priority(request.headers) == PRIORITY_VISIBLE:
+            schedule_page_prefetch(request.state.user_id, path, page_num, quality, scale, encoding)
         return JSONResponse(content={"detail": page_data})
+    except HTTPException as he:
+        raise he
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error getting PDF page with text {page_num} for {path}: {tb_str}")
+        logger.error("Error getting PDF page with text %s for %s", page_num, path, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @files_router.post("/pdf_text_layer")
 @jwt_token("")
+@admission("render")
 async def api_pdf_text_layer(request: Request):
     """Get just the text layer data for a PDF page"""
     try:
@@ -297,12 +429,14 @@ async def api_pdf_text_layer(request: Request):
         path = data.get("path")
         page_num = int(data.get("page", 1))
         scale = float(data.get("scale", 1.0))
+        text_format = data.get("text_format", "full")  # full | compact
         
-        text_data = await get_pdf_text_layer(path, page_num, scale)
+        text_data = await get_pdf_text_layer(path, page_num, scale, text_format)
         return JSONResponse(content={"detail": text_data})
+    except HTTPException as he:
+        raise he
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error getting PDF text layer {page_num} for {path}: {tb_str}")
+        logger.error("Error getting PDF text layer %s for %s", page_num, path, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -315,16 +449,18 @@ async def api_pdf_raw(request: Request):
         if not path:
             raise HTTPException(status_code=400, detail="Path parameter is required")
             
-        raw_pdf = await get_raw_pdf(path)
+        raw_pdf = await get_raw_pdf(path, request.headers, request.query_params.get("version"))
         return raw_pdf
+    except HTTPException as he:
+        raise he
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error serving raw PDF {path}: {tb_str}")
+        logger.error("Error serving raw PDF %s", path, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @files_router.post("/docx_info")
 @jwt_token("")
+@admission("metadata")
 async def api_docx_info(request: Request):
     """Get Word document metadata and page count (approximate)"""
     try:
@@ -333,13 +469,13 @@ async def api_docx_info(request: Request):
         info = await get_docx_info(path)
         return JSONResponse(content={"detail": info})
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error getting DOCX info for {path}: {tb_str}")
+        logger.error("Error getting DOCX info for %s", path, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @files_router.post("/docx_page")
 @jwt_token("")
+@admission("convert")
 async def api_docx_page(request: Request):
     """Get a specific page (section) from a Word document as HTML"""
     try:
@@ -349,13 +485,13 @@ async def api_docx_page(request: Request):
         page_data = await get_docx_page(path, page_num)
         return JSONResponse(content={"detail": page_data})
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error getting DOCX page {page_num} for {path}: {tb_str}")
+        logger.error("Error getting DOCX page %s for %s", page_num, path, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @files_router.post("/xlsx_info")
 @jwt_token("")
+@admission("metadata")
 async def api_xlsx_info(request: Request):
     """Get Excel file metadata and sheet names"""
     try:
@@ -364,13 +500,13 @@ async def api_xlsx_info(request: Request):
         info = await get_xlsx_info(path)
         return JSONResponse(content={"detail": info})
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error getting XLSX info for {path}: {tb_str}")
+        logger.error("Error getting XLSX info for %s", path, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @files_router.post("/xlsx_sheet")
 @jwt_token("")
+@admission("convert")
 async def api_xlsx_sheet(request: Request):
     """Get a specific sheet from Excel as HTML table"""
     try:
@@ -380,13 +516,13 @@ async def api_xlsx_sheet(request: Request):
         sheet_data = await get_xlsx_sheet(path, sheet_name)
         return JSONResponse(content={"detail": sheet_data})
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error getting XLSX sheet {sheet_name} for {path}: {tb_str}")
+        logger.error("Error getting XLSX sheet %s for %s", sheet_name, path, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @files_router.post("/pptx_info")
 @jwt_token("")
+@admission("metadata")
 async def api_pptx_info(request: Request):
     """Get PowerPoint file metadata and slide count"""
     try:
@@ -395,13 +531,13 @@ async def api_pptx_info(request: Request):
         info = await get_pptx_info(path)
         return JSONResponse(content={"detail": info})
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error getting PPTX info for {path}: {tb_str}")
+        logger.error("Error getting PPTX info for %s", path, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @files_router.post("/pptx_slide")
 @jwt_token("")
+@admission("convert")
 async def api_pptx_slide(request: Request):
     """Get a specific slide from PowerPoint as HTML or image"""
     try:
@@ -411,13 +547,13 @@ async def api_pptx_slide(request: Request):
         slide_data = await get_pptx_slide(path, slide_num)
         return JSONResponse(content={"detail": slide_data})
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error getting PPTX slide {slide_num} for {path}: {tb_str}")
+        logger.error("Error getting PPTX slide %s for %s", slide_num, path, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @files_router.post("/newly_added_files")
 @jwt_token("")
+@admission("scan")
 async def api_newly_added_files(request: Request):
     """Get a list of newly added files since a given timestamp"""
     try:
@@ -430,16 +566,18 @@ async def api_newly_added_files(request: Request):
         # Convert timestamp to datetime object
         timestamp_dt = datetime.fromisoformat(timestamp)
         
-        newly_added = await get_newly_added_files_since_timestamp(timestamp_dt)
+        newly_added = await get_newly_added_files_since_timestamp(
+            timestamp_dt, request.state.permissions, request.state.roles
+        )
         return JSONResponse(content={"detail": newly_added})
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error getting newly added files: {tb_str}")
+        logger.error("Error getting newly added files", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @files_router.get("/newly_added")
 @jwt_token("")
+@admission("scan")
 async def api_newly_added_files(request: Request):
     """Get files that have been modified within the last 3 days"""
     try:
@@ -452,9 +590,77 @@ async def api_newly_added_files(request: Request):
         except ValueError:
             days = 3  # Default to 3 if not a valid integer
         
-        newly_added = await get_newly_added_files(days)
+        newly_added = await get_newly_added_files(days, request.state.permissions, request.state.roles)
         return JSONResponse(content={"detail": newly_added})
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error getting newly added files: {tb_str}")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        logger.error("Error getting newly added files", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@files_router.get("/recent_files")
+@jwt_token("")
+@admission("metadata")
+async def api_recent_files(request: Request):
+    """Get the files most recently downloaded by the calling user"""
+    try:
+        try:
+            limit = max(1, min(int(request.query_params.get("limit", "10")), 100))
+        except ValueError:
+            limit = 10
+        
+        recent_files = await get_recent_files(request.state.user_id, limit)
+        return JSONResponse(content={"detail": recent_files})
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error("Error getting recent files", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@files_router.post("/file_stats")
+@jwt_token("")
+@admission("metadata")
+async def api_file_stats(request: Request):
+    """Get download statistics for a file"""
+    path = None
+    try:
+        data = await request.form()
+        path = data.get("path")
+        if not path:
+            raise HTTPException(status_code=400, detail="path field is required")
+        
+        try:
+            days = max(0, int(data.get("days", "30")))
+        except ValueError:
+            days = 30
+        stats = await get_file_stats(path, request.state.permissions, request.state.roles, days)
+        return JSONResponse(content={"detail": stats})
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error("Error getting file stats for %s", path, exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@files_router.get("/trending_files")
+@jwt_token("")
+@admission("metadata")
+async def api_trending_files(request: Request):
+    """Get the most downloaded files of the last N days (days=0 for all time)"""
+    try:
+        try:
+            days = max(0, int(request.query_params.get("days", "7")))
+        except ValueError:
+            days = 7
+        try:
+            limit = max(1, min(int(request.query_params.get("limit", "20")), 100))
+        except ValueError:
+            limit = 20
+        
+        trending = await get_trending_files(request.state.permissions, request.state.roles, days, limit)
+        return JSONResponse(content={"detail": trending})
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error("Error getting trending files", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
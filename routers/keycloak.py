@@ -11,9 +11,17 @@ import shutil
 from pathlib import Path
 import datetime
 import httpx
+import json
+import asyncio
 
 from decorators.jwt import jwt_token
 from routers.utils.api_keycloak_utils import *
+from routers.utils.misc_reconcile_utils import reconcile_resources
+from routers.utils.misc_logging_utils import get_logger
+
+
+logger = get_logger(__name__)
+
 
 keycloak_router = APIRouter()
 
@@ -28,8 +36,7 @@ async def api_delete_permission(request: Request):
         return response
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"delete_permission. error: {tb_str}")
+        logger.error("delete_permission failed", exc_info=True)
         
         if isinstance (e, HTTPException):
             raise e
@@ -48,8 +55,7 @@ async def api_unassign_permission(request: Request):
         return response
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"unassign_permission. error: {tb_str}")
+        logger.error("unassign_permission failed", exc_info=True)
         
         if isinstance (e, HTTPException):
             raise e
@@ -72,8 +78,7 @@ async def api_assign_permission(request: Request):
             raise HTTPException(status_code=response.status_code, detail=response.text)
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"assign_permission. error: {tb_str}")
+        logger.error("assign_permission failed", exc_info=True)
         
         if isinstance (e, HTTPException):
             raise e
@@ -81,6 +86,47 @@ async def api_assign_permission(request: Request):
             raise HTTPException(status_code=500, detail=str(e))
 
 
+@keycloak_router.post("/batch_permissions")
+@jwt_token("admin")
+async def api_batch_permissions(request: Request):
+    """
+    API endpoint to grant / revoke resources for many users in one request.
+    
+    Expected JSON payload:
+    {
+        "changes": [
+            {
+                "username": "user@example.com",                             # Required
+                "add": ["docs", {"name": "reports/2024", "type": "dir"}],   # Optional - names, or name/type objects to create missing resources
+                "remove": ["old_folder"]                                    # Optional
+            },
+            ...
+        ]
+    }
+    
+    Returns a per-user report: status (created / updated / unchanged / error),
+    added and removed resource names, resources that were not found, and the error if any.
+    """
+    try:
+        payload = await request.json()
+        changes = payload.get("changes")
+        
+        if not changes or not isinstance(changes, list):
+            raise HTTPException(status_code=400, detail="changes must be a non-empty list")
+        
+        report = await batch_update_permissions(changes)
+        
+        return {"detail": report}
+    
+    except Exception as e:
+        logger.error("batch_permissions failed", exc_info=True)
+        
+        if isinstance(e, HTTPException):
+            raise e
+        else:
+            raise HTTPException(status_code=500, detail=str(e))
+
+
 @keycloak_router.post("/create_user")
 @jwt_token("admin")
 async def api_create_user(request: Request):
@@ -94,8 +140,7 @@ async def api_create_user(request: Request):
         #     raise HTTPException(status_code=response.status_code, detail=response.text)
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"create_user. error: {tb_str}")
+        logger.error("create_user failed", exc_info=True)
         
         if isinstance (e, HTTPException):
             raise e
@@ -113,8 +158,7 @@ async def api_delete_user(request: Request):
         return {"detail": response}         
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"delete_user. error: {tb_str}")
+        logger.error("delete_user failed", exc_info=True)
         
         if isinstance (e, HTTPException):
             raise e
@@ -144,8 +188,7 @@ async def api_assign_role(request: Request):
             raise HTTPException(status_code=response.status_code, detail=response.text)
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"assign_role. error: {tb_str}")
+        logger.error("assign_role failed", exc_info=True)
         
         if isinstance (e, HTTPException):
             raise e
@@ -161,8 +204,7 @@ async def api_get_user_roles(request: Request):
         role_names = await get_user_roles(user_id)
         return {"detail": role_names}
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"get_user_roles. error: {tb_str}")
+        logger.error("get_user_roles failed", exc_info=True)
         
         if isinstance (e, HTTPException):
             raise e
@@ -192,8 +234,7 @@ async def api_remove_role(request: Request):
             raise HTTPException(status_code=response.status_code, detail=response.text)
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"remove_role. error: {tb_str}")
+        logger.error("remove_role failed", exc_info=True)
         
         if isinstance (e, HTTPException):
             raise e
@@ -217,8 +258,7 @@ async def api_retrieve_user_details(request: Request):
             raise HTTPException(status_code=response.status_code, detail=response.text)
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"retrieve_user_details. error: {tb_str}")
+        logger.error("retrieve_user_details failed", exc_info=True)
         
         if isinstance (e, HTTPException):
             raise e
@@ -241,8 +281,7 @@ async def api_reset_password(request: Request):
         else:
             raise HTTPException(status_code=response.status_code, detail=response.text)
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"reset_password. error: {tb_str}")
+        logger.error("reset_password failed", exc_info=True)
         if isinstance(e, HTTPException):
             raise e
         else:
@@ -261,8 +300,7 @@ async def api_reset_password(request: Request):
         else:
             raise HTTPException(status_code=response.status_code, detail=response.text)
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"reset_password. error: {tb_str}")
+        logger.error("reset_password failed", exc_info=True)
         if isinstance(e, HTTPException):
             raise e
         else:
@@ -281,8 +319,7 @@ async def api_forgot_password(request: Request):
             raise HTTPException(status_code=response.status_code, detail=response.text)
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"forgot_password. error: {tb_str}")
+        logger.error("forgot_password failed", exc_info=True)
         
         if isinstance (e, HTTPException):
             raise e
@@ -297,7 +334,7 @@ async def api_update_user_details(request: Request):
     try:
         user_id = request.state.user_id
         payload = await request.json()
-        response:httpx.Response = await update_user_details(payload, user_id)
+        response:httpx.Response = await update_user_details(payload, user_id, username=request.state.username)
         
         if response.status_code in [200, 201, 204]:
             return {"detail": "user details updated successfully"}
@@ -305,8 +342,7 @@ async def api_update_user_details(request: Request):
             raise HTTPException(status_code=response.status_code, detail=response.text)
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"update_user_details. error: {tb_str}")
+        logger.error("update_user_details failed", exc_info=True)
         
         if isinstance (e, HTTPException):
             raise e
@@ -328,8 +364,7 @@ async def api_logout_user(request: Request):
             raise HTTPException(status_code=response.status_code, detail=response.text)
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"logout_user. error: {tb_str}")
+        logger.error("logout_user failed", exc_info=True)
         
         if isinstance (e, HTTPException):
             raise e
@@ -345,8 +380,7 @@ async def api_users_status(request: Request):
         return {"detail": details}
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"logout_user. error: {tb_str}")
+        logger.error("users_status failed", exc_info=True)
         
         if isinstance (e, HTTPException):
             raise e
@@ -374,15 +408,21 @@ async def api_replace_user_role(request: Request):
         if current_roles:
             # Get role details for removal
             roles_to_remove = []
-            for role_name in current_roles:
+            # Role lookups run concurrently (and are coalesced / cached in misc_keycloak_utils)
+            role_responses = await asyncio.gather(
+                *(get_client_role(role_name) for role_name in current_roles), return_exceptions=True
+            )
+            for role_name, role_response in zip(current_roles, role_responses):
                 try:
-                    role_details = (await get_client_role(role_name)).json()
+                    if isinstance(role_response, Exception):
+                        raise role_response
+                    role_details = role_response.json()
                     roles_to_remove.append({
                         "id": role_details.get("id"),
                         "name": role_name
                     })
                 except Exception as role_error:
-                    print(f"Warning: Could not get details for role {role_name}: {role_error}")
+                    logger.warning("Could not get details for role %s: %s", role_name, role_error)
                     continue
             
             # Remove all roles in one call
@@ -410,8 +450,7 @@ async def api_replace_user_role(request: Request):
                               detail=f"Failed to assign new role: {assign_response.text}")
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"replace_user_role. error: {tb_str}")
+        logger.error("replace_user_role failed", exc_info=True)
         
         if isinstance(e, HTTPException):
             raise e
@@ -449,8 +488,7 @@ async def api_toggle_user_status(request: Request):
         return response
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"toggle_user_status. error: {tb_str}")
+        logger.error("toggle_user_status failed", exc_info=True)
         
         if isinstance(e, HTTPException):
             raise e
@@ -484,8 +522,7 @@ async def api_login_events(request: Request):
         return response
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"login_events. error: {tb_str}")
+        logger.error("login_events failed", exc_info=True)
         
         if isinstance(e, HTTPException):
             raise e
@@ -521,8 +558,7 @@ async def api_get_user_permissions(request: Request):
         return response
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"get_user_permissions. error: {tb_str}")
+        logger.error("get_user_permissions failed", exc_info=True)
         
         if isinstance(e, HTTPException):
             raise e
@@ -558,10 +594,42 @@ async def api_create_resource(request: Request):
             raise HTTPException(status_code=response.status_code, detail=response.text)
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"create_resource. error: {tb_str}")
+        logger.error("create_resource failed", exc_info=True)
+        
+        if isinstance(e, HTTPException):
+            raise e
+        else:
+            raise HTTPException(status_code=500, detail=str(e))
+
+
+@keycloak_router.post("/reconcile_resources")
+@jwt_token("admin")
+async def api_reconcile_resources(request: Request):
+    """
+    API endpoint to sync Keycloak file/dir resources with the remote/ tree.
+    
+    Expected JSON payload (optional):
+    {
+        "dry_run": true,   # Optional - only report the planned creates/deletes (default: false)
+        "force": false     # Optional - run even if the tree is unchanged and lift the bulk-delete guard
+    }
+    
+    Returns the reconcile report.
+    """
+    try:
+        body = await request.body()
+        payload = json.loads(body) if body else {}
+        dry_run = bool(payload.get("dry_run", False))
+        force = bool(payload.get("force", False))
+        
+        report = await reconcile_resources(dry_run=dry_run, force=force)
+        
+        return {"detail": report}
+    
+    except Exception as e:
+        logger.error("reconcile_resources failed", exc_info=True)
         
         if isinstance(e, HTTPException):
             raise e
         else:
-            raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+            raise HTTPException(status_code=500, detail=str(e))
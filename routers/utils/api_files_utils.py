@@ -1,3 +1,4 @@
+import asyncio
 import tempfile
 import subprocess
 import uuid
@@ -23,12 +24,37 @@ from fastapi.responses import HTMLResponse
 
 from routers.utils.misc_files_utils import *
 from routers.utils.misc_keycloak_utils import *
+from routers.utils.misc_activity_utils import activity_pipeline, KEYCLOAK_RECENT_FILES_ENABLED
+from routers.utils.misc_access_log_utils import access_log
+from routers.utils.misc_serve_utils import serve_file, is_initial_request
+from routers.utils.misc_pdf_web_utils import web_pdf_version, get_web_pdf
+from routers.utils.misc_listing_utils import dir_contents_page
+from routers.utils.misc_permission_utils import compile_permissions
+from routers.utils.misc_resource_utils import delete_resources_under
+from routers.utils.misc_reconcile_utils import resource_reconciler
+from routers.utils.misc_metrics_utils import timed, record_cache, pdf_render_duration_seconds
+from routers.utils.misc_tracing_utils import span, traced
+from routers.utils.misc_text_layer_utils import text_layer_cache, TEXT_LAYER_FORMATS
+from routers.utils.misc_render_utils import (
+    page_renderer, page_prefetcher, cap_scale, TilePyramid, TILE_SIZES, PNG_ENCODING
+)
+from routers.utils.misc_admission_utils import admission_controller, PRIORITY_VISIBLE, PRIORITY_PREFETCH
+from routers.utils.misc_logging_utils import get_logger
+
+
+logger = get_logger(__name__)
 
 
 # Cache for PDF documents to avoid reopening frequently
 pdf_cache = {}
 CACHE_SIZE_LIMIT = 10  # Maximum number of PDFs to keep in memory
 
+# Streaming page ranges (pdf_pages_stream)
+PDF_STREAM_MAX_PAGES = 500
+PDF_STREAM_CONCURRENCY = 3  # pages rendering (and held in memory) at once per stream
+PDF_STREAM_QUEUE_SLOTS = 1  # pages of one stream waiting in the render queue at once
+PDF_STREAM_MAX_RETRIES = 3  # retries of a page refused by a full render queue
+
 def get_pdf_cache_key(abs_path, mtime):
     """Generate a cache key for PDF based on path and modification time"""
     return f"{abs_path}_{mtime}"
@@ -50,10 +76,13 @@ def get_cached_pdf(abs_path):
         
         # Check if PDF is already cached
         if cache_key in pdf_cache:
+            record_cache("pdf_document", True)
             return pdf_cache[cache_key]
+        record_cache("pdf_document", False)
         
         # Load new PDF
-        doc = fitz.open(abs_path)
+        with span("pdf.open"):
+            doc = fitz.open(abs_path)
         pdf_cache[cache_key] = doc
         return doc
     except Exception as e:
@@ -74,8 +103,9 @@ async def file_preview(path):
             if doc.page_count < 1:
                 raise HTTPException(status_code=500, detail="Could not render PDF")
             page = doc.load_page(0)
-            pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-            img_data = pix.tobytes("png")
+            with timed(pdf_render_duration_seconds, operation="preview"), span("fitz.render"):
+                pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
+                img_data = pix.tobytes("png")
             img = Image.open(BytesIO(img_data))
         elif ext in [".png", ".jpg", ".jpeg"]:
             img = Image.open(abs_path)
@@ -94,7 +124,7 @@ async def file_preview(path):
         raise e from e
     
 
-async def download_file(path: str, user_id: str = None, username: str = None):
+async def download_file(path: str, user_id: str = None, username: str = None, request_headers=None):
     try:
         base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
         relative_path = path.lstrip("/\\")
@@ -103,36 +133,53 @@ async def download_file(path: str, user_id: str = None, username: str = None):
         if not download_file_path.is_file():
             raise HTTPException(status_code=404, detail=f"File not found: {download_file_path}")
         
-        # Update user's recent_files attribute in Keycloak if user info is provided
-        if user_id and username:
-            await update_user_recent_file_attribute(user_id, username, path)
-        
-        return FileResponse(
-        path=download_file_path,
-        filename=download_file_path.name
+        response = serve_file(
+            download_file_path,
+            request_headers=request_headers,
+            filename=download_file_path.name
         )
+        
+        # Count the download once: not for 304 revalidations or resumed (ranged) transfers
+        if user_id and username and response.status_code != 304 and is_initial_request(request_headers):
+            # Local access history is the source of truth for recent/trending files
+            access_log.record_in_background(user_id, username, path)
+            # Keep the legacy Keycloak recent_files attribute in sync in the background
+            if KEYCLOAK_RECENT_FILES_ENABLED:
+                activity_pipeline.enqueue(user_id, username, path)
+        
+        return response
     except Exception as e:
         raise e from e
     
 
-async def search_files(search_str: str):
+async def search_files(search_str: str, permissions: list, roles: list):
     try:
         base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
-        results = search_files_and_folders(base_dir, search_str)
+        matcher = compile_permissions(permissions, roles)
+        with span("fs.search"):
+            results = search_files_and_folders(base_dir, search_str, matcher=matcher)
         return results
     except Exception as e:
         raise e
 
 
-async def dir_contents(path: str, permissions: list, roles: list):
+async def dir_contents(path: str, permissions: list, roles: list, page_options: dict = None, counts: bool = True):
+    """
+    List a directory. Without page_options the full listing is returned (legacy behaviour),
+    with subdirectory child counts unless counts is False; with page_options (limit, cursor,
+    sort, order, entry_type, prefix, counts) a single page is returned.
+    """
     try:
         base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
         relative_path = path.lstrip("/\\")
         abs_path = os.path.normpath(os.path.join(base_dir, relative_path))
         p_abs_path = Path(abs_path)
         if not p_abs_path.is_dir(): raise HTTPException(status_code=404, detail="path does not exist")
-        print("permissions:", permissions)
-        results = await dir_contents_details(abs_path, permissions, roles)
+        logger.debug("dir_contents", extra={"path": path, "permissions": len(permissions or []), "sample_rate": 0.01})
+        if page_options is not None:
+            # scandir, sorting and permission checks block: keep them off the event loop
+            return await asyncio.to_thread(dir_contents_page, abs_path, permissions, roles, **page_options)
+        results = await dir_contents_details(abs_path, permissions, roles, counts)
         return results
 
     except Exception as e:
@@ -158,6 +205,8 @@ async def create_dir(path: str):
         #     }
         # )
         # await create_resource(resource_payload)
+        # Resources are created in bulk by the background reconciler
+        resource_reconciler.nudge()
     
         return relative_path
     except Exception as e:
@@ -170,16 +219,18 @@ async def delete_file_and_dir(path: str):
         relative_path = str(Path(path.lstrip("/\\")).as_posix())
         # print("relative_path:", relative_path)
         abs_path = os.path.normpath(os.path.join(base_dir, relative_path))
-        all_resources = await get_all_resources()
-        # print("all_resources:", all_resources)
+        if relative_path == ".":
+            raise HTTPException(status_code=400, detail="cannot delete the root directory")
         if os.path.isfile(abs_path):
             os.remove(abs_path)
         elif os.path.isdir(abs_path):
             shutil.rmtree(abs_path)
         else:
             raise HTTPException(status_code=400, detail="invalid path")
-        for resource in all_resources:
-                if relative_path in resource: await delete_resource(all_resources[resource])
+        # Only the resource for this path and the resources below it (exact prefix match)
+        result = await delete_resources_under(relative_path)
+        if result["failed"]:
+            logger.error("Failed to delete resources under %s", relative_path, extra={"failed": result["failed"]})
         return f"deleted: {relative_path}"
     except Exception as e:
         raise e from e
@@ -215,11 +266,12 @@ async def upload_files(folder: str, files, path: str):
 
             uploaded_files.append(file.filename)
 
+        # Resources are created in bulk by the background reconciler
+        resource_reconciler.nudge()
         return uploaded_files
     
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error in upload_files: {tb_str}")
+        logger.error("Error in upload_files", exc_info=True)
         raise e from e
 
 
@@ -239,7 +291,7 @@ async def upload_multiple_folders(files, directory_structure_json: str):
         
         # Parse the directory structure
         directory_structure = json.loads(directory_structure_json)
-        print("directory_structure:", directory_structure)
+        logger.debug("upload_multiple directory structure", extra={"entries": len(directory_structure) if isinstance(directory_structure, (list, dict)) else None})
           # Create a mapping of file names to file objects for quick lookup
         file_map = {file.filename: file for file in files}
         
@@ -256,6 +308,8 @@ async def upload_multiple_folders(files, directory_structure_json: str):
             created_dirs
         )
         
+        # Resources are created in bulk by the background reconciler
+        resource_reconciler.nudge()
         return {
             "uploaded_files": uploaded_files,
             "created_directories": created_dirs,
@@ -266,8 +320,7 @@ async def upload_multiple_folders(files, directory_structure_json: str):
     except json.JSONDecodeError as e:
         raise HTTPException(status_code=400, detail=f"Invalid JSON in directory_structure: {str(e)}")
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error in upload_multiple_folders: {tb_str}")
+        logger.error("Error in upload_multiple_folders", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
 
@@ -305,7 +358,9 @@ async def get_pdf_info(path):
             "producer": metadata.get("producer", ""),
             "creation_date": metadata.get("creationDate", ""),
             "modification_date": metadata.get("modDate", ""),
-            "file_size": os.path.getsize(abs_path)
+            "file_size": os.path.getsize(abs_path),
+            # pass as pdf_raw?version= to load the linearized copy (None until it has been built)
+            "web_version": web_pdf_version(abs_path)
         }
         
         return pdf_info
@@ -314,8 +369,8 @@ async def get_pdf_info(path):
         raise HTTPException(status_code=500, detail=f"Error reading PDF info: {str(e)}")
 
 
-async def get_pdf_page(path, page_num, quality="medium", scale=1.0):
-    """Get a specific page from PDF as base64 image"""
+async def get_pdf_page(path, page_num, quality="medium", scale=1.0, encoding=PNG_ENCODING):
+    """Get a specific page from PDF as base64 image (encoding: see negotiate_encoding)"""
     base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
     relative_path = path.lstrip("/\\")
     abs_path = os.path.normpath(os.path.join(base_dir, relative_path))
@@ -329,9 +384,6 @@ async def get_pdf_page(path, page_num, quality="medium", scale=1.0):
         if page_num < 1 or page_num > doc.page_count:
             raise HTTPException(status_code=400, detail=f"Page {page_num} not found. PDF has {doc.page_count} pages")
         
-        # Load the specific page (0-indexed)
-        page = doc.load_page(page_num - 1)
-        
         # Set quality based on parameter
         quality_settings = {
             "low": 1.0,
@@ -340,25 +392,22 @@ async def get_pdf_page(path, page_num, quality="medium", scale=1.0):
         }
         base_scale = quality_settings.get(quality, 1.5)
         final_scale = base_scale * scale
+        # Large-format pages are scaled down to RENDER_MAX_PIXELS (use pdf_tile to zoom in further)
+        rect = doc.load_page(page_num - 1).rect
+        final_scale = cap_scale(rect.width, rect.height, final_scale)
         
-        # Render page to image
-        matrix = fitz.Matrix(final_scale, final_scale)
-        pix = page.get_pixmap(matrix=matrix)
-        img_data = pix.tobytes("png")
-        
-        # Convert to PIL Image for additional processing if needed
-        img = Image.open(BytesIO(img_data))
-        
-        # Convert to base64
-        buffered = BytesIO()
-        img.save(buffered, format="PNG", optimize=True)
-        img_b64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+        # Render page to image (render pool + cache, see misc_render_utils)
+        img_data, width, height, mime_type = await page_renderer.render(
+            abs_path, os.path.getmtime(abs_path), page_num, final_scale, encoding, operation="page")
+        with span("image.encode"):
+            img_b64 = base64.b64encode(img_data).decode("utf-8")
         
         return {
             "page_number": page_num,
             "image_data": img_b64,
-            "width": img.width,
-            "height": img.height,
+            "mime_type": mime_type,
+            "width": width,
+            "height": height,
             "scale": final_scale
         }
         
@@ -366,7 +415,24 @@ async def get_pdf_page(path, page_num, quality="medium", scale=1.0):
         raise HTTPException(status_code=500, detail=f"Error rendering PDF page: {str(e)}")
 
 
-async def get_pdf_pages_range(path, start_page, end_page, quality="medium", scale=1.0):
+def schedule_page_prefetch(session_id, path, page_num, quality="medium", scale=1.0, encoding=PNG_ENCODING):
+    """Pre-render the pages around page_num in the background (best effort, never raises)"""
+    try:
+        base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
+        relative_path = path.lstrip("/\\")
+        abs_path = os.path.normpath(os.path.join(base_dir, relative_path))
+        doc = get_cached_pdf(abs_path)
+        quality_settings = {"low": 1.0, "medium": 1.5, "high": 2.0}
+        final_scale = quality_settings.get(quality, 1.5) * scale
+        rect = doc.load_page(page_num - 1).rect
+        final_scale = cap_scale(rect.width, rect.height, final_scale)
+        page_prefetcher.schedule((session_id, abs_path), abs_path, os.path.getmtime(abs_path),
+                                 doc.page_count, page_num, final_scale, encoding)
+    except Exception:
+        logger.debug("page prefetch not scheduled for %s", path, exc_info=True)
+
+
+async def get_pdf_pages_range(path, start_page, end_page, quality="medium", scale=1.0, encoding=PNG_ENCODING):
     """Get multiple PDF pages in a range"""
     base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
     relative_path = path.lstrip("/\\")
@@ -390,7 +456,7 @@ async def get_pdf_pages_range(path, start_page, end_page, quality="medium", scal
         pages_data = []
         
         for page_num in range(start_page, end_page + 1):
-            page_data = await get_pdf_page(path, page_num, quality, scale)
+            page_data = await get_pdf_page(path, page_num, quality, scale, encoding)
             pages_data.append(page_data)
         
         return {
@@ -406,6 +472,145 @@ async def get_pdf_pages_range(path, start_page, end_page, quality="medium", scal
         raise HTTPException(status_code=500, detail=f"Error rendering PDF pages: {str(e)}")
 
 
+
+async def stream_pdf_pages(path, start_page, end_page, quality="medium", scale=1.0, encoding=PNG_ENCODING,
+                           priority=PRIORITY_VISIBLE):
+    """
+    Render a page range for a streaming (NDJSON) response: one JSON line per page,
+    in completion order, with at most PDF_STREAM_CONCURRENCY pages rendering or
+    buffered at a time. Validation happens once, before the response starts.
+    Every page takes its own slot of the "render" admission class: the response
+    outlives the endpoint (and its admission slot), so pages queue with other renders.
+    Only the first page keeps the caller's priority; the rest queue as prefetch, so
+    visible page requests evict them, and a stream holds at most PDF_STREAM_QUEUE_SLOTS
+    queue positions.
+    """
+    base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
+    relative_path = path.lstrip("/\\")
+    abs_path = os.path.normpath(os.path.join(base_dir, relative_path))
+    
+    if not os.path.isfile(abs_path):
+        raise HTTPException(status_code=400, detail="Invalid file path")
+    
+    doc = get_cached_pdf(abs_path)
+    if start_page < 1 or end_page > doc.page_count or start_page > end_page:
+        raise HTTPException(status_code=400, detail=f"Invalid page range. PDF has {doc.page_count} pages")
+    if end_page - start_page + 1 > PDF_STREAM_MAX_PAGES:
+        raise HTTPException(status_code=400, detail=f"Maximum {PDF_STREAM_MAX_PAGES} pages per request")
+    
+    quality_settings = {"low": 1.0, "medium": 1.5, "high": 2.0}
+    final_scale = quality_settings.get(quality, 1.5) * scale
+    mtime = os.path.getmtime(abs_path)
+    
+    queue_slots = asyncio.Semaphore(PDF_STREAM_QUEUE_SLOTS)
+    
+    async def render_admitted(page_num, page_scale):
+        page_priority = priority if page_num == start_page else PRIORITY_PREFETCH
+        for attempt in range(PDF_STREAM_MAX_RETRIES + 1):
+            await queue_slots.acquire()
+            waiting = [True]
+            
+            def admitted():
+                if waiting[0]:
+                    waiting[0] = False
+                    queue_slots.release()
+            
+            try:
+                return await admission_controller.run("render", page_priority, lambda: page_renderer.render(
+                    abs_path, mtime, page_num, page_scale, encoding, operation="pages_stream", store=False),
+                    admitted=admitted)
+            except HTTPException as he:
+                if he.status_code != 429 or attempt == PDF_STREAM_MAX_RETRIES:
+                    raise he
+                retry_after = int(he.headers.get("Retry-After", 1))
+            finally:
+                admitted()
+            # render queue full (or evicted by a visible request): back off, then retry the page
+            await asyncio.sleep(retry_after)
+    
+    async def render_one(page_num):
+        try:
+            rect = doc.load_page(page_num - 1).rect
+            page_scale = cap_scale(rect.width, rect.height, final_scale)
+            img_data, width, height, mime_type = await render_admitted(page_num, page_scale)
+        except Exception as e:
+            return {"page_number": page_num, "error": str(e)}
+        return {
+            "page_number": page_num,
+            "image_data": base64.b64encode(img_data).decode("utf-8"),
+            "mime_type": mime_type,
+            "width": width,
+            "height": height,
+            "scale": page_scale
+        }
+    
+    async def lines():
+        yield json.dumps({"start_page": start_page, "end_page": end_page, "page_count": doc.page_count,
+                          "scale": final_scale}) + "\n"
+        next_page = start_page
+        pending = set()
+        try:
+            while next_page <= end_page or pending:
+                while next_page <= end_page and len(pending) < PDF_STREAM_CONCURRENCY:
+                    pending.add(asyncio.ensure_future(render_one(next_page)))
+                    next_page += 1
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield json.dumps(task.result()) + "\n"
+        finally:
+            # client went away: stop waiting for the pages still rendering
+            for task in pending:
+                task.cancel()
+    
+    return lines()
+
+
+def _tile_pyramid(path, page_num, tile_size):
+    base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
+    relative_path = path.lstrip("/\\")
+    abs_path = os.path.normpath(os.path.join(base_dir, relative_path))
+    
+    if not os.path.isfile(abs_path):
+        raise HTTPException(status_code=400, detail="Invalid file path")
+    if tile_size not in TILE_SIZES:
+        raise HTTPException(status_code=400, detail=f"tile_size must be one of {', '.join(map(str, TILE_SIZES))}")
+    
+    doc = get_cached_pdf(abs_path)
+    if page_num < 1 or page_num > doc.page_count:
+        raise HTTPException(status_code=400, detail=f"Page {page_num} not found. PDF has {doc.page_count} pages")
+    return abs_path, TilePyramid(doc.load_page(page_num - 1).rect, tile_size)
+
+
+async def get_pdf_tile_info(path, page_num, tile_size=256):
+    """Zoom levels and tile grid of a page, for deep-zoom viewers"""
+    abs_path, pyramid = _tile_pyramid(path, page_num, tile_size)
+    return {
+        "page_number": page_num,
+        "page_width": pyramid.rect.width,
+        "page_height": pyramid.rect.height,
+        "tile_size": tile_size,
+        "max_zoom": pyramid.max_zoom,
+        "levels": pyramid.levels()
+    }
+
+
+async def get_pdf_tile(path, page_num, zoom, x, y, tile_size=256, encoding=PNG_ENCODING):
+    """One tile of a page: (image bytes, media type). Only the tile's clip rectangle is rendered"""
+    abs_path, pyramid = _tile_pyramid(path, page_num, tile_size)
+    if zoom < 0 or zoom > pyramid.max_zoom:
+        raise HTTPException(status_code=400, detail=f"Zoom level must be between 0 and {pyramid.max_zoom}")
+    columns, rows = pyramid.grid(zoom)
+    if x < 0 or y < 0 or x >= columns or y >= rows:
+        raise HTTPException(status_code=400, detail=f"Tile out of range: level {zoom} has {columns}x{rows} tiles")
+    
+    try:
+        img_data, _, _, mime_type = await page_renderer.render_tile(
+            abs_path, os.path.getmtime(abs_path), page_num, pyramid, zoom, x, y, encoding)
+        return img_data, mime_type
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error rendering PDF tile: {str(e)}")
+
+@traced("pdf.search")
 async def search_pdf_text(path, search_text):
     """Search for text within PDF and return page numbers and positions"""
     base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
@@ -472,14 +677,17 @@ async def search_pdf_text(path, search_text):
         raise HTTPException(status_code=500, detail=f"Error searching PDF: {str(e)}")
 
 
-async def get_pdf_page_with_text(path, page_num, quality="medium", scale=1.0):
-    """Get a PDF page with both image and text layer data"""
+async def get_pdf_page_with_text(path, page_num, quality="medium", scale=1.0, encoding=PNG_ENCODING,
+                                 text_format="full"):
+    """Get a PDF page with both image and text layer data (the words of the text layer)"""
     base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
     relative_path = path.lstrip("/\\")
     abs_path = os.path.normpath(os.path.join(base_dir, relative_path))
     
     if not os.path.isfile(abs_path):
         raise HTTPException(status_code=400, detail="Invalid file path")
+    if text_format not in TEXT_LAYER_FORMATS:
+        raise HTTPException(status_code=400, detail=f"text_format must be one of {', '.join(TEXT_LAYER_FORMATS)}")
     
     try:
         doc = get_cached_pdf(abs_path)
@@ -487,46 +695,55 @@ async def get_pdf_page_with_text(path, page_num, quality="medium", scale=1.0):
         if page_num < 1 or page_num > doc.page_count:
             raise HTTPException(status_code=400, detail=f"Page {page_num} not found")
         
-        page = doc.load_page(page_num - 1)
-        
         # Get the image data (same as before)
         quality_settings = {"low": 1.0, "medium": 1.5, "high": 2.0}
         base_scale = quality_settings.get(quality, 1.5)
         final_scale = base_scale * scale
+        rect = doc.load_page(page_num - 1).rect
+        final_scale = cap_scale(rect.width, rect.height, final_scale)
         
-        matrix = fitz.Matrix(final_scale, final_scale)
-        pix = page.get_pixmap(matrix=matrix)
-        img_data = pix.tobytes("png")
-        
-        img = Image.open(BytesIO(img_data))
-        buffered = BytesIO()
-        img.save(buffered, format="PNG", optimize=True)
-        img_b64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+        img_data, width, height, mime_type = await page_renderer.render(
+            abs_path, os.path.getmtime(abs_path), page_num, final_scale, encoding, operation="page_with_text")
+        with span("image.encode"):
+            img_b64 = base64.b64encode(img_data).decode("utf-8")
         
-        # Get text layer data
-        text_data = await get_pdf_text_layer(path, page_num, final_scale)
+        # Get text layer data (only the words are sent here)
+        with span("pdf.text_layer"):
+            layer = text_layer_cache.get(doc, abs_path, os.path.getmtime(abs_path), page_num)
+            if text_format == "compact":
+                text_layer = layer.compact_words(final_scale)
+            else:
+                text_layer = layer.full_words(final_scale)
         
         return {
             "page_number": page_num,
             "image_data": img_b64,
-            "width": img.width,
-            "height": img.height,
+            "mime_type": mime_type,
+            "width": width,
+            "height": height,
             "scale": final_scale,
-            "text_layer": text_data["text_blocks"]
+            "text_layer": text_layer
         }
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error rendering PDF page with text: {str(e)}")
 
 
-async def get_pdf_text_layer(path, page_num, scale=1.0):
-    """Get text layer data for a PDF page with positioning"""
+@traced("pdf.text_layer")
+async def get_pdf_text_layer(path, page_num, scale=1.0, text_format="full"):
+    """
+    Get text layer data for a PDF page with positioning. The page text is extracted once per
+    (path, mtime, page) and only scaled here; text_format="compact" returns parallel arrays
+    (see TextLayer.compact) instead of a dict per word and line.
+    """
     base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
     relative_path = path.lstrip("/\\")
     abs_path = os.path.normpath(os.path.join(base_dir, relative_path))
     
     if not os.path.isfile(abs_path):
         raise HTTPException(status_code=400, detail="Invalid file path")
+    if text_format not in TEXT_LAYER_FORMATS:
+        raise HTTPException(status_code=400, detail=f"text_format must be one of {', '.join(TEXT_LAYER_FORMATS)}")
     
     try:
         doc = get_cached_pdf(abs_path)
@@ -534,85 +751,31 @@ async def get_pdf_text_layer(path, page_num, scale=1.0):
         if page_num < 1 or page_num > doc.page_count:
             raise HTTPException(status_code=400, detail=f"Page {page_num} not found")
         
-        page = doc.load_page(page_num - 1)
-        
-        # Get text blocks with positioning
-        text_blocks = []
+        layer = text_layer_cache.get(doc, abs_path, os.path.getmtime(abs_path), page_num)
         
-        # Method 1: Get text with detailed positioning (words)
-        words = page.get_text("words")
-        for word in words:
-            x0, y0, x1, y1, text, block_no, line_no, word_no = word
-            
-            # Scale coordinates to match the rendered image
-            text_blocks.append({
-                "text": text,
-                "bbox": {
-                    "x": x0 * scale,
-                    "y": y0 * scale,
-                    "width": (x1 - x0) * scale,
-                    "height": (y1 - y0) * scale
-                },
-                "block_no": block_no,
-                "line_no": line_no,
-                "word_no": word_no,
-                "type": "word"
-            })
-        
-        # Method 2: Get text blocks (paragraphs) for better structure
-        blocks = page.get_text("dict")["blocks"]
-        text_paragraphs = []
-        
-        for block in blocks:
-            if "lines" in block:  # Text block
-                for line in block["lines"]:
-                    line_text = ""
-                    line_bbox = None
-                    
-                    for span in line["spans"]:
-                        line_text += span["text"]
-                        span_bbox = span["bbox"]
-                        
-                        if line_bbox is None:
-                            line_bbox = list(span_bbox)
-                        else:
-                            # Extend bounding box
-                            line_bbox[0] = min(line_bbox[0], span_bbox[0])
-                            line_bbox[1] = min(line_bbox[1], span_bbox[1])
-                            line_bbox[2] = max(line_bbox[2], span_bbox[2])
-                            line_bbox[3] = max(line_bbox[3], span_bbox[3])
-                    
-                    if line_text.strip():
-                        text_paragraphs.append({
-                            "text": line_text,
-                            "bbox": {
-                                "x": line_bbox[0] * scale,
-                                "y": line_bbox[1] * scale,
-                                "width": (line_bbox[2] - line_bbox[0]) * scale,
-                                "height": (line_bbox[3] - line_bbox[1]) * scale
-                            },
-                            "type": "line",
-                            "font_info": {
-                                "size": line["spans"][0].get("size", 12) * scale if line["spans"] else 12,
-                                "font": line["spans"][0].get("font", "unknown") if line["spans"] else "unknown"
-                            }
-                        })
-        
-        return {
+        text_data = {
             "page_number": page_num,
             "scale": scale,
-            "text_blocks": text_blocks,
-            "text_paragraphs": text_paragraphs,
-            "page_width": page.rect.width * scale,
-            "page_height": page.rect.height * scale
+            "page_width": layer.page_width * scale,
+            "page_height": layer.page_height * scale
         }
+        if text_format == "compact":
+            text_data["format"] = "compact"
+            text_data.update(layer.compact(scale))
+        else:
+            text_data["text_blocks"] = layer.full_words(scale)
+            text_data["text_paragraphs"] = layer.full_lines(scale)
+        return text_data
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error extracting text layer: {str(e)}")
 
 
-async def get_raw_pdf(path):
-    """Serve raw PDF file for PDF.js viewer"""
+async def get_raw_pdf(path, request_headers=None, version=None):
+    """
+    Serve raw PDF file for PDF.js viewer (supports Range and conditional requests).
+    With a version (pdf_info's web_version) the linearized copy is served instead.
+    """
     base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
     relative_path = path.lstrip("/\\")
     abs_path = os.path.normpath(os.path.join(base_dir, relative_path))
@@ -624,16 +787,27 @@ async def get_raw_pdf(path):
     if ext != ".pdf":
         raise HTTPException(status_code=415, detail="File is not a PDF")
     
+    if version:
+        # The linearized ("fast web view") copy lets PDF.js render the first page after a
+        # few range requests; it has its own URL so a session never switches files midway
+        served_path = get_web_pdf(abs_path, version)
+        if served_path is None:
+            raise HTTPException(status_code=404, detail="PDF version no longer available")
+    else:
+        served_path = abs_path
+        web_pdf_version(abs_path)  # start building the copy for later sessions
+
     try:
-        return FileResponse(
-            path=abs_path,
+        return serve_file(
+            served_path,
+            request_headers=request_headers,
             media_type="application/pdf",
             filename=os.path.basename(abs_path),
-            headers={
-                "Cache-Control": "public, max-age=3600",
-                "Content-Disposition": "inline"  # Display in browser instead of download
-            }
+            content_disposition_type="inline",  # Display in browser instead of download
+            cache_control="public, max-age=3600"
         )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error serving PDF: {str(e)}")
 
@@ -775,7 +949,7 @@ async def get_pptx_slide(path, slide_num):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error reading PPTX slide: {str(e)}")
 
-async def get_newly_added_files(cutoff_criteria=3):
+async def get_newly_added_files(cutoff_criteria=3, permissions: list = None, roles: list = None):
     """
     Get files that have been modified within the last 'days' days or after a specific timestamp.
     
@@ -791,14 +965,16 @@ async def get_newly_added_files(cutoff_criteria=3):
         if not os.path.exists(base_dir):
             raise HTTPException(status_code=404, detail="Remote directory does not exist")
         
-        recently_modified = scan_recently_modified_files(base_dir, cutoff_criteria)
+        matcher = compile_permissions(permissions, roles) if permissions is not None else None
+        with span("fs.scan_recent"):
+            recently_modified = scan_recently_modified_files(base_dir, cutoff_criteria, matcher=matcher)
         return recently_modified
         
     except Exception as e:
         raise e
 
 
-async def get_newly_added_files_since_timestamp(timestamp_dt):
+async def get_newly_added_files_since_timestamp(timestamp_dt, permissions: list = None, roles: list = None):
     """
     Get files that have been modified since a specific timestamp.
     
@@ -814,8 +990,55 @@ async def get_newly_added_files_since_timestamp(timestamp_dt):
         if not os.path.exists(base_dir):
             raise HTTPException(status_code=404, detail="Remote directory does not exist")
         
-        recently_modified = scan_recently_modified_files(base_dir, timestamp_dt)
+        matcher = compile_permissions(permissions, roles) if permissions is not None else None
+        with span("fs.scan_recent"):
+            recently_modified = scan_recently_modified_files(base_dir, timestamp_dt, matcher=matcher)
         return recently_modified
         
     except Exception as e:
-        raise e
\ No newline at end of file
+        raise e
+
+
+async def get_recent_files(user_id: str, limit: int = 10):
+    """Most recently downloaded files of a user, newest first (served from the local access log)"""
+    try:
+        return await asyncio.to_thread(access_log.recent_files, user_id, limit)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reading access history: {str(e)}")
+
+
+async def get_file_stats(path: str, permissions: list, roles: list, days: int = 30):
+    """Download statistics of a single file (served from the local access log)"""
+    relative_path = str(Path(path.lstrip("/\\")).as_posix())
+    if not has_hierarchical_permission(relative_path, permissions, roles):
+        raise HTTPException(status_code=403, detail="access denied")
+    try:
+        return await asyncio.to_thread(access_log.file_stats, relative_path, days)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reading access history: {str(e)}")
+
+
+async def get_trending_files(permissions: list, roles: list, days: int = 7, limit: int = 20):
+    """
+    Most downloaded files within the last `days` days (trending) or of all time (days=0),
+    restricted to the files the caller has access to.
+    """
+    try:
+        # Page through the ranking until `limit` accessible files are found or the rows run out;
+        # batches are larger than the limit so that filtering usually needs one query
+        batch = limit if "admin" in roles else limit * 5
+        matcher = compile_permissions(permissions, roles)
+        results = []
+        offset = 0
+        while len(results) < limit:
+            if days > 0:
+                rows = await asyncio.to_thread(access_log.trending, days, batch, offset)
+            else:
+                rows = await asyncio.to_thread(access_log.most_downloaded, batch, offset)
+            results.extend(row for row in rows if matcher.is_allowed(row["path"]))
+            if len(rows) < batch:
+                break
+            offset += batch
+        return results[:limit]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reading access history: {str(e)}")
@@ -1,28 +1,33 @@
+import asyncio
+from contextlib import aclosing
+
 from fastapi import HTTPException
 
 from routers.utils.misc_keycloak_utils import *
 from routers.utils.keycloak_vars import *
+from routers.utils.misc_resource_utils import resource_index
+from routers.utils.misc_reconcile_utils import create_resources
+from routers.utils.misc_login_events_utils import login_event_store, user_directory
+from routers.utils.misc_logging_utils import get_logger
+
+
+logger = get_logger(__name__)
 
 
 async def delete_permission(username: str, access_token=None):
     try:
-        headers, _ = await obtain_headers()
+        headers, _ = await obtain_headers(access_token)
 
-        permission_name = f"permission_user_{username}"
-        all_permissions = (await get_all_permissions()).json()
-        relevant_permission = None
-        for permission in all_permissions:
-            if permission.get("name") == permission_name:
-                relevant_permission = permission
-                break
+        relevant_permission = await find_permission(f"permission_user_{username}", access_token)
         if not relevant_permission: raise Exception("no existing permission found for this user")
         permission_id = relevant_permission.get("id")
 
-        async with httpx.AsyncClient() as client:
+        async with keycloak_client() as client:
             response = await client.delete(
                 base_url + ep_delete_permission.replace("[ENTER_PERMISSION_ID]", permission_id), 
                 headers=headers
                 )
+        invalidate_cached_read("find_permission")
         if response.status_code in [200, 201, 204]:
             return {"detail": "permission deleted"}
         else:
@@ -32,29 +37,29 @@ async def delete_permission(username: str, access_token=None):
 
 async def unassign_permission(resources: list, username: str, access_token=None):
     try:
-        print(f"Starting unassign_permission for user: {username}")
-        print(f"Resources to unassign: {resources}")
+        logger.info("unassign_permission", extra={"username": username, "resources": len(resources or [])})
         
         rem_resource_ids = []
         rem_resource_dict = {} # to store resource name against each resource id
         not_found_resources = [] # to track resources that don't exist
         
+        # Resolve the whole batch from the local resource index; only misses go to Keycloak
+        resolved_resources = await resource_index.resolve(resources, access_token)
         for resource_name in resources:
-            resource_id = await retrieve_resource(resource_name)
-            print(f"Retrieved resource for {resource_name}: {resource_id}")
+            resource_id = resolved_resources.get(resource_name)
+            logger.debug("resolved resource %s: %s", resource_name, resource_id)
             
             if not resource_id:
                 not_found_resources.append(resource_name)
-                print(f"Resource {resource_name} not found, added to not_found_resources")
+                logger.debug("resource %s not found", resource_name)
             else:
                 # Extract the resource ID from the resource object
                 actual_resource_id = resource_id.get("_id") if isinstance(resource_id, dict) else resource_id
                 rem_resource_ids.append(actual_resource_id)
                 rem_resource_dict[actual_resource_id] = resource_name
-                print(f"Resource {resource_name} found with ID: {actual_resource_id}")
+                logger.debug("resource %s found with id %s", resource_name, actual_resource_id)
                 
-        print("rem_resource_ids:", rem_resource_ids)
-        print("not_found_resources:", not_found_resources)
+        logger.debug("unassign_permission resolved", extra={"found": len(rem_resource_ids), "not_found": not_found_resources})
 
         # If no valid resource IDs found, handle gracefully
         if not rem_resource_ids:
@@ -63,7 +68,7 @@ async def unassign_permission(resources: list, username: str, access_token=None)
             else:
                 return {"detail": "No valid resources provided for unassignment"}
 
-        user_policy = await retrieve_user_policy(username)
+        user_policy = await retrieve_user_policy(username, access_token)
         if not user_policy:
             raise Exception("policy not found for the given username")
         policy_id = user_policy.get("id")
@@ -71,19 +76,7 @@ async def unassign_permission(resources: list, username: str, access_token=None)
             raise Exception("policy_id not found against the given username")
         
         permission_name = f"permission_user_{username}"
-        permissions_response = await get_all_permissions()
-        if permissions_response.status_code != 200:
-            raise Exception(f"Failed to get permissions: {permissions_response.text}")
-        
-        all_permissions = permissions_response.json()
-        if not all_permissions or not isinstance(all_permissions, list):
-            all_permissions = []
-            
-        relevant_permission = None
-        for permission in all_permissions:
-            if permission and permission.get("name") == permission_name:
-                relevant_permission = permission
-                break
+        relevant_permission = await find_permission(permission_name, access_token)
  
         if relevant_permission:
             permission_id = relevant_permission.get("id")
@@ -97,7 +90,7 @@ async def unassign_permission(resources: list, username: str, access_token=None)
                 resources_in_permission = []
                 
             resource_ids = [resource.get("_id") for resource in resources_in_permission if resource]
-            print("resource_ids:", resource_ids)
+            logger.debug("permission resources before update", extra={"count": len(resource_ids)})
             
             # check if all resources to be unassigned were earlier assigned or not?
             non_existent_permissions = []
@@ -107,7 +100,7 @@ async def unassign_permission(resources: list, username: str, access_token=None)
             updated_resource_ids = resource_ids.copy()
             for id in resource_ids:
                 if id in rem_resource_ids: updated_resource_ids.remove(id)
-            print("updated resource_ids:", updated_resource_ids)
+            logger.debug("permission resources after update", extra={"count": len(updated_resource_ids)})
             update_payload = (
                 {
                     "id":permission_id,
@@ -142,17 +135,23 @@ async def unassign_permission(resources: list, username: str, access_token=None)
 async def assign_permission(resources: list, username: str, access_token=None):
     try:
         new_resource_ids = []
+        for resource_info in resources:
+            if not resource_info.get("name") or not resource_info.get("type"):
+                raise Exception(f"Resource must have both 'name' and 'type' fields. Found: {resource_info}")
+        
+        # Resolve the whole batch from the local resource index; only misses go to Keycloak
+        resolved_resources = await resource_index.resolve(
+            [resource_info.get("name") for resource_info in resources], access_token
+        )
+        
         for resource_info in resources:
             resource_name = resource_info.get("name")
             resource_type = resource_info.get("type")
             
-            if not resource_name or not resource_type:
-                raise Exception(f"Resource must have both 'name' and 'type' fields. Found: {resource_info}")
-            
-            resource_object = await retrieve_resource(resource_name)
+            resource_object = resolved_resources.get(resource_name)
             if not resource_object:
                 # Resource doesn't exist, create it automatically
-                print(f"Resource '{resource_name}' with type '{resource_type}' not found, creating new resource...")
+                logger.info("Resource %s (%s) not found, creating it", resource_name, resource_type)
                 
                 # Create resource with the specified type from input
                 resource_payload = {
@@ -170,22 +169,29 @@ async def assign_permission(resources: list, username: str, access_token=None):
                 if create_response.status_code not in [200, 201, 204]:
                     raise Exception(f"Failed to create resource '{resource_name}': {create_response.text}")
                 
-                print(f"Successfully created resource '{resource_name}' with type '{resource_type}'")
+                logger.info("Created resource %s (%s)", resource_name, resource_type)
                 
-                # Retrieve the newly created resource to get its ID
-                resource_object = await retrieve_resource(resource_name)
+                # Keycloak returns the created resource; fall back to a lookup if the body has no id
+                try:
+                    resource_object = create_response.json()
+                except ValueError:
+                    resource_object = None
+                if not resource_object or not resource_object.get("_id"):
+                    resource_object = await retrieve_resource(resource_name, access_token)
                 if not resource_object:
                     raise Exception(f"Failed to retrieve newly created resource '{resource_name}'")
+                resource_index.add(resource_name, resource_object.get("_id"), resource_type)
+                resolved_resources[resource_name] = resource_object
             
             # Extract the resource ID from the resource object
             resource_id = resource_object.get("_id") if isinstance(resource_object, dict) else resource_object
             new_resource_ids.append(resource_id)
 
         # Try to retrieve user policy, create if it doesn't exist
-        user_policy = await retrieve_user_policy(username)
+        user_policy = await retrieve_user_policy(username, access_token)
         if not user_policy or not user_policy.get("id"):
             # Policy doesn't exist, create it
-            print(f"User policy not found for {username}, creating new policy...")
+            logger.info("User policy not found for %s, creating it", username)
             
             # Get user details to extract user ID
             user_details_response = await retrieve_user_details(username)
@@ -212,22 +218,17 @@ async def assign_permission(resources: list, username: str, access_token=None):
             if policy_response.status_code not in [200, 201, 204]:
                 raise Exception(f"Failed to create user policy for {username}: {policy_response.text}")
             
-            print(f"Successfully created user policy for {username}")
+            logger.info("Created user policy for %s", username)
             
             # Retrieve the newly created policy to get its ID
-            user_policy = await retrieve_user_policy(username)
+            user_policy = await retrieve_user_policy(username, access_token)
             if not user_policy or not user_policy.get("id"):
                 raise Exception(f"Failed to retrieve newly created policy for {username}")
         
         policy_id = user_policy.get("id")
         
         permission_name = f"permission_user_{username}"
-        all_permissions = (await get_all_permissions()).json()
-        relevant_permission = None
-        for permission in all_permissions:
-            if permission.get("name") == permission_name:
-                relevant_permission = permission
-                break
+        relevant_permission = await find_permission(permission_name, access_token)
 
         if relevant_permission:
             permission_id = relevant_permission.get("id")
@@ -277,8 +278,10 @@ async def create_user(payload, access_token=None):
         username = payload["username"]
         
         # create user in keycloak
-        async with httpx.AsyncClient() as client:
+        async with keycloak_client() as client:
             response = await client.post(base_url + ep_create_user, json=payload, headers=headers)
+        invalidate_cached_read("retrieve_user_details", username=username)
+        user_directory.invalidate()
         if response.status_code not in [200, 201, 204]:
             raise HTTPException(status_code=response.status_code, detail=response.text)
         
@@ -325,12 +328,12 @@ async def create_user(payload, access_token=None):
 
 async def delete_user(username, access_token=None):
     try:
-        all_users = (await get_all_users()).json()
         user_id = None
-        for user in all_users:
-            if user.get("username") == username:
-                user_id = user.get("id")
-                break
+        async with aclosing(iter_users(access_token, username=username, exact=True)) as users:
+            async for user in users:
+                if user.get("username") == username:
+                    user_id = user.get("id")
+                    break
         if not user_id: raise Exception(f"user with username {username} not found")
         
         cleanup_results = []
@@ -339,10 +342,10 @@ async def delete_user(username, access_token=None):
         try:
             permission_result = await delete_permission(username, access_token)
             cleanup_results.append("permission deleted")
-            print(f"Successfully deleted permissions for user: {username}")
+            logger.info("Deleted permissions for user %s", username)
         except Exception as perm_error:
             cleanup_results.append("permission not found or already deleted")
-            print(f"Warning: Could not delete permissions for user {username}: {perm_error}")
+            logger.warning("Could not delete permissions for user %s: %s", username, perm_error)
         
         # Step 2: Cleanup user policy (if it exists)
         try:
@@ -351,18 +354,20 @@ async def delete_user(username, access_token=None):
                 policy_id = user_policy.get("id")
                 await delete_user_policy(policy_id, access_token)
                 cleanup_results.append("policy deleted")
-                print(f"Successfully deleted policy for user: {username}")
+                logger.info("Deleted policy for user %s", username)
             else:
                 cleanup_results.append("policy not found")
-                print(f"No policy found for user: {username}")
+                logger.info("No policy found for user %s", username)
         except Exception as policy_error:
             cleanup_results.append("policy not found or already deleted")
-            print(f"Warning: Could not delete policy for user {username}: {policy_error}")
+            logger.warning("Could not delete policy for user %s: %s", username, policy_error)
         
         # Step 3: Delete the user
         headers, _ = await obtain_headers(access_token)
-        async with httpx.AsyncClient() as client:
+        async with keycloak_client() as client:
             response = await client.delete(base_url + ep_delete_user.replace("[ENTER_USER_ID]", user_id), headers=headers)
+        invalidate_cached_read("retrieve_user_details", username=username)
+        user_directory.invalidate()
         
         if response.status_code in [200, 201, 204]:
             cleanup_summary = ", ".join(cleanup_results)
@@ -376,8 +381,8 @@ async def delete_user(username, access_token=None):
 
 async def assign_client_role(payload, user_id: str, access_token=None):
     try:
-        headers, _ = await obtain_headers()
-        async with httpx.AsyncClient() as client:
+        headers, _ = await obtain_headers(access_token)
+        async with keycloak_client() as client:
             response = await client.post(
                 base_url + ep_assign_client_role.replace("[ENTER_USER_ID]", user_id), 
                 json=payload, headers=headers
@@ -389,8 +394,8 @@ async def assign_client_role(payload, user_id: str, access_token=None):
 
 
 async def remove_client_role(payload, user_id: str, access_token=None):
-    headers, _ = await obtain_headers()
-    async with httpx.AsyncClient() as client:
+    headers, _ = await obtain_headers(access_token)
+    async with keycloak_client() as client:
         response = await client.request("DELETE",
             base_url + ep_assign_client_role.replace("[ENTER_USER_ID]", user_id), 
             json=payload, headers=headers
@@ -401,15 +406,15 @@ async def remove_client_role(payload, user_id: str, access_token=None):
 
 async def get_user_roles(user_id: str, access_token=None):
     try:
-        headers, _ = await obtain_headers()
-        roles = (await get_user_role_details(user_id)).json()
+        roles = (await get_user_role_details(user_id, access_token)).json()
         role_names = [role.get("name") for role in roles]
-        print("role_names:", role_names)
+        logger.debug("user roles", extra={"user_id": user_id, "roles": role_names})
         return role_names
     except Exception as e:
         raise e from e
 
 
+@coalesced_read()
 async def retrieve_user_details(username, access_token=None):
     try:
         headers, _ = await obtain_headers(access_token)
@@ -417,7 +422,7 @@ async def retrieve_user_details(username, access_token=None):
         "username": username,
         "exact": True
         }
-        async with httpx.AsyncClient() as client:
+        async with keycloak_client() as client:
             response = await client.get(base_url + ep_retrieve_user, params=query_params, headers=headers)
         return response
     except Exception as e:
@@ -441,7 +446,7 @@ async def reset_password(payload, user_id=None, access_token=None):
         # Remove username from payload before sending to Keycloak
         payload = {k: v for k, v in payload.items() if k != "username"}
     headers, _ = await obtain_headers(access_token)
-    async with httpx.AsyncClient() as client:
+    async with keycloak_client() as client:
         response = await client.put(
             base_url + ep_reset_password.replace("[ENTER_USER_ID]", user_id),
             json=payload, headers=headers
@@ -452,7 +457,7 @@ async def reset_password(payload, user_id=None, access_token=None):
 async def forgot_password(user_id, access_token=None):
     headers, _ = await obtain_headers(access_token)
     payload = ["UPDATE_PASSWORD"]
-    async with httpx.AsyncClient() as client:
+    async with keycloak_client() as client:
         response = await client.put(
             base_url + ep_forgot_password.replace("[ENTER_USER_ID]", user_id), 
             json=payload, headers=headers
@@ -461,20 +466,27 @@ async def forgot_password(user_id, access_token=None):
     return response
 
 
-async def update_user_details(payload, user_id, access_token=None):
+async def update_user_details(payload, user_id, access_token=None, username=None):
     headers, _ = await obtain_headers(access_token)
-    async with httpx.AsyncClient() as client:
+    async with keycloak_client() as client:
         response = await client.put(
             base_url + ep_update_user_details.replace("[ENTER_USER_ID]", user_id), 
             json=payload, headers=headers
             )
+    # retrieve_user_details is keyed by username: drop only this user's lookups when it is known
+    if username is None:
+        invalidate_cached_read("retrieve_user_details")
+    for name in {username, payload.get("username")} - {None}:
+        invalidate_cached_read("retrieve_user_details", username=name)
+    if username is None or "username" in payload:
+        user_directory.forget(user_id)
 
     return response
 
 
 async def logout_user(user_id, access_token=None):
     headers, _ = await obtain_headers(access_token)
-    async with httpx.AsyncClient() as client:
+    async with keycloak_client() as client:
         response = await client.post(
             base_url + ep_logout_user.replace("[ENTER_USER_ID]", user_id), 
             headers=headers
@@ -483,29 +495,41 @@ async def logout_user(user_id, access_token=None):
     return response
 
 
+USERS_STATUS_CONCURRENCY = 10  # users whose sessions / roles are looked up in parallel
+
+
 async def users_status(access_token=None):
-    all_users = (await get_all_users()).json()
-    print("all_users:", all_users)
-    user_ids = [user.get("id") for user in all_users]
-    usernames = [user.get("username") for user in all_users]
-    full_names = [user.get("firstName") + " " + user.get("lastName") for user in all_users]
-    emails = [user.get("email") for user in all_users]
-    enabled_statuses = [user.get("enabled", True) for user in all_users]  # Default to True if not present
+    _, access_token = await obtain_headers(access_token)
+    semaphore = asyncio.Semaphore(USERS_STATUS_CONCURRENCY)
     
-    details = {}
-    for i, id in enumerate(user_ids):
-        active_sessions = (await check_user_active(id)).json()
+    async def user_status(user):
+        async with semaphore:
+            active_sessions_response, user_roles = await asyncio.gather(
+                check_user_active(user.get("id"), access_token),
+                get_user_roles(user.get("id"), access_token)
+            )
+        active_sessions = active_sessions_response.json()
         session_status = "active" if (len(active_sessions)>0) else "inactive"
-        user_roles = await get_user_roles(id)
         role_name = user_roles[0] if user_roles else ""
-        details[usernames[i]] = {
-            "full_name": full_names[i],
-            "email": emails[i], 
+        return user.get("username"), {
+            "full_name": f"{user.get('firstName') or ''} {user.get('lastName') or ''}".strip(),
+            "email": user.get("email"), 
             "role": role_name, 
             "session_status": session_status,
-            "enabled": enabled_statuses[i]
+            "enabled": user.get("enabled", True)  # Default to True if not present
         }
     
+    # Users are processed page by page while the next page is being fetched
+    details = {}
+    page = []
+    async for user in iter_users(access_token):
+        page.append(user_status(user))
+        if len(page) >= KEYCLOAK_PAGE_SIZE:
+            details.update(await asyncio.gather(*page))
+            page = []
+    if page:
+        details.update(await asyncio.gather(*page))
+    
     return details
 
 async def toggle_user_status(username: str, action: str, access_token=None):
@@ -550,7 +574,7 @@ async def toggle_user_status(username: str, action: str, access_token=None):
         }
         
         # Update user status
-        response = await update_user_details(payload, user_id, access_token)
+        response = await update_user_details(payload, user_id, access_token, username=username)
         
         if response.status_code in [200, 201, 204]:
             status_text = "enabled" if enabled else "disabled"
@@ -578,6 +602,10 @@ async def get_login_events(username: str = None, access_token=None):
         list: List of dictionaries containing username and timestamp pairs
     """
     try:
+        from datetime import datetime, timedelta
+        
+        _, access_token = await obtain_headers(access_token)
+        user_id = None
         if username:
             # Get login events for specific user
             # Get user details to extract user ID
@@ -594,88 +622,33 @@ async def get_login_events(username: str = None, access_token=None):
             user_id = user_data[0].get("id")
             if not user_id:
                 raise HTTPException(status_code=500, detail="User ID not found in user data")
-            
-            # Get LOGIN events for the user
-            events_response = await get_events(user_id=user_id, event_type="LOGIN", access_token=access_token)
-        else:
-            # Get login events for all users
-            events_response = await get_events(event_type="LOGIN", access_token=access_token)
         
-        if events_response.status_code != 200:
-            raise HTTPException(status_code=events_response.status_code, 
-                              detail=f"Failed to retrieve events: {events_response.text}")
+        # Calculate 24 hours ago timestamp in milliseconds
+        now = datetime.now()
+        twenty_four_hours_ago = now - timedelta(hours=24)
+        cutoff_timestamp = int(twenty_four_hours_ago.timestamp() * 1000)
         
-        events_data = events_response.json()
+        # Incremental local copy of LOGIN events: only events newer than the last poll are fetched
+        await login_event_store.sync(cutoff_timestamp, access_token)
+        recent_events = await asyncio.to_thread(login_event_store.query, cutoff_timestamp, user_id=user_id)
         
         if username:
-            # For specific user - filter events from past 24 hours
-            from datetime import datetime, timedelta
-            
-            # Calculate 24 hours ago timestamp in milliseconds
-            now = datetime.now()
-            twenty_four_hours_ago = now - timedelta(hours=24)
-            cutoff_timestamp = int(twenty_four_hours_ago.timestamp() * 1000)
-            
-            # Filter events from past 24 hours
-            recent_timestamps = [event.get("time") for event in events_data 
-                               if event.get("time") and event.get("time") >= cutoff_timestamp]
-            recent_timestamps.sort()  # Sort in chronological order (oldest to newest)
-            
-            # Convert timestamps to ISO format
-            formatted_timestamps = []
-            for timestamp in recent_timestamps:
-                dt = datetime.fromtimestamp(timestamp / 1000)
-                iso_format = dt.strftime('%Y-%m-%dT%H:%M:%S')
-                formatted_timestamps.append(iso_format)
-            
-            # Format response as list of dictionaries with username and timestamp pairs
-            response_list = []
-            for timestamp in formatted_timestamps:
-                response_list.append({username: timestamp})
-            
-            return response_list
+            user_id_to_username = {user_id: username}
         else:
-            # For all users - collect all events from past 24 hours
-            from datetime import datetime, timedelta
-            
-            # Calculate 24 hours ago timestamp in milliseconds
-            now = datetime.now()
-            twenty_four_hours_ago = now - timedelta(hours=24)
-            cutoff_timestamp = int(twenty_four_hours_ago.timestamp() * 1000)
-            
-            # Get all users to map user IDs to usernames
-            all_users_response = await get_all_users(access_token)
-            if all_users_response.status_code != 200:
-                raise HTTPException(status_code=all_users_response.status_code, 
-                                  detail=f"Failed to retrieve users: {all_users_response.text}")
-            
-            all_users = all_users_response.json()
-            user_id_to_username = {user.get("id"): user.get("username") for user in all_users if user.get("id") and user.get("username")}
-            
-            # Collect all events from past 24 hours with usernames and timestamps
-            all_events = []
-            for event in events_data:
-                if (event.get("time") and event.get("userId") and 
-                    event.get("time") >= cutoff_timestamp):
-                    user_id = event.get("userId")
-                    username = user_id_to_username.get(user_id)
-                    if username:  # Only include if username is found
-                        all_events.append({
-                            "username": username,
-                            "timestamp": event.get("time")
-                        })
-            
-            # Sort all events chronologically (oldest to newest)
-            all_events.sort(key=lambda x: x["timestamp"])
-            
-            # Convert to required format and convert timestamps to ISO format
-            response_list = []
-            for event in all_events:
-                dt = datetime.fromtimestamp(event["timestamp"] / 1000)
-                iso_format = dt.strftime('%Y-%m-%dT%H:%M:%S')
-                response_list.append({event["username"]: iso_format})
-            
-            return response_list
+            # Map user IDs to usernames from the cached user directory
+            user_id_to_username = await user_directory.resolve(
+                {event_user_id for _, event_user_id in recent_events}, access_token
+            )
+        
+        # Format response as list of dictionaries with username and ISO timestamp pairs
+        response_list = []
+        for timestamp, event_user_id in recent_events:
+            event_username = username or user_id_to_username.get(event_user_id)
+            if event_username:  # Only include if username is found
+                dt = datetime.fromtimestamp(timestamp / 1000)
+                response_list.append({event_username: dt.strftime('%Y-%m-%dT%H:%M:%S')})
+        
+        return response_list
     
     except Exception as e:
         if isinstance(e, HTTPException):
@@ -776,6 +749,7 @@ async def create_resource_api(payload: dict, access_token=None):
         
         # Create the resource
         response = await create_resource(resource_payload, access_token)
+        resource_index.mark_stale()
         
         return response
         
@@ -783,4 +757,183 @@ async def create_resource_api(payload: dict, access_token=None):
         if isinstance(e, HTTPException):
             raise e
         else:
-            raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+            raise HTTPException(status_code=500, detail=str(e))
+
+
+PERMISSION_BATCH_CONCURRENCY = 8  # users updated in parallel by batch_update_permissions
+
+
+def _merge_permission_changes(changes: list):
+    """Validate the batch and merge entries per username (later entries extend earlier ones)"""
+    merged = {}
+    for change in changes:
+        if not isinstance(change, dict) or not change.get("username"):
+            raise HTTPException(status_code=400, detail=f"Each change needs a 'username'. Found: {change}")
+        entry = merged.setdefault(change["username"], {"add": {}, "remove": []})
+        for resource_info in change.get("add") or []:
+            # "add" accepts resource names or {"name", "type"} objects (typed resources are created if missing)
+            if isinstance(resource_info, str):
+                entry["add"].setdefault(resource_info, None)
+            elif isinstance(resource_info, dict) and resource_info.get("name"):
+                entry["add"][resource_info["name"]] = resource_info.get("type")
+            else:
+                raise HTTPException(status_code=400, detail=f"Invalid resource in 'add': {resource_info}")
+        for resource_name in change.get("remove") or []:
+            if not isinstance(resource_name, str):
+                raise HTTPException(status_code=400, detail=f"Invalid resource name in 'remove': {resource_name}")
+            entry["remove"].append(resource_name)
+    return merged
+
+
+async def batch_update_permissions(changes: list, access_token=None):
+    """
+    Apply many (username, add, remove) permission edits in one pass.
+    
+    Expected changes:
+    [
+        {"username": "user@example.com", "add": ["docs", {"name": "new/dir", "type": "dir"}], "remove": ["old"]},
+        ...
+    ]
+    
+    The permission and policy tables are listed once and indexed by name, resource names are
+    resolved through the local resource index, and each user's permission is then read,
+    diffed locally and written back (one PUT, skipped when nothing changes) concurrently.
+    
+    Returns:
+        dict: username -> {"status", "added", "removed", "not_found", "error"}
+    """
+    merged = _merge_permission_changes(changes)
+    if not merged:
+        return {}
+
+    headers, access_token = await obtain_headers(access_token)
+
+    async with keycloak_client(timeout=30.0) as client:
+        # One (paginated) listing of permissions and policies for the whole batch
+        async def index_by_name(items):
+            return {item.get("name"): item async for item in items if item}
+
+        permissions_by_name, policies_by_name = await asyncio.gather(
+            index_by_name(iter_permissions(access_token)),
+            index_by_name(iter_paginated(ep_retrieve_policy, access_token=access_token))
+        )
+
+        # Resolve every referenced resource once; create typed resources that do not exist yet
+        all_names = set()
+        for entry in merged.values():
+            all_names.update(entry["add"])
+            all_names.update(entry["remove"])
+        resolved = await resource_index.resolve(sorted(all_names), access_token)
+        to_create = {}
+        for entry in merged.values():
+            for name, resource_type in entry["add"].items():
+                if resolved.get(name) is None and resource_type:
+                    to_create[name] = resource_type
+        if to_create:
+            _, create_failed = await create_resources(to_create, access_token)
+            if create_failed:
+                logger.error("batch_update_permissions: failed to create resources", extra={"failed": create_failed})
+            resolved.update(await resource_index.resolve(sorted(to_create), access_token))
+
+        semaphore = asyncio.Semaphore(PERMISSION_BATCH_CONCURRENCY)
+
+        async def update_user(username, entry):
+            result = {"status": "unchanged", "added": [], "removed": [], "not_found": [], "error": None}
+            add_ids, remove_ids = {}, {}
+            for name in entry["add"]:
+                if resolved.get(name) is None:
+                    result["not_found"].append(name)
+                else:
+                    add_ids[resolved[name]["_id"]] = name
+            for name in entry["remove"]:
+                if resolved.get(name) is None:
+                    result["not_found"].append(name)
+                else:
+                    remove_ids[resolved[name]["_id"]] = name
+
+            async with semaphore:
+                try:
+                    policy = policies_by_name.get(f"policy_user_{username}")
+                    if not policy:
+                        if not add_ids:
+                            return username, result
+                        user_details_response = await client.get(
+                            base_url + ep_retrieve_user, params={"username": username, "exact": True}, headers=headers
+                        )
+                        user_details = user_details_response.json() if user_details_response.status_code == 200 else []
+                        if not user_details or not user_details[0].get("id"):
+                            raise Exception(f"User {username} not found")
+                        policy_response = await client.post(
+                            base_url + ep_create_user_policy,
+                            json={"name": f"policy_user_{username}", "description": "",
+                                  "users": [user_details[0]["id"]], "logic": "POSITIVE"},
+                            headers=headers
+                        )
+                        if policy_response.status_code not in [200, 201, 204]:
+                            raise Exception(f"Failed to create user policy for {username}: {policy_response.text}")
+                        policy = policy_response.json()
+
+                    permission_name = f"permission_user_{username}"
+                    permission = permissions_by_name.get(permission_name)
+                    if not permission:
+                        if not add_ids:
+                            return username, result
+                        response = await client.post(
+                            base_url + ep_create_permission,
+                            json={"resources": list(add_ids), "policies": [policy.get("id")], "name": permission_name,
+                                  "description": "", "decisionStrategy": "UNANIMOUS"},
+                            headers=headers
+                        )
+                        if response.status_code not in [200, 201, 204]:
+                            raise Exception(f"Failed to create permission for {username}: {response.text}")
+                        result.update(status="created", added=sorted(add_ids.values()))
+                        return username, result
+
+                    permission_id = permission.get("id")
+                    resources_response = await client.get(
+                        base_url + ep_resources_in_permission.replace("[ENTER_PERMISSION_ID]", permission_id),
+                        headers=headers
+                    )
+                    if resources_response.status_code != 200:
+                        raise Exception(f"Failed to get resources in permission: {resources_response.text}")
+                    current_ids = [resource.get("_id") for resource in resources_response.json() or [] if resource]
+
+                    # Diff locally; removals win over additions of the same resource
+                    updated_ids = [resource_id for resource_id in current_ids if resource_id not in remove_ids]
+                    added = [resource_id for resource_id in add_ids
+                             if resource_id not in current_ids and resource_id not in remove_ids]
+                    updated_ids.extend(added)
+                    removed = [resource_id for resource_id in current_ids if resource_id in remove_ids]
+                    if not added and not removed:
+                        return username, result
+
+                    update_payload = {
+                        "id": permission_id,
+                        "name": permission_name,
+                        "description": "",
+                        "type": "resource",
+                        "logic": "POSITIVE",
+                        "decisionStrategy": "UNANIMOUS",
+                        "resources": updated_ids,
+                        "policies": [policy.get("id")],
+                        "scopes": []
+                    }
+                    response = await client.put(
+                        base_url + ep_update_permission.replace("[ENTER_PERMISSION_ID]", permission_id),
+                        json=update_payload, headers=headers
+                    )
+                    if response.status_code not in [200, 201, 204]:
+                        raise Exception(f"Failed to update permission for {username}: {response.text}")
+                    result.update(
+                        status="updated",
+                        added=sorted(add_ids[resource_id] for resource_id in added),
+                        removed=sorted(remove_ids[resource_id] for resource_id in removed)
+                    )
+                except Exception as e:
+                    result.update(status="error", error=str(e))
+            return username, result
+
+        results = await asyncio.gather(*(update_user(username, entry) for username, entry in merged.items()))
+        invalidate_cached_read("find_permission")
+
+    return dict(results)
@@ -0,0 +1,192 @@
+import os
+import sqlite3
+import asyncio
+import threading
+import time
+import datetime
+from pathlib import Path
+
+from routers.utils.misc_logging_utils import get_logger
+
+
+logger = get_logger(__name__)
+
+
+ACCESS_LOG_DB = os.path.join("data", "access_history.sqlite3")
+RECENT_FILES_DEFAULT_LIMIT = 10
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_access (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    user_id TEXT NOT NULL,
+    username TEXT,
+    file_path TEXT NOT NULL,
+    action TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_file_access_user ON file_access(user_id, ts);
+CREATE INDEX IF NOT EXISTS idx_file_access_file ON file_access(file_path, ts);
+
+CREATE TABLE IF NOT EXISTS user_recent (
+    user_id TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    last_ts REAL NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (user_id, file_path)
+);
+CREATE INDEX IF NOT EXISTS idx_user_recent_ts ON user_recent(user_id, last_ts);
+CREATE INDEX IF NOT EXISTS idx_user_recent_file ON user_recent(file_path);
+
+CREATE TABLE IF NOT EXISTS file_stats (
+    file_path TEXT PRIMARY KEY,
+    downloads INTEGER NOT NULL,
+    first_ts REAL NOT NULL,
+    last_ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_file_stats_downloads ON file_stats(downloads);
+
+CREATE TABLE IF NOT EXISTS file_daily (
+    day TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, file_path)
+);
+"""
+
+
+def normalize_file_path(path: str) -> str:
+    """Same relative form that Keycloak resources use, e.g. 'docs/report.pdf'"""
+    return str(Path(path.lstrip("/\\")).as_posix())
+
+
+def _iso(ts):
+    return datetime.datetime.fromtimestamp(ts, tz=datetime.timezone.utc).isoformat()
+
+
+class AccessLog:
+    """
+    Local append-only log of file accesses, stored in SQLite.
+
+    Every access is appended to `file_access`. The per-user (`user_recent`), per-file
+    (`file_stats`) and per-day (`file_daily`) tables are maintained in the same
+    transaction, so reads are index lookups that never touch the full log.
+    The methods block on SQLite; from the event loop, call them through a thread.
+    """
+
+    def __init__(self, db_path=ACCESS_LOG_DB):
+        self.db_path = db_path
+        self._conn = None
+        self._lock = threading.Lock()
+        self._pending = set()   # background record() tasks, referenced until done
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def record(self, user_id: str, username: str, file_path: str, action: str = "download", ts: float = None):
+        ts = ts if ts is not None else time.time()
+        file_path = normalize_file_path(file_path)
+        day = datetime.datetime.fromtimestamp(ts, tz=datetime.timezone.utc).strftime("%Y-%m-%d")
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN")
+            try:
+                conn.execute(
+                    "INSERT INTO file_access (ts, user_id, username, file_path, action) VALUES (?, ?, ?, ?, ?)",
+                    (ts, user_id, username, file_path, action)
+                )
+                conn.execute(
+                    """INSERT INTO user_recent (user_id, file_path, last_ts, count) VALUES (?, ?, ?, 1)
+                       ON CONFLICT(user_id, file_path) DO UPDATE SET last_ts = excluded.last_ts, count = count + 1""",
+                    (user_id, file_path, ts)
+                )
+                conn.execute(
+                    """INSERT INTO file_stats (file_path, downloads, first_ts, last_ts) VALUES (?, 1, ?, ?)
+                       ON CONFLICT(file_path) DO UPDATE SET downloads = downloads + 1, last_ts = excluded.last_ts""",
+                    (file_path, ts, ts)
+                )
+                conn.execute(
+                    """INSERT INTO file_daily (day, file_path, count) VALUES (?, ?, 1)
+                       ON CONFLICT(day, file_path) DO UPDATE SET count = count + 1""",
+                    (day, file_path)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def record_in_background(self, user_id: str, username: str, file_path: str, action: str = "download"):
+        """record() in a worker thread, so the commit never runs on the event loop. Never raises."""
+        task = asyncio.get_running_loop().create_task(
+            asyncio.to_thread(self.record, user_id, username, file_path, action, time.time())
+        )
+        self._pending.add(task)
+        task.add_done_callback(self._record_done)
+
+    def _record_done(self, task):
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Error recording file access", exc_info=task.exception())
+
+    def recent_files(self, user_id: str, limit: int = RECENT_FILES_DEFAULT_LIMIT):
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT file_path, last_ts, count FROM user_recent WHERE user_id = ? ORDER BY last_ts DESC LIMIT ?",
+                (user_id, limit)
+            ).fetchall()
+        return [{"path": path, "last_accessed": _iso(ts), "access_count": count} for path, ts, count in rows]
+
+    def file_stats(self, file_path: str, days: int = 30):
+        file_path = normalize_file_path(file_path)
+        since_day = (datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(days=days)).strftime("%Y-%m-%d")
+        with self._lock:
+            conn = self._connection()
+            stats = conn.execute(
+                "SELECT downloads, first_ts, last_ts FROM file_stats WHERE file_path = ?", (file_path,)
+            ).fetchone()
+            unique_users = conn.execute(
+                "SELECT COUNT(DISTINCT user_id) FROM user_recent WHERE file_path = ?", (file_path,)
+            ).fetchone()[0]
+            daily = conn.execute(
+                "SELECT day, count FROM file_daily WHERE file_path = ? AND day >= ? ORDER BY day",
+                (file_path, since_day)
+            ).fetchall()
+        if not stats:
+            return {"path": file_path, "downloads": 0, "unique_users": 0,
+                    "first_accessed": None, "last_accessed": None, "daily": []}
+        downloads, first_ts, last_ts = stats
+        return {
+            "path": file_path,
+            "downloads": downloads,
+            "unique_users": unique_users,
+            "first_accessed": _iso(first_ts),
+            "last_accessed": _iso(last_ts),
+            "daily": [{"day": day, "downloads": count} for day, count in daily]
+        }
+
+    def most_downloaded(self, limit: int = 20, offset: int = 0):
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT file_path, downloads, last_ts FROM file_stats ORDER BY downloads DESC, file_path LIMIT ? OFFSET ?",
+                (limit, offset)
+            ).fetchall()
+        return [{"path": path, "downloads": downloads, "last_accessed": _iso(ts)} for path, downloads, ts in rows]
+
+    def trending(self, days: int = 7, limit: int = 20, offset: int = 0):
+        since_day = (datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(days=days)).strftime("%Y-%m-%d")
+        with self._lock:
+            rows = self._connection().execute(
+                """SELECT file_path, SUM(count) AS downloads FROM file_daily WHERE day >= ?
+                   GROUP BY file_path ORDER BY downloads DESC, file_path LIMIT ? OFFSET ?""",
+                (since_day, limit, offset)
+            ).fetchall()
+        return [{"path": path, "downloads": downloads} for path, downloads in rows]
+
+
+access_log = AccessLog()
@@ -0,0 +1,118 @@
+import asyncio
+import datetime
+import traceback
+from collections import deque
+
+from routers.utils.misc_keycloak_utils import obtain_headers
+from routers.utils.misc_files_utils import update_user_recent_files_attribute
+from routers.utils.misc_logging_utils import get_logger
+
+
+logger = get_logger(__name__)
+
+
+ACTIVITY_QUEUE_MAX_EVENTS = 5000  # oldest events are dropped beyond this
+ACTIVITY_FLUSH_INTERVAL = 5.0     # seconds between batched Keycloak updates
+ACTIVITY_FLUSH_THRESHOLD = 500    # queue length that triggers an early flush
+ACTIVITY_MAX_CONCURRENT_UPDATES = 5
+
+# Recent files are served from the local access log (misc_access_log_utils). Set to True only
+# while older clients still read the Keycloak 'recent_files' user attribute: every download then
+# costs a user lookup and a user update in Keycloak.
+KEYCLOAK_RECENT_FILES_ENABLED = False
+
+
+class ActivityPipeline:
+    """
+    In-process queue of file access events (downloads) that are flushed to Keycloak
+    in the background, so the request that produced the event never waits on Keycloak.
+
+    - enqueue() is non-blocking; when the queue is full the oldest event is dropped
+    - events are coalesced per user, so a flush costs one lookup + one update per user
+    - a flush is triggered every ACTIVITY_FLUSH_INTERVAL seconds, or early when the
+      queue reaches ACTIVITY_FLUSH_THRESHOLD events
+    """
+
+    def __init__(self, max_events=ACTIVITY_QUEUE_MAX_EVENTS, flush_interval=ACTIVITY_FLUSH_INTERVAL,
+                 flush_threshold=ACTIVITY_FLUSH_THRESHOLD, max_concurrent=ACTIVITY_MAX_CONCURRENT_UPDATES):
+        self.events = deque(maxlen=max_events)
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.max_concurrent = max_concurrent
+        self.dropped_events = 0
+        self._wakeup = None
+        self._task = None
+
+    def enqueue(self, user_id: str, username: str, file_path: str):
+        """Record a file access. Never blocks and never raises into the caller."""
+        if len(self.events) == self.events.maxlen:
+            self.dropped_events += 1  # deque(maxlen) drops the oldest event on append
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.events.append((user_id, username, file_path, timestamp))
+        if self._wakeup is not None and len(self.events) >= self.flush_threshold:
+            self._wakeup.set()
+
+    async def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Flush whatever is left before shutting down
+        try:
+            await self.flush()
+        except Exception:
+            logger.error("activity pipeline final flush failed", exc_info=True)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.error("activity pipeline flush failed", exc_info=True)
+
+    def _drain(self):
+        """Pop all queued events and coalesce them per user (latest timestamp per file wins)."""
+        batched = {}
+        while self.events:
+            user_id, username, file_path, timestamp = self.events.popleft()
+            entry = batched.setdefault(user_id, {"username": username, "files": {}})
+            entry["files"][file_path] = timestamp
+        return batched
+
+    async def flush(self):
+        batched = self._drain()
+        if not batched:
+            return
+
+        # One token for the whole batch instead of one per Keycloak call
+        try:
+            _, access_token = await obtain_headers()
+        except Exception:
+            # Keycloak unreachable: put the events back (still subject to drop-oldest)
+            for user_id, entry in batched.items():
+                for file_path, timestamp in entry["files"].items():
+                    self.events.appendleft((user_id, entry["username"], file_path, timestamp))
+            raise
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+
+        async def update_user(user_id, entry):
+            async with semaphore:
+                await update_user_recent_files_attribute(user_id, entry["username"], entry["files"], access_token)
+
+        await asyncio.gather(*(update_user(user_id, entry) for user_id, entry in batched.items()))
+
+
+activity_pipeline = ActivityPipeline()
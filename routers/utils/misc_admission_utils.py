@@ -0,0 +1,155 @@
+import heapq
+import asyncio
+import itertools
+import time
+
+from fastapi import HTTPException
+
+from routers.utils.misc_metrics_utils import (
+    admission_in_flight, admission_queue_depth, admission_wait_seconds, admission_rejected_total
+)
+from routers.utils.misc_tracing_utils import span
+from routers.utils.misc_logging_utils import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# cost class -> (requests handled at once, requests allowed to wait)
+ADMISSION_CLASSES = {
+    "render": (2, 16),       # PyMuPDF page rendering and text extraction
+    "convert": (1, 4),       # DOCX/XLSX/PPTX conversion (unoconv, openpyxl, python-pptx)
+    "scan": (2, 8),          # filesystem walks and whole-document searches
+    "metadata": (32, 256),   # directory listings, *_info, access statistics
+}
+ADMISSION_RETRY_AFTER_MIN = 1     # seconds
+ADMISSION_RETRY_AFTER_MAX = 30
+ADMISSION_SERVICE_TIME_ALPHA = 0.2  # weight of the latest request in the service time average
+
+PRIORITY_VISIBLE = 0
+PRIORITY_PREFETCH = 1
+PRIORITY_NAMES = {PRIORITY_VISIBLE: "visible", PRIORITY_PREFETCH: "prefetch"}
+
+
+def request_priority(headers) -> int:
+    """
+    Prefetch requests are marked by the viewer with `X-Prefetch: 1`; the standard
+    `Sec-Purpose: prefetch` / `Purpose: prefetch` headers are honoured as well.
+    """
+    if headers.get("x-prefetch", "").strip().lower() in ("1", "true", "yes"):
+        return PRIORITY_PREFETCH
+    purpose = headers.get("sec-purpose") or headers.get("purpose") or ""
+    if "prefetch" in purpose.lower():
+        return PRIORITY_PREFETCH
+    return PRIORITY_VISIBLE
+
+
+class CostClassQueue:
+    """
+    Bounded concurrency + bounded priority queue for one cost class. Waiters are served
+    by priority, then arrival order. When the queue is full a visible request evicts
+    the newest queued prefetch request; otherwise it is refused with a 429.
+    """
+
+    def __init__(self, name, concurrency, queue_size):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.active = 0
+        self.service_time = 0.5     # seconds, moving average
+        self._waiters = []          # heap of [priority, seq, future]
+        self._queued = 0
+        self._seq = itertools.count()
+
+    def retry_after(self) -> int:
+        """Time for the current queue to drain, as a whole number of seconds"""
+        estimate = (self._queued + self.active) * self.service_time / self.concurrency
+        return int(min(ADMISSION_RETRY_AFTER_MAX, max(ADMISSION_RETRY_AFTER_MIN, estimate + 0.5)))
+
+    def _reject(self, priority):
+        admission_rejected_total.inc(cost_class=self.name, priority=PRIORITY_NAMES[priority])
+        logger.warning("admission: %s queue full, request refused", self.name,
+                       extra={"queued": self._queued, "active": self.active})
+        return HTTPException(status_code=429, detail=f"Server busy ({self.name}), retry later",
+                             headers={"Retry-After": str(self.retry_after())})
+
+    def _evict_prefetch(self) -> bool:
+        newest = None
+        for entry in self._waiters:
+            if entry[2] is not None and entry[0] == PRIORITY_PREFETCH and (newest is None or entry[1] > newest[1]):
+                newest = entry
+        if newest is None:
+            return False
+        future, newest[2] = newest[2], None     # lazily removed from the heap
+        self._queued -= 1
+        future.set_exception(self._reject(PRIORITY_PREFETCH))
+        return True
+
+    async def acquire(self, priority):
+        if self.active < self.concurrency and not self._queued:
+            self.active += 1
+            return
+        if self._queued >= self.queue_size:
+            if priority == PRIORITY_PREFETCH or not self._evict_prefetch():
+                raise self._reject(priority)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._seq), future]
+        heapq.heappush(self._waiters, entry)
+        self._queued += 1
+        admission_queue_depth.set(self._queued, cost_class=self.name)
+        try:
+            await future
+        except asyncio.CancelledError:
+            # client went away while queued; hand the slot on if it had just been granted
+            if entry[2] is not None:
+                entry[2] = None
+                self._queued -= 1
+            elif future.done() and not future.cancelled() and future.exception() is None:
+                self.release()
+            raise
+        finally:
+            admission_queue_depth.set(self._queued, cost_class=self.name)
+
+    def release(self):
+        while self._waiters:
+            entry = heapq.heappop(self._waiters)
+            future = entry[2]
+            if future is None or future.done():
+                continue
+            # the slot passes straight to the next waiter, active stays the same
+            entry[2] = None
+            self._queued -= 1
+            future.set_result(None)
+            return
+        self.active -= 1
+
+    def observe(self, seconds):
+        self.service_time += ADMISSION_SERVICE_TIME_ALPHA * (seconds - self.service_time)
+
+
+class AdmissionController:
+    def __init__(self, classes):
+        self.queues = {name: CostClassQueue(name, concurrency, queue_size)
+                       for name, (concurrency, queue_size) in classes.items()}
+
+    async def run(self, cost_class, priority, coro_fn, admitted=None):
+        """Run coro_fn() once admitted; admitted(), if given, is called when the wait is over"""
+        queue = self.queues[cost_class]
+        queued_at = time.perf_counter()
+        with span("admission.wait", cost_class=cost_class, priority=PRIORITY_NAMES[priority]):
+            await queue.acquire(priority)
+        if admitted is not None:
+            admitted()
+        started = time.perf_counter()
+        admission_wait_seconds.observe(started - queued_at, cost_class=cost_class)
+        admission_in_flight.inc(cost_class=cost_class)
+        try:
+            return await coro_fn()
+        finally:
+            admission_in_flight.dec(cost_class=cost_class)
+            queue.observe(time.perf_counter() - started)
+            queue.release()
+
+
+admission_controller = AdmissionController(ADMISSION_CLASSES)
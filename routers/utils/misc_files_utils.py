@@ -5,6 +5,14 @@ from pathlib import Path
 import datetime
 import shutil
 import traceback
+from functools import lru_cache
+
+from routers.utils.misc_permission_utils import compile_permissions
+from routers.utils.misc_tracing_utils import traced
+from routers.utils.misc_logging_utils import get_logger
+
+
+logger = get_logger(__name__)
 
 
 def _get_owner_windows(path: str) -> str:
@@ -123,39 +131,117 @@ def get_owner(path: str) -> str:
         return "UNKNOWN"
 
 
-def search_files_and_folders(root, query, case_sensitive=False):
+@lru_cache(maxsize=4096)
+def owner_name_from_uid(uid: int) -> str:
+    """uid -> user name, cached (the passwd lookup is the expensive part of Path.owner())"""
+    try:
+        import pwd
+        return pwd.getpwuid(uid).pw_name
+    except Exception:
+        return "UNKNOWN"
+
+
+@lru_cache(maxsize=4096)
+def _cached_windows_owner(path: str, mtime_ns: int) -> str:
+    return get_owner(path)
+
+
+def get_owner_cached(path: str, stat_result: os.stat_result = None) -> str:
+    """
+    Owner lookup with caching:
+    - On Unix-like: resolved from st_uid through the uid -> name cache.
+    - On Windows: the Win32 lookup is cached per (path, mtime).
+    """
+    try:
+        if stat_result is None:
+            stat_result = os.stat(path)
+        if os.name == "nt":
+            return _cached_windows_owner(path, stat_result.st_mtime_ns)
+        return owner_name_from_uid(stat_result.st_uid)
+    except Exception:
+        return "UNKNOWN"
+
+
+# Immediate child counts of directories, keyed by path and invalidated on directory mtime change
+_child_counts_cache = {}
+CHILD_COUNTS_CACHE_LIMIT = 50000
+
+
+def get_child_counts(dir_path: str, mtime_ns: int):
+    """
+    Return (num_files, num_subdirs) for the immediate children of dir_path.
+    Uses DirEntry type information (no per-child stat on most platforms) and is only
+    recomputed when the directory's mtime changes, i.e. when children are added/removed.
+    """
+    cached = _child_counts_cache.get(dir_path)
+    if cached and cached[0] == mtime_ns:
+        return cached[1]
+
+    num_files = 0
+    num_subdirs = 0
+    with os.scandir(dir_path) as it:
+        for child in it:
+            try:
+                if child.is_file():
+                    num_files += 1
+                elif child.is_dir():
+                    num_subdirs += 1
+            except OSError:
+                continue
+
+    if len(_child_counts_cache) >= CHILD_COUNTS_CACHE_LIMIT:
+        _child_counts_cache.clear()
+    _child_counts_cache[dir_path] = (mtime_ns, (num_files, num_subdirs))
+    return num_files, num_subdirs
+
+
+def walk_permitted(root, matcher=None):
+    """
+    os.walk over `root` limited to what `matcher` grants.
+    Subdirectories the caller can neither access nor browse through are pruned before
+    they are descended into, so unauthorized subtrees are never walked.
+
+    Yields (dirpath, dirnames, filenames, relative_dir, dir_allowed) where relative_dir is the
+    path relative to remote/ and dir_allowed means everything below dirpath is accessible.
+    """
+    base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        relative_dir = os.path.relpath(dirpath, base_dir).replace(os.sep, '/')
+        dir_allowed = matcher is None or matcher.is_allowed(relative_dir)
+        if not dir_allowed:
+            # Prune in place so os.walk skips whole subtrees
+            dirnames[:] = [
+                dirname for dirname in dirnames
+                if matcher.can_browse(dirname if relative_dir == '.' else f"{relative_dir}/{dirname}")
+            ]
+        yield dirpath, dirnames, filenames, relative_dir, dir_allowed
+
+
+def search_files_and_folders(root, query, case_sensitive=False, matcher=None):
     """
     Recursively search under `root` for any file or folder whose name contains `query`.
     Returns a list of full paths to matching files/folders.
     
     - root:      string path where search begins (e.g. "." or "C:\\Users\\...")
     - query:     substring to look for in file/folder names    - case_sensitive: if False (default), perform a case-insensitive match
+    - matcher:   optional PermissionMatcher; only permitted paths are returned and
+                 unauthorized subtrees are not walked
     """
     matches = []
     if not case_sensitive:
         query_lower = query.lower()
 
-    for dirpath, dirnames, filenames in os.walk(root):
-        # check folders
-        for dirname in dirnames:
-            name_to_check = dirname if case_sensitive else dirname.lower()
-            if (query in dirname) if case_sensitive else (query_lower in name_to_check):
-                found_path = os.path.join(dirpath, dirname)
-                base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
-                relative_path = os.path.relpath(found_path, base_dir)
-                # Convert backslashes to forward slashes for cross-platform compatibility
-                relative_path = relative_path.replace(os.sep, '/')
-                matches.append(relative_path)
-
-        # check files
-        for filename in filenames:
-            name_to_check = filename if case_sensitive else filename.lower()
-            if (query in filename) if case_sensitive else (query_lower in name_to_check):
-                found_path = os.path.join(dirpath, filename)
-                base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
-                relative_path = os.path.relpath(found_path, base_dir)
+    for dirpath, dirnames, filenames, relative_dir, dir_allowed in walk_permitted(root, matcher):
+        for names in (dirnames, filenames):
+            for name in names:
+                name_to_check = name if case_sensitive else name.lower()
+                if not ((query in name) if case_sensitive else (query_lower in name_to_check)):
+                    continue
                 # Convert backslashes to forward slashes for cross-platform compatibility
-                relative_path = relative_path.replace(os.sep, '/')
+                relative_path = name if relative_dir == '.' else f"{relative_dir}/{name}"
+                if not dir_allowed and not matcher.is_allowed(relative_path):
+                    continue
                 matches.append(relative_path)
 
     return matches
@@ -172,40 +258,29 @@ def has_hierarchical_permission(target_path, permissions, roles):
     
     Returns:
         bool: True if access is granted, False otherwise
-    """
     
+    Loops over many paths should compile the permissions once with compile_permissions()
+    and call matcher.is_allowed() directly.
+    """
+    return compile_permissions(permissions, roles).is_allowed(target_path)
+
+
+def can_access_directory(dir_path, perms, roles):
+    """
+    Modified directory-level permission check:
+    Allow access to a directory if:
+    1. User has direct permission to this directory, OR
+    2. User has permission to any subdirectory within this directory (for browsing)
+    """
     if "admin" in roles:
-        # If user has admin role, grant access to everything
+        logger.debug("admin role detected, granting access to all directories", extra={"sample_rate": 0.01})
         return True
     
-    # Normalize the target path
-    if target_path == '.':
-        target_path = ''
-    
-    for permission in permissions:
-        # Normalize permission path
-        if permission == '.':
-            permission = ''
-        
-        # Check exact match
-        if target_path == permission:
-            return True
-        
-        # Check if permission is a parent directory of target_path
-        if permission == '':  # Root permission grants access to everything
-            return True
-        elif target_path.startswith(permission + '/'):
-            return True
-        
-        # Check if target_path is within the permission directory
-        # This handles cases where permission might be 'docs' and target is 'docs/subfolder/file.txt'
-        if permission != '' and (target_path == permission or target_path.startswith(permission + '/')):
-            return True
-    
-    return False
+    return compile_permissions(perms, roles).can_browse(dir_path)
 
 
-async def dir_contents_details(abs_path: str, permissions: list, roles: list):
+@traced("fs.list_dir")
+async def dir_contents_details(abs_path: str, permissions: list, roles: list, counts: bool = True):
     try:
         # permissions
         base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
@@ -213,92 +288,57 @@ async def dir_contents_details(abs_path: str, permissions: list, roles: list):
         # print('relative_path:', relative_path)
         # print('permissions:', permissions)
         
-        # Modified directory-level permission check:
-        # Allow access to a directory if:
-        # 1. User has direct permission to this directory, OR
-        # 2. User has permission to any subdirectory within this directory (for browsing)
-        def can_access_directory(dir_path, perms, roles):
-            
-            if "admin" in roles:
-                print("admin role detected, granting access to all directories")
-                return True
-            
-            # Direct permission to this directory
-            if has_hierarchical_permission(dir_path, perms, roles):
-                return True
-            
-            # Check if user has permission to any subdirectory within this directory
-            # This allows browsing parent directories to reach permitted subdirectories
-            if dir_path == ".":  # Root directory case
-                for perm in perms:
-                    if perm != "." and not perm.startswith("../"):  # Any non-root permission means they need to browse root
-                        return True
-            else:
-                for perm in perms:
-                    if perm.startswith(dir_path + "/"):  # Permission to subdirectory
-                        return True
-            
-            return False
-        
         # Check if user can access this directory
         if not can_access_directory(relative_path, permissions, roles):
             return []  # Return empty list if no permission to access this directory
         
-        results = []
-        for entry in os.listdir(abs_path):
-            entry_relative_path = f"{relative_path}/{entry}" if relative_path != '.' else entry
-            # print('entry_relative_path:', entry_relative_path)
-            
-            # Use hierarchical permission checking
-            if not has_hierarchical_permission(entry_relative_path, permissions, roles):
-                continue
-            entry_path = os.path.join(abs_path, entry)
-            p = Path(entry_path)
-            try:
-                st = p.stat()
-                size_bytes = st.st_size
+        # Owner of the listed directory, resolved once per listing (cached across listings)
+        owner_name = get_owner_cached(abs_path)
+        matcher = compile_permissions(permissions, roles)
 
-                # Cross‐platform owner lookup
-                try:
-                    owner_name = get_owner(abs_path)
-                except Exception:
-                    # Fallback if owner() details not available
-                    owner_name = "UNKNOWN"
-
-                # Last‐modified as an ISO‐8601 string (UTC)
-                last_mod = datetime.datetime.fromtimestamp(
-                    st.st_mtime, tz=datetime.timezone.utc
-                )
-                last_mod_iso = last_mod.isoformat()
-                
-                num_files = 0
-                num_subdirs = 0
+        results = []
+        with os.scandir(abs_path) as it:
+            for entry in it:
+                entry_relative_path = f"{relative_path}/{entry.name}" if relative_path != '.' else entry.name
                 
-                if p.is_dir():
-                    try:
-                        # Count only immediate children (non‐recursive)
-                        for child in p.iterdir():
-                            if child.is_file():
-                                num_files += 1
-                            elif child.is_dir():
-                                num_subdirs += 1
-                    except Exception as inner_err:
-                        # If listing fails (permissions, etc.), log and leave counts at 0
-                        print(f"    ❗ couldn’t list contents of {entry_path}: {inner_err}")
-
-                results.append({
-                    "name": entry,
-                    "is_dir": p.is_dir(),
-                    "size_bytes": size_bytes,
-                    "owner": owner_name,
-                    "last_modified": last_mod_iso,
-                    "num_files": num_files,
-                    "num_subdirs": num_subdirs
-                })
-            except Exception as file_err:
-                # Skip entries that can’t be stat’d or owner() fails unexpectedly
-                print(f"  ❗ couldn’t process {entry_path}: {file_err}")
-                continue
+                # Use hierarchical permission checking
+                if not matcher.is_allowed(entry_relative_path):
+                    continue
+                try:
+                    # DirEntry caches its stat data; is_dir() usually needs no extra syscall
+                    st = entry.stat()
+                    is_dir = entry.is_dir()
+
+                    # Last‐modified as an ISO‐8601 string (UTC)
+                    last_mod = datetime.datetime.fromtimestamp(
+                        st.st_mtime, tz=datetime.timezone.utc
+                    )
+                    
+                    # Child counts cost a scandir per subdirectory (cached per mtime); callers may skip them
+                    num_files = 0 if counts else None
+                    num_subdirs = 0 if counts else None
+                    
+                    if is_dir and counts:
+                        try:
+                            # Count only immediate children (non‐recursive), cached per directory mtime
+                            num_files, num_subdirs = get_child_counts(entry.path, st.st_mtime_ns)
+                        except Exception as inner_err:
+                            # If listing fails (permissions, etc.), log and leave counts at 0
+                            logger.warning("couldn’t list contents of %s: %s", entry.path, inner_err)
+
+                    results.append({
+                        "name": entry.name,
+                        "is_dir": is_dir,
+                        "size_bytes": st.st_size,
+                        "owner": owner_name,
+                        "last_modified": last_mod.isoformat(),
+                        "num_files": num_files,
+                        "num_subdirs": num_subdirs
+                    })
+                except Exception as file_err:
+                    # Skip entries that can’t be stat’d
+                    logger.warning("couldn’t process %s: %s", entry.path, file_err)
+                    continue
         
         return results
     
@@ -357,7 +397,7 @@ async def process_directory_structure(structure, base_dir, current_path, file_ma
                     
                     uploaded_files.append(relative_file_location)
                 else:
-                    print(f"Warning: File {filename} specified in structure but not found in uploaded files")
+                    logger.warning("File %s specified in structure but not found in uploaded files", filename)
         
         # Process folders
         if "folders" in structure and structure["folders"]:
@@ -395,8 +435,7 @@ async def process_directory_structure(structure, base_dir, current_path, file_ma
                 )
                 
     except Exception as e:
-        tb_str = traceback.format_exc()
-        print(f"Error processing directory structure at path '{current_path}': {tb_str}")
+        logger.error("Error processing directory structure at path '%s'", current_path, exc_info=True)
         raise e
 
 
@@ -405,14 +444,29 @@ async def update_user_recent_file_attribute(user_id: str, username: str, file_pa
     Update the user's 'recent_files' attribute in Keycloak with the downloaded file path.
     Appends to existing recent_files list if it exists, otherwise creates a new list.
     """
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    await update_user_recent_files_attribute(user_id, username, {file_path: timestamp})
+
+
+async def update_user_recent_files_attribute(user_id: str, username: str, accessed_files: dict, access_token=None):
+    """
+    Merge several accessed files into the user's 'recent_files' attribute with a single
+    user lookup and a single user update.
+
+    Args:
+        user_id: Keycloak user id
+        username: Keycloak username used for the lookup
+        accessed_files: mapping of file path -> "%Y-%m-%d %H:%M:%S" access timestamp
+        access_token: optional token shared across a batch of updates
+    """
     from routers.utils.api_keycloak_utils import update_user_details, retrieve_user_details
     
     try:
         # First, retrieve current user details to get existing attributes
-        user_response = await retrieve_user_details(username)
+        user_response = await retrieve_user_details(username, access_token)
         
         if user_response.status_code not in [200, 201]:
-            print(f"Error retrieving user details from Keycloak: {user_response.status_code} - {user_response.text}")
+            logger.error("Error retrieving user details from Keycloak: %s - %s", user_response.status_code, user_response.text)
             return
             
         user_data = user_response.json()[0] if user_response.json() else {}
@@ -421,21 +475,18 @@ async def update_user_recent_file_attribute(user_id: str, username: str, file_pa
         # Get existing recent_files list or create new empty list
         recent_files = current_attributes.get("recent_files", [])
         
-        # Create timestamp and new entry with timestamp|file_path format
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        new_entry = f"{timestamp}|{file_path}"
+        # Remove any existing entry for these file paths (check by file path part after |)
+        recent_files = [entry for entry in recent_files if entry.split("|", 1)[-1] not in accessed_files]
         
-        # Remove any existing entry for this file path (check by file path part after |)
-        recent_files = [entry for entry in recent_files if not entry.endswith(f"|{file_path}")]
-        
-        # Append the new entry to the list
-        recent_files.append(new_entry)
+        # Append the new entries with timestamp|file_path format
+        for file_path, timestamp in accessed_files.items():
+            recent_files.append(f"{timestamp}|{file_path}")
         
         max_entries = 2
         if len(recent_files) > max_entries:
             # Sort by timestamp (first part before |) in chronological order
             recent_files.sort(key=lambda x: x.split('|')[0])
-            # Keep only the last 5 entries (most recent)
+            # Keep only the most recent entries
             recent_files = recent_files[-max_entries:]
         
         # Update the attributes with the new recent_files list
@@ -452,25 +503,27 @@ async def update_user_recent_file_attribute(user_id: str, username: str, file_pa
             "enabled": user_data.get("enabled", True),
             "attributes": updated_attributes
         }
-        print("/download_file endpoint: Updating user attributes in Keycloak:", payload)
+        logger.debug("updating recent_files attribute", extra={"user_id": user_id, "recent_files": len(recent_files)})
         # Update user attributes in Keycloak
-        response = await update_user_details(payload, user_id)
+        response = await update_user_details(payload, user_id, access_token, username=username)
         
         if response.status_code not in [200, 201, 204]:
-            print(f"Error updating user attributes in Keycloak: {response.status_code} - {response.text}")
+            logger.error("Error updating user attributes in Keycloak: %s - %s", response.status_code, response.text)
             
     except Exception as e:
         # Log the error but don't fail the download
-        print(f"Error updating user attributes in Keycloak for user {user_id}: {str(e)}")
+        logger.error("Error updating user attributes in Keycloak for user %s", user_id, exc_info=True)
 
 
-def scan_recently_modified_files(root_dir, cutoff_criteria=3):
+def scan_recently_modified_files(root_dir, cutoff_criteria=3, matcher=None):
     """
     Recursively scan directory structure to find files modified after a certain point.
     
     Args:
         root_dir: Root directory to start scanning from
         cutoff_criteria: Either an integer (days to look back) or a datetime object (cutoff timestamp)
+        matcher: Optional PermissionMatcher; files outside the caller's grants are skipped
+                 and unauthorized subtrees are not walked
     
     Returns:
         List of dictionaries containing file information:
@@ -501,9 +554,12 @@ def scan_recently_modified_files(root_dir, cutoff_criteria=3):
     try:
         base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
         
-        for dirpath, dirnames, filenames in os.walk(root_dir):
+        for dirpath, dirnames, filenames, relative_dir, dir_allowed in walk_permitted(root_dir, matcher):
             for filename in filenames:
                 file_path = os.path.join(dirpath, filename)
+                if not dir_allowed and not matcher.is_allowed(
+                        filename if relative_dir == '.' else f"{relative_dir}/{filename}"):
+                    continue
                 try:
                     # Get file statistics
                     st = os.stat(file_path)
@@ -529,11 +585,11 @@ def scan_recently_modified_files(root_dir, cutoff_criteria=3):
                         
                 except (OSError, PermissionError) as e:
                     # Skip files that can't be accessed
-                    print(f"Could not access file {file_path}: {e}")
+                    logger.warning("Could not access file %s: %s", file_path, e)
                     continue
     
     except Exception as e:
-        print(f"Error scanning directory {root_dir}: {e}")
+        logger.error("Error scanning directory %s", root_dir, exc_info=True)
         raise e
     
     # Sort by modification time (newest first)
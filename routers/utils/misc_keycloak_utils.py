@@ -1,9 +1,13 @@
 import jwt
+import copy
 import json
 import time
 import httpx
+import asyncio
+import inspect
 
 from functools import wraps
+from contextlib import aclosing
 from decouple import Config, RepositoryEnv
 from fastapi import HTTPException, Request, WebSocket
 from keycloak import KeycloakOpenID
@@ -12,11 +16,111 @@ from jwcrypto.jws import InvalidJWSObject, InvalidJWSSignature
 from datetime import datetime
 
 from routers.utils.keycloak_vars import *
+from routers.utils.misc_metrics_utils import InstrumentedTransport, record_cache
+from routers.utils.misc_logging_utils import get_logger
+
+
+logger = get_logger(__name__)
+
+
+KEYCLOAK_READ_CACHE_TTL = 5.0  # seconds a successful admin read is reused
+
+_read_cache = {}        # key -> (expires_at, result)
+_read_inflight = {}     # key -> asyncio.Task shared by concurrent identical calls
+_read_generation = {}   # function name -> bumped on invalidation, so in-flight reads don't cache stale data
+
+
+def _cacheable(result) -> bool:
+    """httpx.Response: only 200s. Plain values (parsed lookups, None for "not found") are cached as they are."""
+    if isinstance(result, httpx.Response):
+        return result.status_code == 200
+    return True
+
+
+def _shared(result):
+    """A Response is read-only for callers (.json() parses afresh); plain values are copied per caller"""
+    if isinstance(result, httpx.Response):
+        return result
+    return copy.deepcopy(result)
+
+
+def keycloak_client(limits: httpx.Limits = None, **kwargs) -> httpx.AsyncClient:
+    """httpx.AsyncClient for Keycloak calls; every request is timed in the keycloak_* metrics"""
+    transport = httpx.AsyncHTTPTransport(limits=limits or httpx.Limits())
+    return httpx.AsyncClient(transport=InstrumentedTransport(transport), **kwargs)
+
+
+def coalesced_read(ttl=KEYCLOAK_READ_CACHE_TTL):
+    """
+    Single-flight + short-TTL cache for idempotent Keycloak admin GETs.
+
+    Concurrent calls with identical arguments share one in-flight request, and the result
+    is reused for `ttl` seconds: a successful (200) httpx.Response, or any plain value.
+    access_token is not part of the key. Writes call invalidate_cached_read() for the reads
+    they affect. The shared httpx.Response must be treated as read-only (.json() returns a
+    fresh copy); plain values are deep-copied for every caller.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = (func.__name__,) + tuple(
+                (name, value) for name, value in bound.arguments.items() if name != "access_token"
+            )
+
+            cached = _read_cache.get(key)
+            if cached and cached[0] > time.monotonic():
+                record_cache("keycloak_read", True)
+                return _shared(cached[1])
+
+            task = _read_inflight.get(key)
+            # joining an in-flight request counts as a hit: no extra call goes to Keycloak
+            record_cache("keycloak_read", task is not None)
+            if task is None:
+                generation = _read_generation.get(func.__name__, 0)
+
+                def on_done(done_task):
+                    if _read_inflight.get(key) is done_task:
+                        del _read_inflight[key]
+                    if done_task.cancelled() or done_task.exception() is not None:
+                        return
+                    result = done_task.result()
+                    if _cacheable(result) and _read_generation.get(func.__name__, 0) == generation:
+                        _read_cache[key] = (time.monotonic() + ttl, result)
+
+                task = asyncio.ensure_future(func(*args, **kwargs))
+                task.add_done_callback(on_done)
+                _read_inflight[key] = task
+
+            # shield: one caller being cancelled must not cancel the request for the others
+            return _shared(await asyncio.shield(task))
+
+        return wrapper
+    return decorator
+
+
+def invalidate_cached_read(func_name: str, **arguments):
+    """
+    Drop cached results of a coalesced read. With arguments only the matching key is dropped
+    (e.g. invalidate_cached_read("retrieve_user_details", username=...)), otherwise every key
+    of that function.
+    """
+    _read_generation[func_name] = _read_generation.get(func_name, 0) + 1
+    for cache in (_read_cache, _read_inflight):
+        for key in list(cache):
+            if key[0] != func_name:
+                continue
+            if arguments and any((name, value) not in key[1:] for name, value in arguments.items()):
+                continue
+            cache.pop(key, None)
 
 
 async def get_resources_in_permission(permission_id: str, access_token=None):
-    headers, _ = await obtain_headers()
-    async with httpx.AsyncClient() as client:
+    headers, _ = await obtain_headers(access_token)
+    async with keycloak_client() as client:
         response = await client.get(
             base_url + ep_resources_in_permission.replace("[ENTER_PERMISSION_ID]", permission_id), 
             headers=headers
@@ -26,36 +130,33 @@ async def get_resources_in_permission(permission_id: str, access_token=None):
 
 
 async def create_permission(payload: dict, access_token=None):
-    headers, _ = await obtain_headers()
-    async with httpx.AsyncClient() as client:
+    headers, _ = await obtain_headers(access_token)
+    async with keycloak_client() as client:
         response = await client.post(
             base_url + ep_create_permission, 
             json=payload, headers=headers
             )
+    invalidate_cached_read("find_permission")
 
     return response
 
 
 async def update_permission(permission_id: str, payload: dict, access_token=None):
-    headers, _ = await obtain_headers()
-    async with httpx.AsyncClient() as client:
+    headers, _ = await obtain_headers(access_token)
+    async with keycloak_client() as client:
         response = await client.put(
             base_url + ep_update_permission.replace("[ENTER_PERMISSION_ID]", permission_id), 
             json=payload, headers=headers
             )
+    invalidate_cached_read("find_permission")
 
     return response
 
 
-async def get_all_permissions(access_token=None):
-    headers, _ = await obtain_headers()
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            base_url + ep_get_all_permissions, 
-            headers=headers
-            )
-
-    return response
+@coalesced_read()
+async def find_permission(name: str, access_token=None):
+    """The permission with exactly this name, or None (looked up with Keycloak's name filter, not a full listing)"""
+    return await _find_by_name(ep_get_all_permissions, name, access_token)
 
 
 async def obtain_access_token():
@@ -66,7 +167,7 @@ async def obtain_access_token():
         "client_secret":backend_client_secret
     }
     token_url = base_url + ep_access_token
-    async with httpx.AsyncClient() as client:
+    async with keycloak_client() as client:
         token_response = await client.post(token_url, data=access_token_payload)
         token_response.raise_for_status()  # Optional: raises exception for HTTP 4xx/5xx
         
@@ -85,7 +186,7 @@ async def obtain_headers(access_token=None):
 
 async def check_user_active(user_id, access_token=None):
     headers, _ = await obtain_headers(access_token)
-    async with httpx.AsyncClient() as client:
+    async with keycloak_client() as client:
         response = await client.get(
             base_url + ep_check_user_active.replace("[ENTER_USER_ID]", user_id), 
             headers=headers
@@ -94,21 +195,11 @@ async def check_user_active(user_id, access_token=None):
     return response
 
 
-async def get_all_users(access_token=None):
-    headers, _ = await obtain_headers(access_token)
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            base_url + ep_get_all_users, 
-            headers=headers
-            )
-
-    return response
-
-
+@coalesced_read()
 async def get_client_role(role: str, access_token=None): # get complete details against a given role name
     try:
         headers, _ = await obtain_headers(access_token)
-        async with httpx.AsyncClient() as client:
+        async with keycloak_client() as client:
             response = await client.get(
                 base_url + ep_get_client_role.replace("[ENTER_ROLE]", role), 
                 headers=headers
@@ -122,7 +213,7 @@ async def get_client_role(role: str, access_token=None): # get complete details
 async def get_user_role_details(user_id, access_token=None):
     try:
         headers, _ = await obtain_headers(access_token)
-        async with httpx.AsyncClient() as client:
+        async with keycloak_client() as client:
             response = await client.get(base_url + ep_get_user_roles.replace("[ENTER_USER_ID]", user_id), headers=headers)
         if response.status_code not in [200, 201, 204]:
             raise HTTPException(status_code=response.status_code, detail=response.text)
@@ -133,7 +224,7 @@ async def get_user_role_details(user_id, access_token=None):
 
 async def create_user_policy(payload, access_token=None):
     headers, _ = await obtain_headers(access_token)
-    async with httpx.AsyncClient() as client:
+    async with keycloak_client() as client:
         response = await client.post(base_url + ep_create_user_policy, json=payload, headers=headers)
 
     return response
@@ -141,34 +232,15 @@ async def create_user_policy(payload, access_token=None):
 
 async def retrieve_user_policy(username, access_token=None):
     try:
-        headers, _ = await obtain_headers(access_token)
-        async with httpx.AsyncClient() as client:
-            response = await client.get(base_url + ep_retrieve_policy, headers=headers)
-
-        if response.status_code != 200:
-            return None
-            
-        details = response.json()
-        print("policy details:", details)
-        
-        # Handle case where details is None or not a list
-        if not details or not isinstance(details, list):
-            return None
-            
-        policy = None
-        for detail in details:
-            if detail and detail.get("name") == f"policy_user_{username}":
-                policy = detail
-                break
-        return policy
+        return await _find_by_name(ep_retrieve_policy, f"policy_user_{username}", access_token)
     except Exception as e:
-        print(f"Error in retrieve_user_policy for {username}: {e}")
+        logger.error("Error in retrieve_user_policy for %s", username, exc_info=True)
         return None
 
 
 async def delete_user_policy(policy_id, access_token=None):
     headers, _ = await obtain_headers(access_token)
-    async with httpx.AsyncClient() as client:
+    async with keycloak_client() as client:
         response = await client.delete(base_url + ep_delete_user_policy + policy_id, headers=headers)
 
     return response
@@ -176,7 +248,7 @@ async def delete_user_policy(policy_id, access_token=None):
 
 async def create_resource(payload, access_token=None):
     headers, _ = await obtain_headers(access_token)
-    async with httpx.AsyncClient() as client:
+    async with keycloak_client() as client:
         response = await client.post(base_url + ep_create_resource_url, json=payload, headers=headers)
 
     return response
@@ -189,7 +261,7 @@ async def retrieve_resource(resource_name, access_token=None):
         "name": resource_name,
         "exact": True
         }
-        async with httpx.AsyncClient() as client:
+        async with keycloak_client() as client:
             response = await client.get(base_url + ep_retrieve_resource, params=query_params, headers=headers)
 
         if response.status_code != 200:
@@ -199,19 +271,14 @@ async def retrieve_resource(resource_name, access_token=None):
         # Return the full resource object if found, None if not found
         return resource_data[0] if resource_data and len(resource_data) > 0 else None
     except Exception as e:
-        print(f"Error in retrieve_resource for {resource_name}: {e}")
+        logger.error("Error in retrieve_resource for %s", resource_name, exc_info=True)
         return None
 
 
 async def get_all_resources(access_token=None):
     try:
-        headers, _ = await obtain_headers(access_token)
-        async with httpx.AsyncClient() as client:
-            response = await client.get(base_url + ep_get_all_resources, headers=headers)
-
-        resource_details = response.json()
         resources_summary = {}
-        for resource in resource_details:
+        async for resource in iter_resources(access_token):
             resources_summary[resource.get("name")] = resource.get("_id")
         return resources_summary
     except Exception as e:
@@ -220,7 +287,7 @@ async def get_all_resources(access_token=None):
 
 async def delete_resource(resource_id, access_token=None):
     headers, _ = await obtain_headers(access_token)
-    async with httpx.AsyncClient() as client:
+    async with keycloak_client() as client:
         response = await client.delete(base_url + ep_delete_resource + resource_id, headers=headers)
 
     return response
@@ -248,7 +315,7 @@ async def get_events(user_id=None, event_type=None, access_token=None):
         if event_type:
             params["type"] = event_type
             
-        async with httpx.AsyncClient() as client:
+        async with keycloak_client() as client:
             response = await client.get(
                 base_url + ep_events, 
                 params=params, 
@@ -260,6 +327,88 @@ async def get_events(user_id=None, event_type=None, access_token=None):
         raise e from e
 
 
+KEYCLOAK_PAGE_SIZE = 100  # Keycloak's own default page size for users and events
+
+
+async def iter_paginated(endpoint: str, params: dict = None, page_size: int = KEYCLOAK_PAGE_SIZE, access_token=None):
+    """
+    Async iterator over a paginated Keycloak admin listing (first / max query parameters).
+
+    Uses one token and one client for all pages, and requests the next page while the
+    caller is still consuming the current one, so only about two pages are held in memory.
+    Callers that stop early should wrap the iterator in contextlib.aclosing().
+    """
+    headers, _ = await obtain_headers(access_token)
+    base_params = dict(params or {})
+
+    async with keycloak_client(timeout=30.0) as client:
+        async def fetch_page(first):
+            response = await client.get(
+                base_url + endpoint,
+                params={**base_params, "first": first, "max": page_size},
+                headers=headers
+            )
+            if response.status_code != 200:
+                raise HTTPException(status_code=response.status_code, detail=response.text)
+            return response.json() or []
+
+        first = 0
+        pending = asyncio.ensure_future(fetch_page(first))
+        try:
+            while pending is not None:
+                page = await pending
+                pending = None
+                if len(page) >= page_size:
+                    # prefetch the next page while this one is consumed
+                    first += page_size
+                    pending = asyncio.ensure_future(fetch_page(first))
+                for item in page:
+                    yield item
+        finally:
+            if pending is not None:
+                pending.cancel()
+                try:
+                    await pending
+                except (asyncio.CancelledError, Exception):
+                    pass
+
+
+async def _find_by_name(endpoint: str, name: str, access_token=None):
+    """
+    First item of a listing whose name is exactly `name`. Keycloak's name filter is a
+    case-insensitive substring match, so the few candidates it returns are checked here.
+    """
+    async with aclosing(iter_paginated(endpoint, {"name": name}, access_token=access_token)) as items:
+        async for item in items:
+            if item and item.get("name") == name:
+                return item
+    return None
+
+
+def iter_users(access_token=None, **params):
+    """All users of the realm, page by page (extra params are passed as query filters)"""
+    return iter_paginated(ep_get_all_users, params, access_token=access_token)
+
+
+def iter_resources(access_token=None, **params):
+    """All resources of the backend client, page by page"""
+    return iter_paginated(ep_get_all_resources, params, access_token=access_token)
+
+
+def iter_permissions(access_token=None, **params):
+    """All permissions of the backend client, page by page"""
+    return iter_paginated(ep_get_all_permissions, params, access_token=access_token)
+
+
+def iter_events(user_id=None, event_type=None, access_token=None, **params):
+    """Events, newest first, page by page; optionally filtered by user and event type"""
+    if user_id:
+        params["user"] = user_id
+    if event_type:
+        params["type"] = event_type
+    return iter_paginated(ep_events, params, access_token=access_token)
+
+
 async def get_user_permissions_by_username(username: str, access_token=None):
     """
     Get all resources/permissions granted to a specific user by username.
@@ -272,16 +421,7 @@ async def get_user_permissions_by_username(username: str, access_token=None):
         list: List of resource dictionaries with name and id that the user has permission to access
     """
     try:
-        permission_name = f"permission_user_{username}"
-        all_permissions = (await get_all_permissions(access_token)).json()
-        
-        # Find the user's permission
-        user_permission = None
-        for permission in all_permissions:
-            if permission.get("name") == permission_name:
-                user_permission = permission
-                break
-        
+        user_permission = await find_permission(f"permission_user_{username}", access_token)
         if not user_permission:
             return []  # User has no permissions
         
@@ -313,16 +453,8 @@ async def get_all_resources_detailed(access_token=None):
         dict: Dictionary mapping resource IDs to resource details including type
     """
     try:
-        headers, _ = await obtain_headers(access_token)
-        async with httpx.AsyncClient() as client:
-            response = await client.get(base_url + ep_get_all_resources, headers=headers)
-
-        if response.status_code not in [200, 201, 204]:
-            raise HTTPException(status_code=response.status_code, detail=response.text)
-            
-        resource_details = response.json()
         resources_dict = {}
-        for resource in resource_details:
+        async for resource in iter_resources(access_token):
             resource_id = resource.get("_id")
             if resource_id:
                 resources_dict[resource_id] = resource
@@ -0,0 +1,268 @@
+import os
+import time
+import json
+import base64
+import bisect
+import datetime
+import threading
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+
+from fastapi import HTTPException
+
+from routers.utils.misc_files_utils import (
+    can_access_directory,
+    get_owner_cached,
+    get_child_counts
+)
+from routers.utils.misc_permission_utils import compile_permissions
+from routers.utils.misc_metrics_utils import record_cache
+from routers.utils.misc_tracing_utils import span
+from routers.utils.misc_logging_utils import get_logger
+
+
+logger = get_logger(__name__)
+
+
+LISTING_CACHE_SIZE = 256      # directories kept in memory
+LISTING_CACHE_MAX_AGE = 60.0  # seconds; catches in-place file modifications that don't touch the dir mtime
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+SORT_KEYS = ("name", "size", "mtime")
+TYPE_FILTERS = ("all", "file", "dir")
+
+
+def _sort_key(record, sort):
+    if sort == "size":
+        return (record["size_bytes"], record["name_lower"], record["name"])
+    if sort == "mtime":
+        return (record["mtime_ns"], record["name_lower"], record["name"])
+    return (record["name_lower"], record["name"])
+
+
+def _key_types(sort):
+    """Element types of _sort_key() for a sort key (cursor validation)"""
+    return (str, str) if sort == "name" else (int, str, str)
+
+
+def _child_path(relative_path, name):
+    return f"{relative_path}/{name}" if relative_path != '.' else name
+
+
+class DirectoryListing:
+    """Snapshot of one directory: scandir records plus lazily built sorted views"""
+
+    def __init__(self, abs_path, mtime_ns):
+        self.abs_path = abs_path
+        self.mtime_ns = mtime_ns
+        self.created = time.monotonic()
+        self.records = []
+        self._views = {}
+        self._visible_counts = weakref.WeakKeyDictionary()  # PermissionMatcher -> visible entries
+        self._lock = threading.Lock()
+
+        with os.scandir(abs_path) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                    self.records.append({
+                        "name": entry.name,
+                        "name_lower": entry.name.lower(),
+                        "is_dir": entry.is_dir(),
+                        "size_bytes": st.st_size,
+                        "mtime": st.st_mtime,
+                        "mtime_ns": st.st_mtime_ns,
+                        "path": entry.path
+                    })
+                except OSError as file_err:
+                    logger.warning("couldn’t process %s: %s", entry.path, file_err)
+
+    def view(self, sort):
+        """(sorted keys, sorted records) for a sort key, built once per snapshot"""
+        view = self._views.get(sort)
+        if view is None:
+            with self._lock:
+                view = self._views.get(sort)
+                if view is None:
+                    ordered = sorted(self.records, key=lambda r: _sort_key(r, sort))
+                    view = ([_sort_key(r, sort) for r in ordered], ordered)
+                    self._views[sort] = view
+        return view
+
+    def visible_count(self, matcher, relative_path):
+        """Entries the matcher allows, counted once per snapshot and matcher"""
+        with self._lock:
+            count = self._visible_counts.get(matcher)
+        if count is None:
+            count = sum(1 for r in self.records if matcher.is_allowed(_child_path(relative_path, r["name"])))
+            with self._lock:
+                self._visible_counts[matcher] = count
+        return count
+
+
+class DirectoryListingCache:
+    """Per-directory listing snapshots, invalidated when the directory mtime changes"""
+
+    def __init__(self, max_entries=LISTING_CACHE_SIZE, max_age=LISTING_CACHE_MAX_AGE):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, abs_path):
+        mtime_ns = os.stat(abs_path).st_mtime_ns
+        with self._lock:
+            listing = self._entries.get(abs_path)
+            if listing and listing.mtime_ns == mtime_ns and time.monotonic() - listing.created < self.max_age:
+                self._entries.move_to_end(abs_path)
+                record_cache("listing", True)
+                return listing
+
+        record_cache("listing", False)
+        with span("fs.scandir"):
+            listing = DirectoryListing(abs_path, mtime_ns)
+        with self._lock:
+            self._entries[abs_path] = listing
+            self._entries.move_to_end(abs_path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return listing
+
+    def invalidate(self, abs_path=None):
+        with self._lock:
+            if abs_path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(abs_path, None)
+
+
+listing_cache = DirectoryListingCache()
+
+
+def encode_cursor(key, sort, order):
+    raw = json.dumps({"k": list(key), "s": sort, "o": order}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, sort, order):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        key = tuple(data["k"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+    if data.get("s") != sort or data.get("o") != order:
+        raise HTTPException(status_code=400, detail="cursor does not match the requested sort order")
+    # the key is compared against the snapshot's sort keys, so it must have their exact shape
+    types = _key_types(sort)
+    if len(key) != len(types) or any(type(value) is not expected for value, expected in zip(key, types)):
+        raise HTTPException(status_code=400, detail="invalid cursor")
+    return key
+
+
+def dir_contents_page(abs_path: str, permissions: list, roles: list, limit: int = DEFAULT_PAGE_SIZE,
+                      cursor: str = None, sort: str = "name", order: str = "asc",
+                      entry_type: str = "all", prefix: str = None, counts: bool = True):
+    """
+    One page of a directory listing, sorted and filtered server-side.
+
+    Entries come from a cached, pre-sorted snapshot of the directory, so a page costs
+    a binary search to the cursor position plus `limit` permission checks, independent
+    of the directory size. Child counts are only computed for the returned entries, and
+    not at all without counts (num_files / num_subdirs are then null).
+
+    Returns:
+        {"entries": [...], "next_cursor": str | None, "total_entries": int}
+        total_entries is the number of entries the caller may see (before the type and
+        prefix filters); entries hidden by permissions are not counted.
+    """
+    if sort not in SORT_KEYS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {list(SORT_KEYS)}")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order must be 'asc' or 'desc'")
+    if entry_type not in TYPE_FILTERS:
+        raise HTTPException(status_code=400, detail=f"type must be one of {list(TYPE_FILTERS)}")
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+    base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
+    relative_path = str(Path(os.path.relpath(abs_path, base_dir)).as_posix())
+    if not can_access_directory(relative_path, permissions, roles):
+        return {"entries": [], "next_cursor": None, "total_entries": 0}
+
+    listing = listing_cache.get(abs_path)
+    keys, ordered = listing.view(sort)
+    prefix_lower = prefix.lower() if prefix else None
+
+    # Position of the first candidate entry
+    if order == "asc":
+        if cursor:
+            index = bisect.bisect_right(keys, decode_cursor(cursor, sort, order))
+        elif prefix_lower and sort == "name":
+            index = bisect.bisect_left(keys, (prefix_lower,))
+        else:
+            index = 0
+        step, stop = 1, len(ordered)
+    else:
+        if cursor:
+            index = bisect.bisect_left(keys, decode_cursor(cursor, sort, order)) - 1
+        else:
+            index = len(ordered) - 1
+        step, stop = -1, -1
+
+    owner_name = get_owner_cached(abs_path)
+    matcher = compile_permissions(permissions, roles)
+
+    if matcher.is_allowed(relative_path):
+        total_entries = len(ordered)  # granted directory: every entry is visible
+    else:
+        total_entries = listing.visible_count(matcher, relative_path)
+
+    page = []
+    last_key = None
+    has_more = False
+    while index != stop:
+        record = ordered[index]
+        index += step
+
+        if prefix_lower and not record["name_lower"].startswith(prefix_lower):
+            # name-sorted ascending: all prefix matches are contiguous
+            if sort == "name" and order == "asc" and record["name_lower"] > prefix_lower:
+                break
+            continue
+        if entry_type == "file" and record["is_dir"]:
+            continue
+        if entry_type == "dir" and not record["is_dir"]:
+            continue
+        if not matcher.is_allowed(_child_path(relative_path, record["name"])):
+            continue
+
+        if len(page) == limit:
+            has_more = True
+            break
+        page.append(record)
+        last_key = keys[index - step]
+
+    entries = []
+    for record in page:
+        num_files, num_subdirs = (0, 0) if counts else (None, None)
+        if record["is_dir"] and counts:
+            try:
+                num_files, num_subdirs = get_child_counts(record["path"], os.stat(record["path"]).st_mtime_ns)
+            except Exception as inner_err:
+                logger.warning("couldn’t list contents of %s: %s", record["path"], inner_err)
+        entries.append({
+            "name": record["name"],
+            "is_dir": record["is_dir"],
+            "size_bytes": record["size_bytes"],
+            "owner": owner_name,
+            "last_modified": datetime.datetime.fromtimestamp(record["mtime"], tz=datetime.timezone.utc).isoformat(),
+            "num_files": num_files,
+            "num_subdirs": num_subdirs
+        })
+
+    return {
+        "entries": entries,
+        "next_cursor": encode_cursor(last_key, sort, order) if has_more else None,
+        "total_entries": total_entries
+    }
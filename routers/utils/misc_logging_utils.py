@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import datetime
+import threading
+import traceback
+import logging.handlers
+
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = 10000               # records buffered for the writer thread; beyond that they are dropped
+LOG_RATE_LIMIT = 10                  # WARNING+ records per message template per LOG_RATE_WINDOW ...
+LOG_RATE_WINDOW = 60.0               # ... seconds; the rest are counted and reported with the next one let through
+LOGGER_ROOT = "files_api"
+
+# LogRecord attributes that are not structured fields passed through extra={...}
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sample_rate"}
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a share of records logged with extra={"sample_rate": r} (high-volume messages)"""
+
+    def filter(self, record):
+        rate = getattr(record, "sample_rate", None)
+        return rate is None or random.random() < rate
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    At most LOG_RATE_LIMIT records per (logger, message template) and window at
+    WARNING and above, so a failing dependency or a burst of bad tokens cannot flood
+    the log. The number of suppressed records is attached to the next record let through.
+    """
+
+    def __init__(self, limit=LOG_RATE_LIMIT, window=LOG_RATE_WINDOW, min_level=logging.WARNING):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.min_level = min_level
+        self._buckets = {}      # key -> [window start, emitted, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < self.min_level:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None or now - bucket[0] >= self.window:
+                suppressed = bucket[2] if bucket else 0
+                bucket = self._buckets[key] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            if bucket[1] >= self.limit:
+                bucket[2] += 1
+                return False
+            bucket[1] += 1
+            return True
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Turns records into plain dicts on the calling side (cheap: no I/O, no JSON encoding)
+    and hands them to the writer thread; when the queue is full the record is dropped
+    instead of blocking the event loop.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, tz=datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        trace_id = _current_trace_id()
+        if trace_id:
+            entry["trace_id"] = trace_id
+        if record.exc_info:
+            entry["exc"] = "".join(traceback.format_exception(*record.exc_info))
+        return entry
+
+    def enqueue(self, entry):
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonLinesHandler(logging.Handler):
+    """Writer-thread side: one JSON object per line"""
+
+    def __init__(self, stream=None):
+        super().__init__()
+        self.stream = stream or sys.stdout
+
+    def handle(self, entry):
+        try:
+            self.stream.write(json.dumps(entry, default=str, ensure_ascii=False) + "\n")
+            self.stream.flush()
+        except Exception:
+            pass
+
+
+_trace_var = None
+
+
+def _current_trace_id():
+    # imported lazily: the tracing module logs through this one
+    global _trace_var
+    if _trace_var is None:
+        from routers.utils.misc_tracing_utils import _current_trace
+        _trace_var = _current_trace
+    trace = _trace_var.get()
+    return trace.trace_id if trace is not None else None
+
+
+def _configure():
+    root = logging.getLogger(LOGGER_ROOT)
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = StructuredQueueHandler(log_queue)
+    # filters run before prepare(), so sampled-out and rate-limited records cost almost nothing
+    handler.addFilter(SamplingFilter())
+    handler.addFilter(RateLimitFilter())
+    root.addHandler(handler)
+    listener = logging.handlers.QueueListener(log_queue, JsonLinesHandler())
+    listener.start()
+    atexit.register(listener.stop)
+    return handler
+
+
+_queue_handler = _configure()
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger below the application root, e.g. get_logger(__name__)"""
+    return logging.getLogger(f"{LOGGER_ROOT}.{name}")
@@ -0,0 +1,198 @@
+import os
+import sqlite3
+import threading
+import time
+import asyncio
+import datetime
+from contextlib import aclosing
+
+from routers.utils.misc_keycloak_utils import obtain_headers, iter_users, iter_events, keycloak_client
+from routers.utils.keycloak_vars import *
+
+
+LOGIN_EVENTS_DB = os.path.join("data", "login_events.sqlite3")
+LOGIN_EVENTS_RETENTION_DAYS = 7      # events older than this are pruned from the local store
+USER_DIRECTORY_MAX_AGE = 600.0       # seconds before the id -> username directory is re-synced
+USER_LOOKUP_CONCURRENCY = 8
+EVENT_SYNC_OVERLAP_MS = 60_000       # re-read this much before the newest stored event (late writes from other nodes)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS login_events (
+    event_key TEXT PRIMARY KEY,
+    time INTEGER NOT NULL,
+    user_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_login_events_time ON login_events(time);
+CREATE INDEX IF NOT EXISTS idx_login_events_user ON login_events(user_id, time);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def _keycloak_date(timestamp_ms: int) -> str:
+    """dateFrom / dateTo take calendar days (yyyy-MM-dd, server local time), so round outwards"""
+    return datetime.datetime.fromtimestamp(timestamp_ms / 1000).strftime("%Y-%m-%d")
+
+
+class UserDirectory:
+    """
+    Cached user id -> username map, synced page by page from Keycloak.
+    Ids missing from the snapshot (users created since) are fetched individually and concurrently.
+    """
+
+    def __init__(self, max_age=USER_DIRECTORY_MAX_AGE):
+        self.max_age = max_age
+        self._usernames = {}
+        self._unknown = set()   # ids that were not found, not looked up again until the next sync
+        self._synced_at = None
+        self._lock = None
+
+    def invalidate(self):
+        self._synced_at = None
+
+    def forget(self, user_id):
+        """Drop one id, so the next resolve() looks it up again (e.g. after a rename)"""
+        self._usernames.pop(user_id, None)
+        self._unknown.discard(user_id)
+
+    async def sync(self, access_token=None):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._synced_at is not None and time.monotonic() - self._synced_at <= self.max_age:
+                return
+            usernames = {}
+            async for user in iter_users(access_token):
+                if user.get("id") and user.get("username"):
+                    usernames[user["id"]] = user["username"]
+            self._usernames = usernames
+            self._unknown = set()
+            self._synced_at = time.monotonic()
+
+    async def resolve(self, user_ids, access_token=None) -> dict:
+        """user id -> username for the given ids (ids of deleted users are left out)"""
+        await self.sync(access_token)
+        user_ids = set(user_ids)
+        misses = [user_id for user_id in user_ids if user_id not in self._usernames and user_id not in self._unknown]
+        if misses:
+            headers, _ = await obtain_headers(access_token)
+            semaphore = asyncio.Semaphore(USER_LOOKUP_CONCURRENCY)
+            async with keycloak_client(timeout=30.0) as client:
+                async def lookup(user_id):
+                    async with semaphore:
+                        response = await client.get(
+                            base_url + ep_update_user_details.replace("[ENTER_USER_ID]", user_id), headers=headers
+                        )
+                    if response.status_code == 200 and response.json().get("username"):
+                        self._usernames[user_id] = response.json()["username"]
+                    else:
+                        self._unknown.add(user_id)
+
+                await asyncio.gather(*(lookup(user_id) for user_id in misses))
+        return {user_id: self._usernames[user_id] for user_id in user_ids if user_id in self._usernames}
+
+
+class LoginEventStore:
+    """
+    Local, incrementally synced copy of Keycloak LOGIN events (SQLite).
+
+    The first sync fetches the requested window (pushed down with dateFrom); later syncs
+    only page through events newer than the newest one already stored, so repeated
+    dashboard polls cost about one small page.
+    """
+
+    def __init__(self, db_path=LOGIN_EVENTS_DB, retention_days=LOGIN_EVENTS_RETENTION_DAYS):
+        self.db_path = db_path
+        self.retention_days = retention_days
+        self._conn = None
+        self._lock = threading.Lock()
+        self._sync_lock = None
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _state(self, key):
+        with self._lock:
+            row = self._connection().execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _store(self, events, covered_from, newest_time):
+        cutoff = int((time.time() - self.retention_days * 86400) * 1000)
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO login_events (event_key, time, user_id) VALUES (?, ?, ?)", events
+                )
+                # pruned rows are no longer covered
+                for key, value in (("covered_from", max(covered_from, cutoff)), ("newest_time", newest_time)):
+                    conn.execute(
+                        "INSERT INTO sync_state (key, value) VALUES (?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                        (key, value)
+                    )
+                conn.execute("DELETE FROM login_events WHERE time < ?", (cutoff,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    async def sync(self, since_ms: int, access_token=None):
+        """Make sure every LOGIN event from since_ms up to now is stored locally"""
+        if self._sync_lock is None:
+            self._sync_lock = asyncio.Lock()
+        async with self._sync_lock:
+            covered_from = await asyncio.to_thread(self._state, "covered_from")
+            newest_time = await asyncio.to_thread(self._state, "newest_time")
+            if covered_from is None or covered_from > since_ms or newest_time is None:
+                # (re)load the whole window
+                stop_before, covered_from, newest_time = since_ms, since_ms, since_ms
+            else:
+                # only what is newer than the last stored event (plus a small overlap; duplicates are ignored)
+                stop_before = newest_time - EVENT_SYNC_OVERLAP_MS
+
+            events = []
+            newest_seen = newest_time
+            params = {"dateFrom": _keycloak_date(stop_before)}
+            async with aclosing(iter_events(event_type="LOGIN", access_token=access_token, **params)) as pages:
+                async for event in pages:
+                    event_time = event.get("time")
+                    if not event_time or not event.get("userId"):
+                        continue
+                    # events come newest first
+                    if event_time < stop_before:
+                        break
+                    event_key = event.get("id") or f"{event_time}-{event['userId']}-{event.get('sessionId', '')}"
+                    events.append((event_key, event_time, event["userId"]))
+                    newest_seen = max(newest_seen, event_time)
+
+            await asyncio.to_thread(self._store, events, covered_from, newest_seen)
+
+    def query(self, since_ms: int, until_ms: int = None, user_id: str = None):
+        """[(time, user_id)] oldest first; blocking, call it via asyncio.to_thread"""
+        sql = "SELECT time, user_id FROM login_events WHERE time >= ?"
+        params = [since_ms]
+        if until_ms is not None:
+            sql += " AND time <= ?"
+            params.append(until_ms)
+        if user_id:
+            sql += " AND user_id = ?"
+            params.append(user_id)
+        sql += " ORDER BY time"
+        with self._lock:
+            return self._connection().execute(sql, params).fetchall()
+
+
+user_directory = UserDirectory()
+login_event_store = LoginEventStore()
@@ -0,0 +1,286 @@
+import re
+import hmac
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+import httpx
+from decouple import Config, RepositoryEnv
+
+from routers.utils.misc_tracing_utils import span
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+# /metrics requires "Authorization: Bearer <METRICS_TOKEN>" (Prometheus: authorization.credentials).
+# The client address cannot be used for this: behind the reverse proxy every request comes from the
+# proxy. Without a token in secrets.env (or the environment) the endpoint is not served at all.
+METRICS_TOKEN = Config(RepositoryEnv("secrets.env"))("METRICS_TOKEN", default="")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        lines.extend(self._render_samples(items))
+        return lines
+
+    def _render_samples(self, items):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket (non cumulative) counts + overflow bucket, sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(float(bound)) if bound != float("inf") else "+Inf"}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# HTTP (every router)
+http_requests_total = registry.register(Counter(
+    "http_requests_total", "HTTP requests by route and status", ("method", "route", "status")))
+http_request_errors_total = registry.register(Counter(
+    "http_request_errors_total", "HTTP requests answered with a 4xx/5xx status or an unhandled exception",
+    ("method", "route", "status")))
+http_request_duration_seconds = registry.register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency until the last body chunk", ("method", "route")))
+http_response_size_bytes = registry.register(Histogram(
+    "http_response_size_bytes", "HTTP response body size", ("method", "route"), buckets=SIZE_BUCKETS))
+http_requests_in_flight = registry.register(Gauge(
+    "http_requests_in_flight", "HTTP requests currently being handled", ("method", "router")))
+METRICS_ROUTERS = ("files", "keycloak")
+
+# Subsystems
+keycloak_request_duration_seconds = registry.register(Histogram(
+    "keycloak_request_duration_seconds", "Keycloak call latency until response headers", ("method", "endpoint")))
+keycloak_requests_total = registry.register(Counter(
+    "keycloak_requests_total", "Keycloak calls by endpoint and status", ("method", "endpoint", "status")))
+auth_verification_duration_seconds = registry.register(Histogram(
+    "auth_verification_duration_seconds", "Token verification time in the jwt_token decorator", ("outcome",)))
+pdf_render_duration_seconds = registry.register(Histogram(
+    "pdf_render_duration_seconds", "PyMuPDF render + encode time", ("operation",)))
+cache_requests_total = registry.register(Counter(
+    "cache_requests_total", "Cache lookups by cache and result (hit ratio = hit / (hit + miss))", ("cache", "result")))
+admission_in_flight = registry.register(Gauge(
+    "admission_in_flight", "Requests holding an admission slot", ("cost_class",)))
+admission_queue_depth = registry.register(Gauge(
+    "admission_queue_depth", "Requests waiting for an admission slot", ("cost_class",)))
+admission_wait_seconds = registry.register(Histogram(
+    "admission_wait_seconds", "Time spent queued before an admission slot was granted", ("cost_class",)))
+admission_rejected_total = registry.register(Counter(
+    "admission_rejected_total", "Requests refused with 429 because the cost class queue was full",
+    ("cost_class", "priority")))
+
+
+def record_cache(cache: str, hit: bool, count: int = 1):
+    if count:
+        cache_requests_total.inc(count, cache=cache, result="hit" if hit else "miss")
+
+
+@contextmanager
+def timed(histogram: Histogram, **labels):
+    """Observe the duration of the with-block on a histogram"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started, **labels)
+
+
+def _router_label(path: str) -> str:
+    prefix = path.lstrip("/").split("/", 1)[0]
+    return f"/{prefix}" if prefix in METRICS_ROUTERS else "other"
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware recording per-route latency, in-flight requests, response size
+    and error counts. Routes are labelled with their path template (e.g. /files/download),
+    not the raw path, so label cardinality stays bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        method = scope.get("method", "")
+        started = time.perf_counter()
+        state = {"status": 500, "size": 0, "content_length": None}
+        # the route template is only known after routing, so in-flight requests are counted per router prefix
+        router = _router_label(scope.get("path", ""))
+        http_requests_in_flight.inc(method=method, router=router)
+
+        async def send_wrapper(message):
+            message_type = message["type"]
+            if message_type == "http.response.start":
+                state["status"] = message["status"]
+                for name, value in message.get("headers", ()):
+                    if name.lower() == b"content-length":
+                        state["content_length"] = int(value)
+                        break
+            elif message_type == "http.response.body":
+                state["size"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            state["status"] = 500
+            raise
+        finally:
+            http_requests_in_flight.dec(method=method, router=router)
+            route = scope.get("route")
+            route_label = getattr(route, "path", None) or "unmatched"
+            status = state["status"]
+            size = state["content_length"] if state["content_length"] is not None else state["size"]
+            http_requests_total.inc(method=method, route=route_label, status=status)
+            http_request_duration_seconds.observe(time.perf_counter() - started, method=method, route=route_label)
+            http_response_size_bytes.observe(size, method=method, route=route_label)
+            if status >= 400:
+                http_request_errors_total.inc(method=method, route=route_label, status=status)
+
+
+_ID_SEGMENT = re.compile(r"/[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?=/|$)")
+
+
+def keycloak_endpoint_label(path: str) -> str:
+    """/admin/realms/r/users/<uuid>/sessions -> /admin/realms/r/users/:id/sessions"""
+    return _ID_SEGMENT.sub("/:id", path)
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """httpx transport wrapper timing every Keycloak call by method and endpoint"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self._transport = transport
+
+    async def handle_async_request(self, request):
+        started = time.perf_counter()
+        status = "error"
+        endpoint = keycloak_endpoint_label(request.url.path)
+        try:
+            with span("keycloak", method=request.method, endpoint=endpoint) as current:
+                response = await self._transport.handle_async_request(request)
+                if current is not None:
+                    current.attributes["status"] = response.status_code
+            status = response.status_code
+            return response
+        finally:
+            keycloak_request_duration_seconds.observe(
+                time.perf_counter() - started, method=request.method, endpoint=endpoint)
+            keycloak_requests_total.inc(method=request.method, endpoint=endpoint, status=status)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def metrics_authorized(headers) -> bool:
+    if not METRICS_TOKEN:
+        return False
+    scheme, _, token = (headers.get("authorization") or "").partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode(), METRICS_TOKEN.encode())
+
+
+def render_metrics() -> str:
+    return registry.render()
@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import subprocess
+import time
+import traceback
+from collections import OrderedDict
+
+import fitz
+
+from routers.utils.misc_metrics_utils import record_cache
+from routers.utils.misc_serve_utils import compute_etag
+from routers.utils.misc_logging_utils import get_logger
+
+
+logger = get_logger(__name__)
+
+
+WEB_PDF_CACHE_DIR = os.path.join("cache", "web_pdf")
+WEB_PDF_MIN_SIZE = 2 * 1024 * 1024  # smaller files load fast enough as they are
+WEB_PDF_MAX_CONCURRENT_BUILDS = 1
+WEB_PDF_BUILD_TIMEOUT = 300         # seconds qpdf may take for one file
+WEB_PDF_NOT_BENEFICIAL_MAX = 4096   # remembered files whose copy would not help (oldest forgotten first)
+WEB_PDF_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # disk budget of cache/web_pdf, least recently served evicted first
+WEB_PDF_TOUCH_INTERVAL = 60.0       # seconds between access-time updates of a served copy
+
+_building = {}                  # cache file -> asyncio.Task
+_not_beneficial = OrderedDict() # cache files whose optimized copy would not help
+_build_semaphore = None
+_linearize_unavailable = False  # no qpdf and this MuPDF cannot write linearized files: nothing to build
+
+
+def _cache_file(abs_path: str, stat_result: os.stat_result) -> str:
+    """Cache entry keyed by (path, mtime); the path hash prefix lets stale versions be found and removed"""
+    path_hash = hashlib.sha1(os.path.abspath(abs_path).encode("utf-8")).hexdigest()[:20]
+    return os.path.join(WEB_PDF_CACHE_DIR, f"{path_hash}-{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}.pdf")
+
+
+def is_linearized(abs_path: str) -> bool:
+    """A linearized PDF declares /Linearized in its first object, within the first KB"""
+    try:
+        with open(abs_path, "rb") as f:
+            return b"/Linearized" in f.read(1024)
+    except OSError:
+        return False
+
+
+def _build_web_pdf(abs_path: str, target: str) -> bool:
+    """
+    Write a linearized ("fast web view") copy of abs_path to target.
+    Uses qpdf --linearize when it is installed, otherwise PyMuPDF's linear save, which
+    recent MuPDF versions no longer support. Only linearized copies are kept: a plain
+    rewrite would be advertised as web_version without loading any faster.
+    Returns False when no linearized copy could be written.
+    """
+    global _linearize_unavailable
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_target = f"{target}.{os.getpid()}.tmp"
+    try:
+        qpdf = shutil.which("qpdf")
+        if qpdf:
+            result = subprocess.run(
+                [qpdf, "--linearize", "--object-streams=generate", abs_path, tmp_target],
+                capture_output=True, timeout=WEB_PDF_BUILD_TIMEOUT
+            )
+            # qpdf exit code 3 means "succeeded with warnings"
+            if result.returncode not in (0, 3) or not os.path.isfile(tmp_target):
+                raise Exception(f"qpdf failed: {result.stderr.decode('utf-8', 'replace')}")
+        else:
+            doc = fitz.open(abs_path)
+            try:
+                doc.save(tmp_target, garbage=3, deflate=True, use_objstms=1, linear=True)
+            except Exception:
+                if not _linearize_unavailable:
+                    logger.warning("PDF linearization unavailable (qpdf not installed, MuPDF has no linear output); "
+                                   "web-optimized PDF copies are disabled")
+                _linearize_unavailable = True
+                return False
+            finally:
+                doc.close()
+            if not is_linearized(tmp_target):
+                return False
+        os.replace(tmp_target, target)
+        return True
+    finally:
+        if os.path.exists(tmp_target):
+            os.remove(tmp_target)
+
+
+def _enforce_cache_budget(keep: str):
+    """Delete the least recently served copies until cache/web_pdf fits WEB_PDF_CACHE_MAX_BYTES"""
+    try:
+        entries = [
+            (entry.stat().st_atime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(WEB_PDF_CACHE_DIR)
+            if entry.name.endswith(".pdf") and entry.path != keep
+        ]
+        total = sum(size for _, size, _ in entries) + os.path.getsize(keep)
+    except OSError:
+        return
+    for _, size, path in sorted(entries):
+        if total <= WEB_PDF_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def _remove_stale_versions(target: str):
+    prefix = os.path.basename(target).split("-", 1)[0] + "-"
+    try:
+        for entry in os.scandir(os.path.dirname(target)):
+            if entry.name.startswith(prefix) and entry.path != target and not entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+    except OSError:
+        pass
+
+
+async def _build_in_background(abs_path: str, target: str):
+    global _build_semaphore
+    if _build_semaphore is None:
+        _build_semaphore = asyncio.Semaphore(WEB_PDF_MAX_CONCURRENT_BUILDS)
+    try:
+        async with _build_semaphore:
+            built = await asyncio.to_thread(_build_web_pdf, abs_path, target)
+        if built:
+            _remove_stale_versions(target)
+            await asyncio.to_thread(_enforce_cache_budget, target)
+        else:
+            _mark_not_beneficial(target)
+    except Exception:
+        _mark_not_beneficial(target)
+        logger.error("Error building web-optimized PDF for %s", abs_path, exc_info=True)
+    finally:
+        _building.pop(target, None)
+
+
+def _mark_not_beneficial(target: str):
+    _not_beneficial[target] = True
+    while len(_not_beneficial) > WEB_PDF_NOT_BENEFICIAL_MAX:
+        _not_beneficial.popitem(last=False)
+
+
+def web_pdf_version(abs_path: str):
+    """
+    Version token of the cached web-optimized copy of a PDF, or None while it is being
+    built (the build is started here) or when optimizing would not help.
+
+    The copy is only served under its version (get_web_pdf), never in place of the
+    original: a PDF.js session keeps sending Range requests to the URL it started with,
+    and ranges from a file with a different length and xref would corrupt the document.
+    """
+    try:
+        stat_result = os.stat(abs_path)
+    except OSError:
+        return None
+    if stat_result.st_size < WEB_PDF_MIN_SIZE:
+        return None
+
+    target = _cache_file(abs_path, stat_result)
+    try:
+        version = compute_etag(os.stat(target)).strip('"')
+        record_cache("web_pdf", True)
+        return version
+    except OSError:
+        pass
+    record_cache("web_pdf", False)
+    if _linearize_unavailable or target in _not_beneficial or target in _building or is_linearized(abs_path):
+        return None
+
+    _building[target] = asyncio.get_running_loop().create_task(_build_in_background(abs_path, target))
+    return None
+
+
+def get_web_pdf(abs_path: str, version: str):
+    """Path of the web-optimized copy of abs_path if it still exists as `version`, else None"""
+    try:
+        target = _cache_file(abs_path, os.stat(abs_path))
+        stat_result = os.stat(target)
+        if compute_etag(stat_result).strip('"') == version:
+            # record the access for eviction; only the access time changes, so the version stays
+            if time.time() - stat_result.st_atime > WEB_PDF_TOUCH_INTERVAL:
+                os.utime(target, ns=(time.time_ns(), stat_result.st_mtime_ns))
+            return target
+    except OSError:
+        pass
+    return None
@@ -0,0 +1,78 @@
+from functools import lru_cache
+
+
+ALLOWED = "allowed"      # path is granted directly or through an ancestor
+BROWSABLE = "browsable"  # path is not granted, but something below it is (may be listed to reach it)
+DENIED = "denied"
+
+
+class _Node:
+    __slots__ = ("children", "granted")
+
+    def __init__(self):
+        self.children = {}
+        self.granted = False
+
+
+class PermissionMatcher:
+    """
+    Permission list (resource names such as '.', 'docs', 'docs/2024/report.pdf')
+    compiled into a path trie, so each check costs O(path depth) instead of O(#permissions).
+
+    Matches the rules of has_hierarchical_permission / can_access_directory:
+    - admin, or a '.' grant, allows everything
+    - a grant allows the path itself and everything below it
+    - a directory with a grant somewhere below it is browsable
+    - the root is browsable with any grant that does not start with '../'
+    """
+
+    def __init__(self, permissions, is_admin=False):
+        self.is_admin = is_admin
+        self.root = _Node()
+        self.root_browsable = False
+        for permission in permissions:
+            if permission is None:
+                continue
+            if permission in (".", ""):
+                self.root.granted = True
+                continue
+            if not permission.startswith("../"):
+                self.root_browsable = True
+            node = self.root
+            for segment in permission.split("/"):
+                node = node.children.setdefault(segment, _Node())
+            node.granted = True
+
+    def check(self, path: str) -> str:
+        if self.is_admin or self.root.granted:
+            return ALLOWED
+        if path in (".", ""):
+            return BROWSABLE if self.root_browsable else DENIED
+        node = self.root
+        for segment in path.split("/"):
+            node = node.children.get(segment)
+            if node is None:
+                return DENIED
+            if node.granted:
+                return ALLOWED
+        return BROWSABLE if node.children else DENIED
+
+    def is_allowed(self, path: str) -> bool:
+        return self.check(path) == ALLOWED
+
+    def can_browse(self, path: str) -> bool:
+        """Allowed, or an ancestor of something allowed (used for listing and for pruning scans)"""
+        return self.check(path) != DENIED
+
+
+@lru_cache(maxsize=1024)
+def _compile(permissions: tuple, is_admin: bool) -> PermissionMatcher:
+    return PermissionMatcher(permissions, is_admin)
+
+
+def compile_permissions(permissions, roles) -> PermissionMatcher:
+    """
+    Matcher for a permission set, cached per distinct (permissions, admin) pair, i.e.
+    effectively per token: repeated requests with the same grants reuse the compiled trie.
+    """
+    return _compile(tuple(permissions or ()), "admin" in (roles or ()))
@@ -0,0 +1,286 @@
+import asyncio
+import datetime
+import json
+import os
+import time
+import traceback
+
+import httpx
+
+from routers.utils.misc_keycloak_utils import obtain_headers, keycloak_client
+from routers.utils.misc_resource_utils import resource_index, delete_resources
+from routers.utils.keycloak_vars import *
+from routers.utils.misc_logging_utils import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# Background passes are opt-in, and only create resources unless deletes are enabled as well;
+# POST /keycloak/reconcile_resources runs a pass (with deletes) on demand either way
+RESOURCE_RECONCILE_ENABLED = False
+RESOURCE_RECONCILE_DELETE = False
+RECONCILE_INTERVAL = 300.0          # seconds between background passes
+RECONCILE_FULL_PASS_INTERVAL = 3600.0  # re-diff an unchanged tree this often to catch changes made in Keycloak
+RECONCILE_NUDGE_DELAY = 5.0         # debounce after an upload / mkdir before reconciling
+RECONCILE_BATCH_SIZE = 100          # requests sent together, then paced
+RECONCILE_CONCURRENCY = 10          # parallel requests inside a batch
+RECONCILE_MAX_REQUESTS_PER_SECOND = 50.0
+RECONCILE_MAX_DELETE_RATIO = 0.5    # refuse to delete more than this share of managed resources without force
+RECONCILE_DELETE_GUARD_MIN = 10     # ... once more than this many deletes are planned
+RECONCILE_STATE_FILE = os.path.join("data", "reconcile_state.json")
+
+# Resources the reconciler manages; anything else (api resources, roles, ...) is never touched
+MANAGED_RESOURCE_TYPES = ("file", "dir")
+PROTECTED_RESOURCES = (".", "admin")
+
+
+def scan_catalog(base_dir: str):
+    """
+    Filesystem catalog of remote/: resource name (relative posix path) -> "file" | "dir",
+    plus a cheap tree signature (entry count, newest directory mtime) used as the watermark.
+    """
+    catalog = {}
+    newest_dir_mtime_ns = 0
+    for dirpath, dirnames, filenames in os.walk(base_dir):
+        try:
+            newest_dir_mtime_ns = max(newest_dir_mtime_ns, os.stat(dirpath).st_mtime_ns)
+        except OSError:
+            pass
+        relative_dir = os.path.relpath(dirpath, base_dir).replace(os.sep, '/')
+        for dirname in dirnames:
+            catalog[dirname if relative_dir == '.' else f"{relative_dir}/{dirname}"] = "dir"
+        for filename in filenames:
+            catalog[filename if relative_dir == '.' else f"{relative_dir}/{filename}"] = "file"
+    return catalog, f"{len(catalog)}-{newest_dir_mtime_ns:x}"
+
+
+def load_watermark():
+    try:
+        with open(RECONCILE_STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_watermark(state: dict):
+    os.makedirs(os.path.dirname(RECONCILE_STATE_FILE), exist_ok=True)
+    tmp_file = f"{RECONCILE_STATE_FILE}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_file, RECONCILE_STATE_FILE)
+
+
+def plan_reconcile(catalog: dict):
+    """Diff the filesystem catalog against the resource index"""
+    to_create = {name: resource_type for name, resource_type in catalog.items() if resource_index.get(name) is None}
+    to_delete = {}
+    managed = 0
+    for name in resource_index.names():
+        resource = resource_index.get(name)
+        if resource["type"] not in MANAGED_RESOURCE_TYPES or name in PROTECTED_RESOURCES:
+            continue
+        managed += 1
+        if name not in catalog:
+            to_delete[name] = resource["_id"]
+    return to_create, to_delete, managed
+
+
+async def _paced_batches(items, batch_size, max_rate, apply_batch):
+    """Run apply_batch over consecutive batches, spacing them to stay under max_rate requests/s"""
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        started = time.monotonic()
+        await apply_batch(batch)
+        min_duration = len(batch) / max_rate
+        elapsed = time.monotonic() - started
+        if elapsed < min_duration and start + batch_size < len(items):
+            await asyncio.sleep(min_duration - elapsed)
+
+
+async def create_resources(to_create: dict, access_token=None, concurrency=RECONCILE_CONCURRENCY):
+    """
+    Create resources concurrently over one client and one token.
+
+    Returns:
+        (created_names, failed) where failed maps name -> error text
+    """
+    created, failed = [], {}
+    if not to_create:
+        return created, failed
+
+    headers, _ = await obtain_headers(access_token)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with keycloak_client(timeout=30.0) as client:
+        async def create_one(name):
+            resource_payload = {
+                "name": name,
+                "displayName": name,
+                "type": to_create[name],
+                "icon_uri": "",
+                "ownerManagedAccess": False,
+                "attributes": {},
+                "scopes": []
+            }
+            async with semaphore:
+                try:
+                    response = await client.post(base_url + ep_create_resource_url, json=resource_payload, headers=headers)
+                except httpx.HTTPError as e:
+                    failed[name] = str(e)
+                    return
+            if response.status_code in (200, 201):
+                resource_index.add(name, response.json().get("_id"), to_create[name])
+                created.append(name)
+            elif response.status_code == 409:
+                # created concurrently elsewhere; the next index sync picks up its id
+                resource_index.mark_stale()
+                created.append(name)
+            else:
+                failed[name] = f"{response.status_code} - {response.text}"
+
+        await asyncio.gather(*(create_one(name) for name in to_create))
+
+    return created, failed
+
+
+async def reconcile_resources(dry_run: bool = False, force: bool = False, delete: bool = True):
+    """
+    Bring Keycloak file/dir resources in line with the remote/ tree.
+
+    - resources are created for files and directories that have none
+    - file/dir resources whose path no longer exists are deleted when delete is set
+      (protected and non file/dir resources are never deleted)
+    - requests go out in concurrent, rate-limited batches over one token
+    - the tree signature of the last complete pass is persisted; a pass over an unchanged
+      tree is skipped (up to RECONCILE_FULL_PASS_INTERVAL) unless force is set
+    - when more than RECONCILE_MAX_DELETE_RATIO of the managed resources (and more than
+      RECONCILE_DELETE_GUARD_MIN) would be deleted, e.g. because remote/ is not mounted,
+      nothing is deleted unless force is set
+
+    Returns a report; with dry_run the planned creates/deletes are listed and nothing is applied.
+    """
+    base_dir = os.path.normpath(os.path.join(os.getcwd(), "remote"))
+    if not os.path.isdir(base_dir):
+        raise Exception("Remote directory does not exist")
+
+    catalog, tree_signature = await asyncio.to_thread(scan_catalog, base_dir)
+    watermark = load_watermark()
+    if not dry_run and not force and watermark.get("tree_signature") == tree_signature \
+            and time.time() - watermark.get("completed_at_ts", 0) < RECONCILE_FULL_PASS_INTERVAL:
+        return {"skipped": True, "reason": "tree unchanged since last reconcile", "watermark": watermark}
+
+    _, access_token = await obtain_headers()
+    await resource_index.sync(access_token)
+    to_create, to_delete, managed = plan_reconcile(catalog)
+
+    deletes_blocked = not force and len(to_delete) > max(RECONCILE_DELETE_GUARD_MIN, managed * RECONCILE_MAX_DELETE_RATIO)
+    report = {
+        "dry_run": dry_run,
+        "catalog_entries": len(catalog),
+        "managed_resources": managed,
+        "to_create": len(to_create),
+        "to_delete": len(to_delete),
+        "deletes_blocked": deletes_blocked,
+        "deletes_enabled": delete
+    }
+    if dry_run:
+        report["create"] = sorted(to_create)
+        report["delete"] = sorted(to_delete)
+        return report
+
+    created, create_failed = [], {}
+    deleted, delete_failed = [], {}
+
+    async def create_batch(names):
+        batch_created, batch_failed = await create_resources({name: to_create[name] for name in names}, access_token)
+        created.extend(batch_created)
+        create_failed.update(batch_failed)
+
+    async def delete_batch(names):
+        id_to_name = {to_delete[name]: name for name in names}
+        batch_deleted, batch_failed = await delete_resources(id_to_name, access_token, concurrency=RECONCILE_CONCURRENCY)
+        batch_names = [id_to_name[resource_id] for resource_id in batch_deleted]
+        resource_index.remove(batch_names)
+        deleted.extend(batch_names)
+        delete_failed.update({id_to_name[resource_id]: error for resource_id, error in batch_failed.items()})
+
+    # Parents sort before their children, so directories are created first
+    await _paced_batches(sorted(to_create), RECONCILE_BATCH_SIZE, RECONCILE_MAX_REQUESTS_PER_SECOND, create_batch)
+    if delete and not deletes_blocked:
+        await _paced_batches(sorted(to_delete), RECONCILE_BATCH_SIZE, RECONCILE_MAX_REQUESTS_PER_SECOND, delete_batch)
+
+    report.update({
+        "created": len(created),
+        "deleted": len(deleted),
+        "failed": {"create": create_failed, "delete": delete_failed}
+    })
+
+    # Only advance the watermark when the pass fully converged
+    if not create_failed and not delete_failed and not (delete and deletes_blocked):
+        save_watermark({
+            "tree_signature": tree_signature,
+            "completed_at": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+            "completed_at_ts": time.time(),
+            "created": len(created),
+            "deleted": len(deleted)
+        })
+    return report
+
+
+class ResourceReconciler:
+    """
+    Background task running reconcile_resources() every RECONCILE_INTERVAL seconds, when
+    RESOURCE_RECONCILE_ENABLED is set; it deletes only with RESOURCE_RECONCILE_DELETE.
+    nudge() schedules an earlier pass (debounced), so uploads never create resources inline.
+    """
+
+    def __init__(self, interval=RECONCILE_INTERVAL, nudge_delay=RECONCILE_NUDGE_DELAY):
+        self.interval = interval
+        self.nudge_delay = nudge_delay
+        self.last_report = None
+        self._wakeup = None
+        self._task = None
+
+    def nudge(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def start(self):
+        if self._task is None and RESOURCE_RECONCILE_ENABLED:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+                # let a burst of uploads finish before diffing
+                await asyncio.sleep(self.nudge_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                self.last_report = await reconcile_resources(delete=RESOURCE_RECONCILE_DELETE)
+                if not self.last_report.get("skipped"):
+                    logger.info("resource reconcile", extra={
+                        "created": self.last_report.get("created"),
+                        "deleted": self.last_report.get("deleted"),
+                        "to_delete": self.last_report.get("to_delete"),
+                        "deletes_enabled": RESOURCE_RECONCILE_DELETE,
+                        "deletes_blocked": self.last_report.get("deletes_blocked")
+                    })
+            except Exception:
+                logger.error("resource reconcile failed", exc_info=True)
+
+
+resource_reconciler = ResourceReconciler()
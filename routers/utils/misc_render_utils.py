@@ -0,0 +1,479 @@
+import os
+import math
+import time
+import asyncio
+import multiprocessing
+from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import fitz
+from PIL import Image, features
+from fastapi import HTTPException
+
+from routers.utils.misc_metrics_utils import timed, record_cache, pdf_render_duration_seconds
+from routers.utils.misc_tracing_utils import span
+from routers.utils.misc_logging_utils import get_logger
+
+
+logger = get_logger(__name__)
+
+
+RENDER_USE_PROCESSES = True          # False: render in threads (PyMuPDF holds the GIL, so no parallelism)
+RENDER_WORKERS = max(2, min(4, os.cpu_count() or 1))
+RENDER_WORKER_DOCS = 8               # open documents kept per worker process
+RENDER_CACHE_MAX_BYTES = 256 * 1024 * 1024
+RENDER_CACHE_MAX_ENTRY_BYTES = 16 * 1024 * 1024
+RENDER_MAX_PIXELS = 24_000_000       # whole-page renders are scaled down to stay below this
+
+IMAGE_MEDIA_TYPES = {"png": "image/png", "webp": "image/webp", "avif": "image/avif", "jpeg": "image/jpeg"}
+IMAGE_LOSSY_QUALITY = 80             # default for webp/avif/jpeg, overridable per request (1-100)
+IMAGE_WEBP_METHOD = 2                # encoder effort 0-6: higher is smaller and slower
+IMAGE_PNG_COMPRESS_LEVEL = 6
+RASTER_PAGE_IMAGE_COVERAGE = 0.5     # pages at least this much covered by images are encoded lossy
+PNG_ENCODING = ("png", "png", None)  # (format for text/vector pages, format for raster pages, lossy quality)
+
+TILE_SIZES = (256, 512)
+TILE_MAX_SCALE = 16.0                # deepest zoom level renders at most at this scale (1152 dpi)
+
+PREFETCH_ENABLED = True
+PREFETCH_MIN_PAGES = 1               # pages ahead in the reading direction for a slow reader ...
+PREFETCH_MAX_PAGES = 6               # ... and for someone flipping through
+PREFETCH_LOOKAHEAD_SECONDS = 3.0     # aim to have this much reading time rendered ahead
+PREFETCH_INTERVAL_ALPHA = 0.5        # weight of the latest page turn in the interval average
+PREFETCH_SESSION_IDLE = 120.0        # seconds after which a session starts over
+PREFETCH_MAX_SESSIONS = 512
+PREFETCH_CONCURRENCY = 1             # prefetch renders running at once, across all sessions
+
+
+def _avif_available():
+    # Pillow >= 11.2 may be built with AVIF; older versions need the pillow-avif-plugin package
+    try:
+        if features.check_codec("avif"):
+            return True
+    except ValueError:
+        pass
+    try:
+        import pillow_avif  # noqa: F401 (registers the codec)
+        return True
+    except ImportError:
+        return False
+
+
+AVIF_AVAILABLE = _avif_available()
+
+
+# --- worker side (runs in the render processes) ---
+
+_worker_docs = OrderedDict()
+
+
+def _worker_doc(abs_path, mtime):
+    key = (abs_path, mtime)
+    doc = _worker_docs.get(key)
+    if doc is not None:
+        _worker_docs.move_to_end(key)
+        return doc
+    doc = fitz.open(abs_path)
+    _worker_docs[key] = doc
+    while len(_worker_docs) > RENDER_WORKER_DOCS:
+        _, old = _worker_docs.popitem(last=False)
+        old.close()
+    return doc
+
+
+def is_raster_page(page) -> bool:
+    """Scans and photo pages (mostly covered by images) compress far better lossy than text and vector art"""
+    page_area = page.rect.get_area()
+    if not page_area:
+        return False
+    covered = 0.0
+    for info in page.get_image_info():
+        covered += (fitz.Rect(info["bbox"]) & page.rect).get_area()
+    return covered / page_area >= RASTER_PAGE_IMAGE_COVERAGE
+
+
+def encode_pixmap(pix, fmt, quality=None, lossless=False) -> bytes:
+    img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    buffered = BytesIO()
+    quality = quality or IMAGE_LOSSY_QUALITY
+    if fmt == "png":
+        # optimize=True (zlib level 9 + filter search) took ~4x as long for ~3% smaller pages
+        img.save(buffered, format="PNG", compress_level=IMAGE_PNG_COMPRESS_LEVEL)
+    elif fmt == "webp" and lossless:
+        img.save(buffered, format="WEBP", lossless=True, method=IMAGE_WEBP_METHOD)
+    elif fmt == "webp":
+        img.save(buffered, format="WEBP", quality=quality, method=IMAGE_WEBP_METHOD)
+    elif fmt == "avif":
+        img.save(buffered, format="AVIF", quality=quality)
+    else:
+        img.save(buffered, format="JPEG", quality=quality, optimize=True)
+    return buffered.getvalue()
+
+
+def render_image(abs_path, mtime, page_index, scale, encoding=PNG_ENCODING, clip=None):
+    """
+    Render a page, or only the clip rectangle of it (page coordinates), and encode it:
+    text/vector pages with the lossless format of the encoding, raster pages (or any page
+    when there is no lossless format) with the lossy one. -> (bytes, width, height, media type)
+    """
+    lossless, lossy, quality = encoding
+    page = _worker_doc(abs_path, mtime).load_page(page_index)
+    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), clip=fitz.Rect(clip) if clip else None, alpha=False)
+    if lossless and (lossy == "png" or not is_raster_page(page)):
+        fmt, data = lossless, encode_pixmap(pix, lossless, lossless=True)
+    else:
+        fmt, data = lossy, encode_pixmap(pix, lossy, quality)
+    return data, pix.width, pix.height, IMAGE_MEDIA_TYPES[fmt]
+
+
+def cap_scale(width, height, scale):
+    """Largest scale <= scale at which a width x height (points) page stays within RENDER_MAX_PIXELS"""
+    if width * height * scale * scale <= RENDER_MAX_PIXELS:
+        return scale
+    return math.sqrt(RENDER_MAX_PIXELS / (width * height))
+
+
+class TilePyramid:
+    """
+    Zoom levels of one page, map style: at level 0 the whole page fits in one tile, and
+    every level doubles the scale, up to TILE_MAX_SCALE. Tile (x, y) of level z covers
+    pixels [x * size, (x + 1) * size) x [y * size, (y + 1) * size) of the page rendered at
+    scale(z); edge tiles are cropped to the page.
+    """
+
+    def __init__(self, page_rect, tile_size):
+        self.rect = fitz.Rect(page_rect)
+        self.tile_size = tile_size
+        self.base_scale = tile_size / max(self.rect.width, self.rect.height)
+        self.max_zoom = max(0, int(math.floor(math.log2(TILE_MAX_SCALE / self.base_scale)))) \
+            if self.base_scale < TILE_MAX_SCALE else 0
+
+    def scale(self, zoom):
+        return self.base_scale * (2 ** zoom)
+
+    def grid(self, zoom):
+        """(columns, rows) of a level"""
+        scale = self.scale(zoom)
+        return (math.ceil(self.rect.width * scale / self.tile_size),
+                math.ceil(self.rect.height * scale / self.tile_size))
+
+    def clip(self, zoom, x, y):
+        scale = self.scale(zoom)
+        step = self.tile_size / scale
+        x0 = self.rect.x0 + x * step
+        y0 = self.rect.y0 + y * step
+        return (x0, y0, min(x0 + step, self.rect.x1), min(y0 + step, self.rect.y1))
+
+    def levels(self):
+        return [{"zoom": zoom, "scale": self.scale(zoom), "columns": self.grid(zoom)[0], "rows": self.grid(zoom)[1]}
+                for zoom in range(self.max_zoom + 1)]
+
+
+# --- event loop side ---
+
+def negotiate_encoding(requested=None, accept=None, quality=None):
+    """
+    Encoding for a render request from the explicit format parameter and the Accept header.
+    - png: lossless everywhere (the default, when neither asks for anything else)
+    - webp: lossless for text pages, lossy for raster pages
+    - jpeg / avif: lossy everywhere
+    - auto, or an Accept header naming image types: the best accepted of each kind,
+      webp lossless (else png) for text pages and avif, webp or jpeg for raster pages
+    - auto with an Accept header naming no image types (fetch() sends */*): webp, which
+      every current browser decodes; avif is only chosen when the client names it
+    """
+    requested = (requested or "").lower().strip()
+    if requested == "jpg":
+        requested = "jpeg"
+    if quality is not None and not 1 <= quality <= 100:
+        raise HTTPException(status_code=400, detail="image_quality must be between 1 and 100")
+    if requested == "avif" and not AVIF_AVAILABLE:
+        raise HTTPException(status_code=415, detail="AVIF encoding is not available on this server")
+    if requested == "png":
+        return PNG_ENCODING
+    if requested == "webp":
+        return ("webp", "webp", quality)
+    if requested in ("jpeg", "avif"):
+        return (None, requested, quality)
+    if requested and requested != "auto":
+        raise HTTPException(status_code=400, detail=f"Unsupported image format: {requested}")
+
+    accepted = set()
+    for item in (accept or "").split(","):
+        media_type, _, params = item.strip().lower().partition(";")
+        if media_type.strip() in ("image/webp", "image/avif", "image/jpeg") and \
+                params.replace(" ", "") not in ("q=0", "q=0.0"):
+            accepted.add(media_type.strip())
+    if not accepted:
+        return ("webp", "webp", quality) if requested == "auto" else PNG_ENCODING
+    lossless = "webp" if "image/webp" in accepted else "png"
+    if AVIF_AVAILABLE and "image/avif" in accepted:
+        lossy = "avif"
+    elif "image/webp" in accepted:
+        lossy = "webp"
+    else:
+        lossy = "jpeg"
+    return (lossless, lossy, quality)
+
+
+def request_encoding(params, headers):
+    """negotiate_encoding() from a request's form/query fields (format, image_quality) and Accept header"""
+    quality = params.get("image_quality")
+    try:
+        quality = int(quality) if quality else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="image_quality must be an integer")
+    return negotiate_encoding(params.get("format"), headers.get("accept"), quality)
+
+
+class RenderCache:
+    """LRU of rendered pages bounded by total bytes"""
+
+    def __init__(self, max_bytes=RENDER_CACHE_MAX_BYTES, max_entry_bytes=RENDER_CACHE_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def put(self, key, entry):
+        size = len(entry[0])
+        if size > self.max_entry_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old[0])
+        self._entries[key] = entry
+        self.size += size
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted[0])
+
+
+def render_key(abs_path, mtime, page_num, scale, encoding=PNG_ENCODING):
+    return (abs_path, mtime, page_num, round(scale, 4), encoding)
+
+
+def tile_key(abs_path, mtime, page_num, tile_size, zoom, x, y, encoding=PNG_ENCODING):
+    return ("tile", abs_path, mtime, page_num, tile_size, zoom, x, y, encoding)
+
+
+class PageRenderer:
+    """
+    Renders PDF pages in a process pool, off the event loop. Results are cached by
+    (path, mtime, page, scale, encoding), each encoded variant separately, and concurrent
+    requests for the same variant share one render,
+    so a foreground request for a page that is being prefetched just waits for it.
+    """
+
+    def __init__(self):
+        self.cache = RenderCache()
+        self._pool = None
+        self._inflight = {}
+        self._waiting = {}          # key -> foreground requests waiting for that in-flight render
+        self._foreground = 0
+        self._idle = None
+
+    def _executor(self):
+        if self._pool is None:
+            if RENDER_USE_PROCESSES:
+                # spawn, not fork: forking a process that runs threads (event loop executors, the
+                # access log writer) can copy held locks into the child and deadlock it
+                self._pool = ProcessPoolExecutor(
+                    max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+        return self._pool
+
+    def _idle_event(self):
+        if self._idle is None:
+            self._idle = asyncio.Event()
+            self._idle.set()
+        return self._idle
+
+    async def wait_idle(self):
+        """Wait until no foreground render is running"""
+        await self._idle_event().wait()
+
+    def _submit(self, key, fn, args, store=True):
+        future = asyncio.wrap_future(self._executor().submit(fn, *args))
+        self._inflight[key] = future
+
+        def done(fut):
+            self._inflight.pop(key, None)
+            if not fut.cancelled() and fut.exception() is None:
+                if store:
+                    self.cache.put(key, fut.result())
+            elif not fut.cancelled() and isinstance(fut.exception(), BrokenProcessPool):
+                # a worker died (e.g. on a malformed PDF): start a fresh pool for the next render
+                self._pool = None
+
+        future.add_done_callback(done)
+        return future
+
+    async def render(self, abs_path, mtime, page_num, scale, encoding=PNG_ENCODING,
+                     foreground=True, operation="page", store=True):
+        """
+        (image bytes, width, height, media type) for a page, rendered at most once. store=False
+        keeps bulk renders (streamed ranges) from evicting the pages people are looking at.
+        """
+        return await self._render(render_key(abs_path, mtime, page_num, scale, encoding), render_image,
+                                  (abs_path, mtime, page_num - 1, scale, encoding), foreground, operation, store,
+                                  "page_render", page=page_num, scale=scale)
+
+    async def render_tile(self, abs_path, mtime, page_num, pyramid, zoom, x, y, encoding=PNG_ENCODING):
+        """(image bytes, width, height, media type) of one tile of a page's TilePyramid"""
+        return await self._render(tile_key(abs_path, mtime, page_num, pyramid.tile_size, zoom, x, y, encoding),
+                                  render_image, (abs_path, mtime, page_num - 1, pyramid.scale(zoom), encoding,
+                                                 pyramid.clip(zoom, x, y)),
+                                  True, "tile", True, "tile", page=page_num, zoom=zoom)
+
+    async def _render(self, key, fn, args, foreground, operation, store, cache_name, **attributes):
+        cached = self.cache.get(key)
+        if foreground:
+            # prefetch lookups would inflate the hit ratio
+            record_cache(cache_name, cached is not None)
+        if cached is not None:
+            return cached
+
+        future = self._inflight.get(key) or self._submit(key, fn, args, store)
+        if not foreground:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # drop a cancelled prefetch that has not started, unless a foreground request joined it
+                if not self._waiting.get(key):
+                    future.cancel()
+                raise
+
+        self._foreground += 1
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        self._idle_event().clear()
+        try:
+            with timed(pdf_render_duration_seconds, operation=operation), \
+                    span("fitz.render", **attributes):
+                # shielded: a client going away must not cancel a render other requests may share
+                return await asyncio.shield(future)
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                del self._waiting[key]
+            self._foreground -= 1
+            if not self._foreground:
+                self._idle_event().set()
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+page_renderer = PageRenderer()
+
+
+class _PrefetchSession:
+    __slots__ = ("last_page", "last_time", "interval", "direction", "task")
+
+    def __init__(self):
+        self.last_page = None
+        self.last_time = 0.0
+        self.interval = None
+        self.direction = 1
+        self.task = None
+
+
+class PagePrefetcher:
+    """
+    After page N is served, pre-renders N+1..N+k and N-1 (mirrored when reading backwards)
+    at the same scale. k follows the reader's pace: the average time between page turns
+    decides how many pages cover PREFETCH_LOOKAHEAD_SECONDS. Prefetch renders only start
+    while no foreground render is running, one at a time, and the plan of a session is
+    cancelled as soon as it requests another page.
+    """
+
+    def __init__(self, renderer):
+        self.renderer = renderer
+        self._sessions = OrderedDict()
+        self._semaphore = None
+
+    def _session(self, session_key, now):
+        session = self._sessions.get(session_key)
+        if session is None or now - session.last_time > PREFETCH_SESSION_IDLE:
+            if session is not None and session.task is not None:
+                session.task.cancel()
+            session = self._sessions[session_key] = _PrefetchSession()
+        self._sessions.move_to_end(session_key)
+        while len(self._sessions) > PREFETCH_MAX_SESSIONS:
+            _, old = self._sessions.popitem(last=False)
+            if old.task is not None:
+                old.task.cancel()
+        return session
+
+    def lookahead(self, session) -> int:
+        if session.interval is None:
+            return PREFETCH_MIN_PAGES
+        pages = math.ceil(PREFETCH_LOOKAHEAD_SECONDS / max(session.interval, 0.05))
+        return max(PREFETCH_MIN_PAGES, min(PREFETCH_MAX_PAGES, pages))
+
+    def schedule(self, session_key, abs_path, mtime, page_count, page_num, scale, encoding=PNG_ENCODING):
+        if not PREFETCH_ENABLED:
+            return
+        now = time.monotonic()
+        session = self._session(session_key, now)
+        if session.last_page is not None and page_num != session.last_page:
+            turn = now - session.last_time
+            session.interval = turn if session.interval is None else \
+                session.interval + PREFETCH_INTERVAL_ALPHA * (turn - session.interval)
+            session.direction = 1 if page_num > session.last_page else -1
+        session.last_page = page_num
+        session.last_time = now
+        if session.task is not None:
+            session.task.cancel()
+
+        k = self.lookahead(session)
+        ahead = [page_num + session.direction * step for step in range(1, k + 1)]
+        plan = [page for page in ahead + [page_num - session.direction]
+                if 1 <= page <= page_count and render_key(abs_path, mtime, page, scale, encoding) not in self.renderer.cache]
+        session.task = None
+        if plan:
+            session.task = asyncio.get_running_loop().create_task(self._run(abs_path, mtime, plan, scale, encoding))
+
+    async def _run(self, abs_path, mtime, plan, scale, encoding):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+        for page_num in plan:
+            await self.renderer.wait_idle()
+            async with self._semaphore:
+                await self.renderer.wait_idle()
+                try:
+                    await self.renderer.render(abs_path, mtime, page_num, scale, encoding, foreground=False)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.debug("prefetch of page %s failed for %s", page_num, abs_path, exc_info=True)
+                    return
+
+    def stop(self):
+        for session in self._sessions.values():
+            if session.task is not None:
+                session.task.cancel()
+        self._sessions.clear()
+
+
+page_prefetcher = PagePrefetcher(page_renderer)
+
+
+async def stop_rendering():
+    page_prefetcher.stop()
+    page_renderer.shutdown()
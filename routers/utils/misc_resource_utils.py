@@ -0,0 +1,178 @@
+import asyncio
+import bisect
+import time
+
+import httpx
+
+from routers.utils.misc_keycloak_utils import obtain_headers, get_all_resources_detailed, retrieve_resource, keycloak_client
+from routers.utils.keycloak_vars import *
+from routers.utils.misc_metrics_utils import record_cache
+
+
+RESOURCE_INDEX_MAX_AGE = 60.0       # seconds before the index is re-synced from Keycloak
+RESOURCE_DELETE_CONCURRENCY = 16    # parallel DELETE requests against Keycloak
+RESOURCE_DELETE_TIMEOUT = 30.0
+RESOURCE_LOOKUP_CONCURRENCY = 8     # parallel lookups for names missing from the index
+
+
+class ResourceIndex:
+    """
+    Local index of Keycloak resource names, synced from Keycloak.
+
+    Names are kept in a sorted list, so "every resource at or below a path" is a
+    binary search plus a contiguous slice instead of a scan over all resources:
+    'docs' matches 'docs' and 'docs/...' but not 'docs2' or 'old/docs'.
+    """
+
+    def __init__(self, max_age=RESOURCE_INDEX_MAX_AGE):
+        self.max_age = max_age
+        self._names = []        # sorted resource names
+        self._resources = {}    # name -> {"_id": ..., "type": ...}
+        self._synced_at = None
+        self._stale = True
+        self._lock = None
+
+    def _load(self, resources: dict):
+        by_name = {}
+        for resource_id, resource in resources.items():
+            name = resource.get("name")
+            if name is not None:
+                by_name[name] = {"_id": resource_id, "type": resource.get("type")}
+        self._resources = by_name
+        self._names = sorted(by_name)
+        self._synced_at = time.monotonic()
+        self._stale = False
+
+    async def sync(self, access_token=None):
+        """Reload all resources from Keycloak (one request)"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self._load(await get_all_resources_detailed(access_token))
+
+    async def ensure_fresh(self, access_token=None):
+        if self._stale or self._synced_at is None or time.monotonic() - self._synced_at > self.max_age:
+            await self.sync(access_token)
+
+    def mark_stale(self):
+        """Force a re-sync before the next lookup, e.g. after resources were created elsewhere"""
+        self._stale = True
+
+    def add(self, name: str, resource_id: str, resource_type: str = None):
+        if name not in self._resources:
+            bisect.insort(self._names, name)
+        self._resources[name] = {"_id": resource_id, "type": resource_type}
+
+    def remove(self, names):
+        for name in names:
+            if self._resources.pop(name, None) is not None:
+                index = bisect.bisect_left(self._names, name)
+                if index < len(self._names) and self._names[index] == name:
+                    del self._names[index]
+
+    def get(self, name: str):
+        return self._resources.get(name)
+
+    def names(self):
+        return list(self._names)
+
+    async def resolve(self, names, access_token=None) -> dict:
+        """
+        Resolve a batch of resource names to {"_id": ..., "type": ...} (None if the resource does not exist).
+        Names are answered from the index; misses (e.g. created since the last sync) are
+        looked up in Keycloak concurrently and added to the index.
+        """
+        await self.ensure_fresh(access_token)
+        resolved = {name: self._resources.get(name) for name in names}
+        misses = [name for name, resource in resolved.items() if resource is None]
+        record_cache("resource_index", True, len(resolved) - len(misses))
+        record_cache("resource_index", False, len(misses))
+        if not misses:
+            return resolved
+
+        semaphore = asyncio.Semaphore(RESOURCE_LOOKUP_CONCURRENCY)
+
+        async def lookup(name):
+            async with semaphore:
+                resource = await retrieve_resource(name, access_token)
+            if resource and resource.get("_id"):
+                self.add(name, resource["_id"], resource.get("type"))
+                resolved[name] = self._resources[name]
+
+        await asyncio.gather(*(lookup(name) for name in misses))
+        return resolved
+
+    def under(self, path: str) -> dict:
+        """name -> resource for `path` itself and every resource below it"""
+        path = path.rstrip("/")
+        matches = {}
+        if path in self._resources:
+            matches[path] = self._resources[path]
+        # names sharing a prefix form one contiguous run in sorted order
+        prefix = path + "/"
+        index = bisect.bisect_left(self._names, prefix)
+        while index < len(self._names) and self._names[index].startswith(prefix):
+            name = self._names[index]
+            matches[name] = self._resources[name]
+            index += 1
+        return matches
+
+
+resource_index = ResourceIndex()
+
+
+async def delete_resources(resource_ids, access_token=None, concurrency=RESOURCE_DELETE_CONCURRENCY):
+    """
+    Delete Keycloak resources concurrently over one client and one token.
+
+    Returns:
+        (deleted_ids, failed) where failed maps resource id -> error text.
+        A resource that is already gone (404) counts as deleted.
+    """
+    resource_ids = list(resource_ids)
+    if not resource_ids:
+        return [], {}
+
+    headers, _ = await obtain_headers(access_token)
+    semaphore = asyncio.Semaphore(concurrency)
+    deleted, failed = [], {}
+
+    async with keycloak_client(
+        timeout=RESOURCE_DELETE_TIMEOUT,
+        limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    ) as client:
+        async def delete_one(resource_id):
+            async with semaphore:
+                try:
+                    response = await client.delete(base_url + ep_delete_resource + resource_id, headers=headers)
+                    if response.status_code in (200, 204, 404):
+                        deleted.append(resource_id)
+                    else:
+                        failed[resource_id] = f"{response.status_code} - {response.text}"
+                except httpx.HTTPError as e:
+                    failed[resource_id] = str(e)
+
+        await asyncio.gather(*(delete_one(resource_id) for resource_id in resource_ids))
+
+    return deleted, failed
+
+
+async def delete_resources_under(path: str, access_token=None):
+    """
+    Delete the resource named `path` and every resource below it.
+
+    Returns:
+        {"deleted": [names], "failed": {name: error}}
+    """
+    await resource_index.ensure_fresh(access_token)
+    matches = resource_index.under(path)
+    id_to_name = {resource["_id"]: name for name, resource in matches.items()}
+
+    deleted_ids, failed_ids = await delete_resources(id_to_name, access_token)
+    deleted_names = [id_to_name[resource_id] for resource_id in deleted_ids]
+    resource_index.remove(deleted_names)
+
+    return {
+        "deleted": deleted_names,
+        "failed": {id_to_name[resource_id]: error for resource_id, error in failed_ids.items()}
+    }
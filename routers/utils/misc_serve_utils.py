@@ -0,0 +1,107 @@
+import os
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import HTTPException
+from fastapi.responses import FileResponse, Response
+
+
+def compute_etag(stat_result: os.stat_result) -> str:
+    """Strong ETag derived from (inode, size, mtime); changes whenever the file content is replaced"""
+    return f'"{stat_result.st_ino:x}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def is_not_modified(request_headers, etag: str, stat_result: os.stat_result) -> bool:
+    """
+    Evaluate If-None-Match / If-Modified-Since against the current representation.
+    If-None-Match takes precedence over If-Modified-Since (RFC 9110, 13.2.2).
+    """
+    if not request_headers:
+        return False
+
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match:
+        if if_none_match.strip() == "*":
+            return True
+        # weak comparison: W/"x" matches "x"
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag in tags
+
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have one second resolution
+        return int(stat_result.st_mtime) <= since
+
+    return False
+
+
+class ServedFileResponse(FileResponse):
+    """
+    FileResponse with the multipart/byteranges boundary in Content-Type, where clients
+    look for it. Range / multi-range (206) and If-Range handling come from FileResponse.
+    """
+
+    async def _handle_multiple_ranges(self, send, ranges, file_size: int, send_header_only: bool) -> None:
+        # FileResponse puts the multipart boundary in Content-Range; clients expect it in Content-Type.
+        # Its Content-Length is one byte short of the body it sends, so the body goes out chunked.
+        async def send_multipart(message):
+            if message["type"] == "http.response.start":
+                multipart_type = self.headers["content-range"].encode("latin-1")
+                headers = [(k, v) for k, v in message["headers"]
+                           if k not in (b"content-type", b"content-range", b"content-length")]
+                headers.append((b"content-type", multipart_type))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        await super()._handle_multiple_ranges(send_multipart, ranges, file_size, send_header_only)
+
+
+def serve_file(abs_path, request_headers=None, media_type=None, filename=None,
+               content_disposition_type="attachment", cache_control="private, no-cache", headers=None):
+    """
+    Shared file-serving layer for downloads, raw PDFs and preview artifacts.
+
+    - strong ETag from (inode, size, mtime) plus Last-Modified
+    - 304 Not Modified for matching If-None-Match / If-Modified-Since
+    - 206 Partial Content for single and multi-range Range requests
+    """
+    try:
+        stat_result = os.stat(abs_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    etag = compute_etag(stat_result)
+    validator_headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+
+    if is_not_modified(request_headers, etag, stat_result):
+        return Response(status_code=304, headers=validator_headers)
+
+    response_headers = dict(headers or {})
+    response_headers.update(validator_headers)
+    return ServedFileResponse(
+        path=abs_path,
+        media_type=media_type,
+        filename=filename,
+        headers=response_headers,
+        stat_result=stat_result,
+        content_disposition_type=content_disposition_type
+    )
+
+
+def is_initial_request(request_headers) -> bool:
+    """False for resumed / partial downloads (Range starting past byte 0)"""
+    if not request_headers:
+        return True
+    http_range = request_headers.get("range", "")
+    return not http_range or http_range.replace(" ", "").startswith("bytes=0-")
@@ -0,0 +1,176 @@
+import sys
+from array import array
+from collections import OrderedDict
+
+import fitz
+
+from routers.utils.misc_metrics_utils import record_cache
+
+
+TEXT_LAYER_CACHE_MAX_BYTES = 64 * 1024 * 1024       # estimated memory of all cached pages
+TEXT_LAYER_CACHE_MAX_ENTRY_BYTES = 8 * 1024 * 1024  # larger pages are extracted but not kept
+TEXT_LAYER_COMPACT_DECIMALS = 2    # coordinates in the compact format are rounded to this many decimals
+TEXT_LAYER_FORMATS = ("full", "compact")
+
+
+class TextLayer:
+    """
+    Text of one page, extracted once and kept unscaled in parallel arrays (one entry per
+    word / per line) instead of a dict per word. Numbers live in typed arrays (unboxed
+    doubles and ints), only the strings are Python objects. Scaling happens when a
+    response is built.
+    """
+    __slots__ = ("page_width", "page_height",
+                 "word_text", "word_bbox", "word_block", "word_line", "word_no",
+                 "line_text", "line_bbox", "line_size", "line_font", "fonts", "nbytes")
+
+    def __init__(self, page):
+        # one TextPage for both the word list and the line structure (was two full extractions)
+        textpage = page.get_textpage(flags=fitz.TEXTFLAGS_WORDS)
+        self.page_width = page.rect.width
+        self.page_height = page.rect.height
+
+        words = page.get_text("words", textpage=textpage)
+        self.word_text = [word[4] for word in words]
+        self.word_bbox = array("d", (coordinate for word in words for coordinate in word[:4]))  # x0, y0, x1, y1, ...
+        self.word_block = array("i", (word[5] for word in words))
+        self.word_line = array("i", (word[6] for word in words))
+        self.word_no = array("i", (word[7] for word in words))
+
+        self.line_text, self.line_bbox, self.line_size, self.line_font = [], array("d"), array("d"), array("i")
+        self.fonts = []
+        font_index = {}
+        for block in page.get_text("dict", textpage=textpage)["blocks"]:
+            for line in block.get("lines", ()):
+                spans = line["spans"]
+                line_text = "".join(span["text"] for span in spans)
+                if not line_text.strip():
+                    continue
+                bbox = list(spans[0]["bbox"])
+                for span in spans[1:]:
+                    span_bbox = span["bbox"]
+                    bbox[0] = min(bbox[0], span_bbox[0])
+                    bbox[1] = min(bbox[1], span_bbox[1])
+                    bbox[2] = max(bbox[2], span_bbox[2])
+                    bbox[3] = max(bbox[3], span_bbox[3])
+                font = spans[0].get("font", "unknown")
+                if font not in font_index:
+                    font_index[font] = len(self.fonts)
+                    self.fonts.append(font)
+                self.line_text.append(line_text)
+                self.line_bbox.extend(bbox)
+                self.line_size.append(spans[0].get("size", 12))
+                self.line_font.append(font_index[font])
+        self.nbytes = self._estimate_size()
+
+    def _estimate_size(self):
+        """Approximate memory held by the layer (arrays, string lists and their strings)"""
+        size = 0
+        for strings in (self.word_text, self.line_text, self.fonts):
+            size += sys.getsizeof(strings) + sum(sys.getsizeof(text) for text in strings)
+        for numbers in (self.word_bbox, self.word_block, self.word_line, self.word_no,
+                        self.line_bbox, self.line_size, self.line_font):
+            size += sys.getsizeof(numbers)
+        return size
+
+    def full_words(self, scale):
+        """The original verbose shape: a dict per word with a nested bbox"""
+        bbox = self.word_bbox
+        return [{
+            "text": text,
+            "bbox": {
+                "x": bbox[4 * i] * scale,
+                "y": bbox[4 * i + 1] * scale,
+                "width": (bbox[4 * i + 2] - bbox[4 * i]) * scale,
+                "height": (bbox[4 * i + 3] - bbox[4 * i + 1]) * scale
+            },
+            "block_no": self.word_block[i],
+            "line_no": self.word_line[i],
+            "word_no": self.word_no[i],
+            "type": "word"
+        } for i, text in enumerate(self.word_text)]
+
+    def full_lines(self, scale):
+        """The original verbose shape: a dict per line with a nested bbox and font info"""
+        bbox = self.line_bbox
+        return [{
+            "text": text,
+            "bbox": {
+                "x": bbox[4 * i] * scale,
+                "y": bbox[4 * i + 1] * scale,
+                "width": (bbox[4 * i + 2] - bbox[4 * i]) * scale,
+                "height": (bbox[4 * i + 3] - bbox[4 * i + 1]) * scale
+            },
+            "type": "line",
+            "font_info": {
+                "size": self.line_size[i] * scale,
+                "font": self.fonts[self.line_font[i]]
+            }
+        } for i, text in enumerate(self.line_text)]
+
+    def compact_words(self, scale):
+        return {
+            "text": self.word_text,
+            "bbox": _scaled_boxes(self.word_bbox, scale),
+            "block": self.word_block.tolist(),
+            "line": self.word_line.tolist(),
+            "word": self.word_no.tolist()
+        }
+
+    def compact(self, scale):
+        """
+        Parallel arrays with flat, rounded [x, y, width, height, ...] boxes:
+        {"words": {"text", "bbox", "block", "line", "word"}, "lines": {"text", "bbox", "size", "font"}, "fonts"}
+        where lines.font indexes fonts.
+        """
+        return {
+            "words": self.compact_words(scale),
+            "lines": {
+                "text": self.line_text,
+                "bbox": _scaled_boxes(self.line_bbox, scale),
+                "size": [round(size * scale, TEXT_LAYER_COMPACT_DECIMALS) for size in self.line_size],
+                "font": self.line_font.tolist()
+            },
+            "fonts": self.fonts
+        }
+
+
+def _scaled_boxes(corners, scale):
+    """[x0, y0, x1, y1, ...] -> [x, y, width, height, ...] scaled and rounded"""
+    decimals = TEXT_LAYER_COMPACT_DECIMALS
+    boxes = []
+    for i in range(0, len(corners), 4):
+        x0, y0, x1, y1 = corners[i:i + 4]
+        boxes += (round(x0 * scale, decimals), round(y0 * scale, decimals),
+                  round((x1 - x0) * scale, decimals), round((y1 - y0) * scale, decimals))
+    return boxes
+
+
+class TextLayerCache:
+    """LRU of text layers bounded by their estimated memory"""
+
+    def __init__(self, max_bytes=TEXT_LAYER_CACHE_MAX_BYTES, max_entry_bytes=TEXT_LAYER_CACHE_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, doc, abs_path, mtime, page_num) -> TextLayer:
+        key = (abs_path, mtime, page_num)
+        layer = self._entries.get(key)
+        record_cache("text_layer", layer is not None)
+        if layer is not None:
+            self._entries.move_to_end(key)
+            return layer
+        layer = TextLayer(doc.load_page(page_num - 1))
+        if layer.nbytes > self.max_entry_bytes:
+            return layer
+        self._entries[key] = layer
+        self.size += layer.nbytes
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= evicted.nbytes
+        return layer
+
+
+text_layer_cache = TextLayerCache()
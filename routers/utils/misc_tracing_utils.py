@@ -0,0 +1,274 @@
+import os
+import json
+import time
+import queue
+import random
+import inspect
+import threading
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+from routers.utils.misc_logging_utils import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# Per-request breakdown in a Server-Timing response header. It names internal spans (auth,
+# Keycloak, filesystem), so it is off by default; "admin" sends it only on responses to
+# requests authenticated with the admin role, True on every response.
+TRACE_SERVER_TIMING = False          # False | "admin" | True
+TRACE_EXPORT = None                  # None | "jsonl" | "otel"
+TRACE_EXPORT_FILE = os.path.join("data", "traces.jsonl")
+TRACE_EXPORT_SAMPLE_RATE = 1.0       # share of requests exported (independent of Server-Timing)
+TRACE_MAX_SPANS = 2000               # per request; further spans are counted but not kept
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("span_id", "parent_id", "name", "attributes", "start", "end", "error")
+
+    def __init__(self, span_id, parent_id, name, attributes):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.end = None
+        self.error = None
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+
+class Trace:
+    """Spans of one request. Spans may be recorded from worker threads (asyncio.to_thread copies the context)."""
+
+    def __init__(self, name, attributes=None):
+        self.trace_id = f"{random.getrandbits(128):032x}"
+        self.root = Span(0, None, name, attributes or {})
+        self.wall_start_ns = time.time_ns()
+        self.spans = []
+        self.dropped = 0
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def start_span(self, name, parent, attributes):
+        with self._lock:
+            if len(self.spans) >= TRACE_MAX_SPANS:
+                self.dropped += 1
+                return None
+            span = Span(self._next_id, parent.span_id if parent else 0, name, attributes)
+            self._next_id += 1
+            self.spans.append(span)
+            return span
+
+    def breakdown(self):
+        """span name -> (total seconds, count), for finished spans"""
+        totals = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            if span.end is None:
+                continue
+            total, count = totals.get(span.name, (0.0, 0))
+            totals[span.name] = (total + span.duration, count + 1)
+        return totals
+
+    def server_timing(self) -> str:
+        entries = [f'{name};dur={total * 1000:.1f};desc="{count}x"'
+                   for name, (total, count) in sorted(self.breakdown().items(), key=lambda item: -item[1][0])]
+        entries.append(f"total;dur={self.root.duration * 1000:.1f}")
+        return ", ".join(entries)
+
+    def to_dict(self):
+        offset_ns = lambda t: self.wall_start_ns + int((t - self.root.start) * 1e9)
+        with self._lock:
+            spans = [self.root] + list(self.spans)
+        return {
+            "trace_id": self.trace_id,
+            "name": self.root.name,
+            "attributes": self.root.attributes,
+            "dropped_spans": self.dropped,
+            "spans": [{
+                "span_id": span.span_id,
+                "parent_id": span.parent_id,
+                "name": span.name,
+                "start_ns": offset_ns(span.start),
+                "duration_ms": round(span.duration * 1000, 3),
+                "attributes": span.attributes,
+                "error": span.error
+            } for span in spans]
+        }
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Time the with-block as a child of the current span. A no-op outside a traced request
+    (background tasks, startup), so it is cheap to leave in hot paths.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    current = trace.start_span(name, _current_span.get(), attributes)
+    if current is None:
+        yield None
+        return
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.end = time.perf_counter()
+        _current_span.reset(token)
+
+
+def traced(name):
+    """Decorator form of span() for sync and async functions"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _JsonlExporter:
+    """Appends finished traces to TRACE_EXPORT_FILE from a background thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def export(self, trace):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                    self._thread.start()
+        self._queue.put(trace.to_dict())
+
+    def _run(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        while True:
+            record = self._queue.get()
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+            except Exception:
+                logger.error("trace export failed", exc_info=True)
+
+
+class _OtelExporter:
+    """
+    Replays finished traces as OpenTelemetry spans. Only opentelemetry-api is needed here;
+    where they go (OTLP collector, console, file) is whatever SDK/exporter the process configured.
+    """
+
+    def __init__(self):
+        from opentelemetry import trace as otel_trace
+        self._otel = otel_trace
+        self._tracer = otel_trace.get_tracer("files-api")
+
+    def export(self, trace):
+        record = trace.to_dict()
+        otel_spans = {}
+        for span_record in record["spans"]:
+            parent = otel_spans.get(span_record["parent_id"])
+            context = self._otel.set_span_in_context(parent) if parent is not None else None
+            otel_span = self._tracer.start_span(
+                span_record["name"], context=context, start_time=span_record["start_ns"],
+                attributes={key: str(value) for key, value in span_record["attributes"].items()}
+            )
+            if span_record["error"]:
+                otel_span.set_status(self._otel.Status(self._otel.StatusCode.ERROR, span_record["error"]))
+            otel_spans[span_record["span_id"]] = otel_span
+        # end children before parents
+        for span_record in reversed(record["spans"]):
+            otel_spans[span_record["span_id"]].end(
+                end_time=span_record["start_ns"] + int(span_record["duration_ms"] * 1e6))
+
+
+def _make_exporter():
+    if TRACE_EXPORT == "jsonl":
+        return _JsonlExporter(TRACE_EXPORT_FILE)
+    if TRACE_EXPORT == "otel":
+        try:
+            return _OtelExporter()
+        except ImportError:
+            logger.warning("opentelemetry-api is not installed, traces are not exported")
+    return None
+
+
+_exporter = _make_exporter()
+
+
+def _send_server_timing(scope) -> bool:
+    if TRACE_SERVER_TIMING == "admin":
+        # request.state, filled in by @jwt_token before the response starts
+        return "admin" in (scope.get("state", {}).get("roles") or ())
+    return bool(TRACE_SERVER_TIMING)
+
+
+class TracingMiddleware:
+    """
+    Pure ASGI middleware opening a trace per HTTP request. The spans recorded while the
+    request is handled are summed per name into a Server-Timing header (see
+    TRACE_SERVER_TIMING), e.g.
+    `auth.verify;dur=41.2;desc="1x", keycloak;dur=30.5;desc="3x", fitz.render;dur=310.0;desc="1x"`.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        trace = Trace(f"{scope.get('method', '')} {scope.get('path', '')}", {"http.method": scope.get("method")})
+        trace_token = _current_trace.set(trace)
+        span_token = _current_span.set(trace.root)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                trace.root.attributes["http.status_code"] = message["status"]
+                if _send_server_timing(scope):
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", trace.server_timing().encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            trace.root.error = type(e).__name__
+            raise
+        finally:
+            trace.root.end = time.perf_counter()
+            _current_span.reset(span_token)
+            _current_trace.reset(trace_token)
+            route = scope.get("route")
+            if route is not None:
+                trace.root.attributes["http.route"] = getattr(route, "path", None)
+            if _exporter is not None and random.random() < TRACE_EXPORT_SAMPLE_RATE:
+                try:
+                    _exporter.export(trace)
+                except Exception:
+                    logger.error("trace export failed", exc_info=True)